@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from encode import build_agent, build_dataset
+from src.agents.openai_adapter import usage_summary
+from src.agents.rate_limiter import RateLimiter
+from src.mock.openai_server import LatencyModel, MockOpenAIServer
+from src.mock.synthetic_data import write_amazon, write_movielens
+from src.pipeline.async_encoder import AsyncUserEncoder
+from src.pipeline.result_writer import ResultWriter
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] - %(levelname)s - %(message)s')
+
+
+def parse_args():
+    """
+    Parses command-line arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the encode pipeline against a local mock OpenAI server")
+    parser.add_argument("--dataset", '-d',
+                        dest='datasets',
+                        nargs='+',
+                        default=["ml-1m", "amazon"],
+                        choices=["ml-1m", "amazon"],
+                        help="Datasets to benchmark")
+    parser.add_argument("--users", '-n',
+                        type=int,
+                        dest='users',
+                        default=200,
+                        help="Number of users encoded per run")
+    parser.add_argument("--concurrency", '-c',
+                        type=int,
+                        dest='concurrency',
+                        nargs='+',
+                        default=[1, 8, 32],
+                        help="Concurrency levels to benchmark")
+    parser.add_argument("--embedding-batch-size",
+                        type=int,
+                        dest='embedding_batch_size',
+                        default=64,
+                        help="Maximum number of descriptions per embedding request in the asyncio pipeline")
+    parser.add_argument("--synthetic",
+                        dest='synthetic',
+                        action='store_true',
+                        help="Generate synthetic datasets instead of reading the ones in data/")
+    parser.add_argument("--chat-latency",
+                        type=LatencyModel.parse,
+                        dest='chat_latency',
+                        default=LatencyModel("lognormal", 0.5, 0.4),
+                        help="Mock chat latency as distribution:median[:spread[:per_token]]")
+    parser.add_argument("--embedding-latency",
+                        type=LatencyModel.parse,
+                        dest='embedding_latency',
+                        default=LatencyModel("lognormal", 0.1, 0.3),
+                        help="Mock embedding latency as distribution:median[:spread[:per_token]]")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        dest='error_rate',
+                        default=0.0,
+                        help="Probability of a mocked 429 response")
+    parser.add_argument("--mock-rpm",
+                        type=int,
+                        dest='mock_rpm',
+                        default=None,
+                        help="Requests per minute above which the mock answers with 429")
+    parser.add_argument("--prefix-cache-min-tokens",
+                        type=int,
+                        dest='prefix_cache_min_tokens',
+                        default=1024,
+                        help="Shortest prompt prefix served from the mock prefix cache")
+    parser.add_argument("--rpm",
+                        type=float,
+                        dest='requests_per_minute',
+                        default=None,
+                        help="Requests per minute of the client-side rate limiter")
+    parser.add_argument("--check-batching",
+                        dest='check_batching',
+                        action='store_true',
+                        help="Assert that the embedding batches fill up at every concurrency level instead of "
+                             "benchmarking")
+    parser.add_argument("--output", '-o',
+                        dest='output',
+                        default=None,
+                        help="JSON file for the benchmark report")
+    return parser.parse_args()
+
+
+def benchmark(mode: str,
+              folder: str,
+              users: int,
+              concurrency: int,
+              embedding_batch_size: int,
+              server_options: dict,
+              requests_per_minute: float | None = None,
+              embedding_max_wait: float = 0.25,
+              asynchronous: bool | None = None) -> dict:
+    """
+    Encodes the first users of a dataset against a fresh mock server and measures the pipeline.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset.
+        users (int): The number of users to encode.
+        concurrency (int): The number of users processed concurrently.
+        embedding_batch_size (int): The maximum number of descriptions per embedding request.
+        server_options (dict): The keyword arguments of MockOpenAIServer.
+        requests_per_minute (float, optional): The client-side requests-per-minute budget. Defaults to None.
+        embedding_max_wait (float, optional): The maximum embedding batch wait in seconds. Defaults to 0.25.
+        asynchronous (bool, optional): Whether to run the asyncio pipeline. Defaults to None, i.e. above a
+            concurrency of 1 as encode.py does.
+
+    Returns:
+        dict: The throughput, the user latency percentiles and the request counts of the run.
+    """
+    dataset = build_dataset(mode, folder)
+    user_ids = dataset.user_ids()[:users]
+    latencies, errors = [], 0
+    with MockOpenAIServer(**server_options) as server, tempfile.TemporaryDirectory() as result_folder:
+        rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, max_concurrency=concurrency)
+        llm_agent = build_agent(mode, "openai", rate_limiter=rate_limiter, token="mock",  # noqa: S106
+                                base_url=server.url)
+        writer = ResultWriter(result_folder=result_folder, mode=mode)
+
+        def collect(user, record: dict | None, error: Exception | None):
+            nonlocal errors
+            if error is None:
+                writer.write(record, embedding=user.embedding)
+            else:
+                errors += 1
+
+        started = time.perf_counter()
+        if asynchronous if asynchronous is not None else concurrency > 1:
+            encoder = AsyncUserEncoder(llm_agent=llm_agent, concurrency=concurrency,
+                                       embedding_batch_size=embedding_batch_size,
+                                       embedding_max_wait=embedding_max_wait)
+            encode_user = encoder.encode_user
+
+            async def timed(user, slot: asyncio.Semaphore | None = None) -> dict:
+                user_started = time.perf_counter()
+                try:
+                    return await encode_user(user, slot)
+                finally:
+                    latencies.append(time.perf_counter() - user_started)
+
+            encoder.encode_user = timed
+            asyncio.run(encoder.run((dataset.get_user(user_id) for user_id in user_ids), collect))
+        else:
+            for user_id in user_ids:
+                user = dataset.get_user(user_id)
+                user_started = time.perf_counter()
+                try:
+                    user.description = llm_agent.get_user_description(user=user)
+                    user.embedding = llm_agent.encode_description(user.description)
+                    collect(user, user.dict(), None)
+                except Exception as e:
+                    collect(user, None, e)
+                latencies.append(time.perf_counter() - user_started)
+        writer.close()
+        elapsed = time.perf_counter() - started
+        written = os.path.getsize(writer.result_path)
+        stats = dict(server.stats)
+        usage = usage_summary(llm_agent.metrics)
+
+    return {"dataset": mode,
+            "concurrency": concurrency,
+            "users": len(user_ids),
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "users_per_second": round(len(user_ids) / elapsed, 2),
+            "latency_p50": round(float(np.percentile(latencies, 50)), 3),
+            "latency_p99": round(float(np.percentile(latencies, 99)), 3),
+            "chat_requests": stats["chat"],
+            "embedding_requests": stats["embedding"],
+            "embedding_inputs": stats["embedding_inputs"],
+            "rate_limited": stats["rate_limited"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "cached_tokens": usage["cached_tokens"],
+            "result_bytes": written}
+
+
+def check_embedding_batching(mode: str, folder: str, users: int, embedding_batch_size: int, server_options: dict,
+                             concurrency_levels: list[int]):
+    """
+    Checks that the asyncio pipeline fills its embedding batches, i.e. that the users are embedded in
+    ceil(users / embedding_batch_size) requests whatever the concurrency. The mock chat answers without latency and
+    the batch wait is long, so that only the batch size closes a batch before the last one.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset.
+        users (int): The number of users to encode.
+        embedding_batch_size (int): The maximum number of descriptions per embedding request.
+        server_options (dict): The keyword arguments of MockOpenAIServer.
+        concurrency_levels (list[int]): The concurrency levels to check.
+
+    Raises:
+        RuntimeError: If a run fails users or sends more embedding requests than full batches need.
+    """
+    server_options = {**server_options, "chat_latency": LatencyModel("fixed", 0.0), "error_rate": 0.0,
+                      "requests_per_minute": None}
+    for concurrency in concurrency_levels:
+        result = benchmark(mode, folder, users, concurrency, embedding_batch_size, server_options,
+                           embedding_max_wait=5.0, asynchronous=True)
+        expected = -(-result["users"] // embedding_batch_size)
+        if result["errors"]:
+            raise RuntimeError(f"{mode} c={concurrency}: {result['errors']} users failed")
+        if result["embedding_inputs"] != result["users"]:
+            raise RuntimeError(f"{mode} c={concurrency}: {result['embedding_inputs']} embedding inputs for "
+                               f"{result['users']} users")
+        if result["embedding_requests"] != expected:
+            raise RuntimeError(f"{mode} c={concurrency}: {result['embedding_requests']} embedding requests instead "
+                               f"of {expected}")
+        logging.info(f"{mode} c={concurrency}: {result['users']} users embedded in {expected} batches")
+
+
+if __name__ == '__main__':
+    """
+    Main entry point for the script.
+    """
+    args = parse_args()
+    server_options = {"chat_latency": args.chat_latency,
+                      "embedding_latency": args.embedding_latency,
+                      "error_rate": args.error_rate,
+                      "requests_per_minute": args.mock_rpm,
+                      "prefix_cache_min_tokens": args.prefix_cache_min_tokens}
+    with tempfile.TemporaryDirectory() as data_folder:
+        folders = {"ml-1m": os.path.join("data", "ml-1m"), "amazon": os.path.join("data", "Amazon_CDs_and_Vinyl")}
+        if args.synthetic:
+            folders = {"ml-1m": write_movielens(os.path.join(data_folder, "ml-1m"), n_users=args.users),
+                       "amazon": write_amazon(os.path.join(data_folder, "Amazon_CDs_and_Vinyl"), n_users=args.users)}
+        report = []
+        for mode in args.datasets:
+            if args.check_batching:
+                check_embedding_batching(mode, folders[mode], args.users, args.embedding_batch_size, server_options,
+                                         args.concurrency)
+                continue
+            for concurrency in args.concurrency:
+                result = benchmark(mode, folders[mode], args.users, concurrency, args.embedding_batch_size,
+                                   server_options, requests_per_minute=args.requests_per_minute)
+                logging.info(f"{mode} c={concurrency}: {result['users_per_second']} users/s, "
+                             f"p50 {result['latency_p50']}s, p99 {result['latency_p99']}s, "
+                             f"{result['chat_requests']} chat + {result['embedding_requests']} embedding requests "
+                             f"({result['embedding_inputs']} inputs), {result['rate_limited']} rate limited, "
+                             f"{result['cached_tokens']} of {result['prompt_tokens']} prompt tokens prefix-cached, "
+                             f"{result['errors']} errors")
+                report.append(result)
+
+    if args.output and report:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Report saved to {args.output}")
@@ -0,0 +1,130 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+from src.storage.user_index import UserIndex
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] - %(levelname)s - %(message)s')
+
+# ml-1m and the 5-core Amazon CDs and Vinyl user counts
+USER_COUNTS = {"ml-1m": 6040, "amazon": 112395}
+
+
+def parse_args():
+    """
+    Parses command-line arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the top-k queries of UserIndex")
+    parser.add_argument("--dataset", '-d',
+                        dest='datasets',
+                        nargs='+',
+                        default=list(USER_COUNTS),
+                        choices=list(USER_COUNTS),
+                        help="Datasets whose user counts are benchmarked")
+    parser.add_argument("--dimensions",
+                        type=int,
+                        dest='dimensions',
+                        default=1536,
+                        help="Embedding dimension")
+    parser.add_argument("--queries", '-q',
+                        type=int,
+                        dest='queries',
+                        default=2000,
+                        help="Number of queries per run")
+    parser.add_argument("--k",
+                        type=int,
+                        dest='k',
+                        default=10,
+                        help="Number of similar users per query")
+    parser.add_argument("--nprobe",
+                        type=int,
+                        dest='nprobe',
+                        default=8,
+                        help="Clusters scored per query in IVF mode")
+    parser.add_argument("--output", '-o',
+                        dest='output',
+                        default=None,
+                        help="JSON file for the benchmark report")
+    return parser.parse_args()
+
+
+def clustered_embeddings(users: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    """
+    Draws embeddings around a few hundred topics, closer to real user embeddings than isotropic noise.
+
+    Args:
+        users (int): The number of users.
+        dimensions (int): The embedding dimension.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: The float32 embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((256, dimensions), dtype=np.float32)
+    vectors = topics[rng.integers(0, len(topics), users)]
+    vectors += 0.8 * rng.standard_normal((users, dimensions), dtype=np.float32)
+    return vectors
+
+
+def benchmark(name: str, users: int, dimensions: int, queries: int, k: int, nprobe: int) -> list[dict]:
+    """
+    Measures the queries per second of exact, IVF and int8 IVF search and the recall of the approximate modes.
+
+    Args:
+        name (str): The dataset name.
+        users (int): The number of users.
+        dimensions (int): The embedding dimension.
+        queries (int): The number of query users.
+        k (int): The number of similar users per query.
+        nprobe (int): The number of clusters scored per query in IVF mode.
+
+    Returns:
+        list[dict]: One result per mode.
+    """
+    index = UserIndex(list(range(users)), clustered_embeddings(users, dimensions))
+    query_ids = np.random.default_rng(1).choice(users, min(queries, users), replace=False).tolist()
+    results, truth = [], None
+    for mode, quantize in (("exact", None), ("ivf", False), ("ivf-int8", True)):
+        started = time.perf_counter()
+        if quantize is not None:
+            index.build_ivf(nprobe=nprobe, quantize=quantize)
+        build_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        found = index.similar(query_ids, k=k, exact=quantize is None)
+        seconds = time.perf_counter() - started
+        neighbours = [{user_id for user_id, _ in row} for row in found]
+        if truth is None:
+            truth = neighbours
+        recall = np.mean([len(found_ids & true_ids) / len(true_ids)
+                          for found_ids, true_ids in zip(neighbours, truth, strict=True)])
+        results.append({"dataset": name, "users": users, "mode": mode, "queries": len(query_ids),
+                        "build_seconds": round(build_seconds, 3),
+                        "queries_per_second": round(len(query_ids) / seconds, 1),
+                        f"recall@{k}": round(float(recall), 4)})
+    return results
+
+
+if __name__ == '__main__':
+    """
+    Main entry point for the script.
+    """
+    args = parse_args()
+    report = []
+    for dataset in args.datasets:
+        for result in benchmark(dataset, USER_COUNTS[dataset], args.dimensions, args.queries, args.k, args.nprobe):
+            logging.info(f"{dataset} ({result['users']} users) {result['mode']}: "
+                         f"{result['queries_per_second']} queries/s, recall@{args.k} {result[f'recall@{args.k}']}, "
+                         f"built in {result['build_seconds']}s")
+            report.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Report saved to {args.output}")
@@ -1,12 +1,32 @@
 from tqdm import tqdm
 import argparse
+import asyncio
 import json
 import logging
 import os
+import time
+import numpy as np
 
-from src.agents.embed_agent import EmbedAgentMovie, EmbedAgentMusic
+from src.agents.embed_agent import EmbedAgent, EmbedAgentMovie, EmbedAgentMusic, ItemAgentMovie, ItemAgentMusic
+from src.agents.embedding_backends import EmbeddingBackend, build_backend
+from src.agents.llm_cache import LLMCache
+from src.agents.openai_adapter import usage_summary
+from src.agents.rate_limiter import RateLimiter
+from src.data.prompt_budget import STRATEGIES, PromptBudget, approximate_token_count, tiktoken_counter
+from src.evaluation.compression import compression_report
+from src.evaluation.recommendation import SCORERS, SPLITS, RecommendationEvaluator
+from src.monitoring.run_metrics import MetricsExporter, RunMetrics
 from src.movie.movie_dataset import MovieDataset
 from src.music.music_dataset import MusicDataset
+from src.pipeline.async_encoder import AsyncUserEncoder
+from src.pipeline.batch_api import custom_id, export_batch, ingest_batch
+from src.pipeline.incremental import PreviousResults, carry_forward
+from src.pipeline.item_pooling import pool_embeddings, pooling_weights
+from src.pipeline.reembed import reembed
+from src.pipeline.result_writer import ResultWriter
+from src.pipeline.sharding import Shard, merge_shards
+from src.storage.embedding_store import EmbeddingStore, EmbeddingStoreWriter
+from src.storage.quantization import STORAGE_DTYPES
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] - %(levelname)s - %(message)s')
 
@@ -19,6 +39,17 @@ def parse_args():
         argparse.Namespace: The parsed arguments.
     """
     parser = argparse.ArgumentParser(description="Evaluate embeddings")
+    parser.add_argument("command",
+                        nargs='?',
+                        default="encode",
+                        choices=["encode", "merge", "export-batch", "ingest-batch", "reembed", "evaluate",
+                                 "compression-report", "pool"],
+                        help="encode the users (default), merge the outputs of --shard runs in the result folder, "
+                             "export the missing requests as Batch API input files, ingest Batch API output files, "
+                             "embed the descriptions of a previous run again with --embedding-backend, evaluate "
+                             "the recommendation quality of the embeddings, report the memory and the similar-user "
+                             "recall of reduced dimensions and storage dtypes or pool the item embeddings of a "
+                             "previous --encoding item run into user embeddings again, e.g. with other weights")
     parser.add_argument("--dataset", '-d',
                         type=str,
                         dest='dataset',
@@ -38,56 +69,796 @@ def parse_args():
                         dest='result_folder',
                         default="embeddings",
                         help="Folder for results json")
+    parser.add_argument("--encoding",
+                        dest='encoding',
+                        default="user",
+                        choices=["user", "item"],
+                        help="Describe and embed every user or describe and embed every rated item once and pool the "
+                             "item embeddings of every user, weighted by rating and recency, into {dataset}_pooled")
+    parser.add_argument("--rating-center",
+                        type=float,
+                        dest='rating_center',
+                        default=None,
+                        help="Neutral rating of the item encoding, items rated below it push the user away. Defaults "
+                             "to the middle of the rating range")
+    parser.add_argument("--half-life-days",
+                        type=float,
+                        dest='half_life_days',
+                        default=365,
+                        help="Half-life in days of the recency weight of the item encoding, counted back from the "
+                             "latest interaction of every user")
+    parser.add_argument("--concurrency", '-c',
+                        type=int,
+                        dest='concurrency',
+                        default=1,
+                        help="Number of users processed concurrently, values above 1 enable the asyncio pipeline")
+    parser.add_argument("--embedding-batch-size",
+                        type=int,
+                        dest='embedding_batch_size',
+                        default=64,
+                        help="Maximum number of descriptions per embedding request in the asyncio pipeline")
+    parser.add_argument("--cache-path",
+                        dest='cache_path',
+                        default=os.path.join(".cache", "llm_cache.sqlite"),
+                        help="SQLite file caching descriptions and embeddings between runs")
+    parser.add_argument("--no-cache",
+                        dest='no_cache',
+                        action='store_true',
+                        help="Disable the persistent cache of descriptions and embeddings")
+    parser.add_argument("--resume",
+                        dest='resume',
+                        action='store_true',
+                        help="Skip users finished by a previous run according to its last checkpoint")
+    parser.add_argument("--checkpoint-every",
+                        type=int,
+                        dest='checkpoint_every',
+                        default=100,
+                        help="Number of written users between two fsync'd checkpoints")
+    parser.add_argument("--stream",
+                        dest='stream',
+                        action='store_true',
+                        help="Stream the users from the interaction file in chunks instead of loading every "
+                             "interaction first, the first requests go out within seconds and the memory stays bounded")
+    parser.add_argument("--presorted",
+                        dest='presorted',
+                        action='store_true',
+                        help="The amazon interaction file is grouped by user, --stream reads it without sorting it "
+                             "into an on-disk spill first")
+    parser.add_argument("--incremental",
+                        dest='incremental',
+                        action='store_true',
+                        help="Encode only new users and users whose prompt or models changed since the previous "
+                             "results, carrying the previous records of all other users forward")
+    parser.add_argument("--metrics-interval",
+                        type=float,
+                        dest='metrics_interval',
+                        default=30,
+                        help="Seconds between two snapshots of the run metrics written to {name}_metrics.json and "
+                             "{name}_metrics.prom in the result folder")
+    parser.add_argument("--prometheus-textfile",
+                        dest='prometheus_textfile',
+                        default=None,
+                        help="Path of the Prometheus textfile of the run metrics, e.g. in the directory of the node "
+                             "exporter textfile collector. Defaults to {name}_metrics.prom in the result folder")
+    parser.add_argument("--prompt-budget",
+                        type=int,
+                        dest='prompt_budget',
+                        default=None,
+                        help="Maximum number of tokens of a user prompt, heavier users keep only part of their ratings")
+    parser.add_argument("--prompt-strategy",
+                        dest='prompt_strategy',
+                        default="recent",
+                        choices=STRATEGIES,
+                        help="Ratings kept when a prompt exceeds the budget: the latest ones, the ones farthest from "
+                             "the user's mean rating or a sample stratified by rating")
+    parser.add_argument("--map-reduce-threshold",
+                        type=int,
+                        dest='map_reduce_threshold',
+                        default=0,
+                        help="Number of rated items above which a user is described by summarizing chronological "
+                             "chunks of the history concurrently and merging the partial profiles, 0 (default) "
+                             "disables it")
+    parser.add_argument("--map-reduce-chunk-size",
+                        type=int,
+                        dest='map_reduce_chunk_size',
+                        default=250,
+                        help="Maximum number of rated items summarized by one map request")
+    parser.add_argument("--map-reduce-concurrency",
+                        type=int,
+                        dest='map_reduce_concurrency',
+                        default=8,
+                        help="Maximum number of map requests of one user in flight at the same time")
+    parser.add_argument("--token-counter",
+                        dest='token_counter',
+                        default="approx",
+                        choices=["approx", "tiktoken"],
+                        help="Offline token counter for the prompt budget, tiktoken requires the tiktoken package")
+    parser.add_argument("--rpm",
+                        type=float,
+                        dest='requests_per_minute',
+                        default=None,
+                        help="Requests per minute allowed by the API key, shared by chat and embedding requests")
+    parser.add_argument("--tpm",
+                        type=float,
+                        dest='tokens_per_minute',
+                        default=None,
+                        help="Tokens per minute allowed by the API key, shared by chat and embedding requests")
+    parser.add_argument("--shard",
+                        type=Shard.parse,
+                        dest='shard',
+                        default=None,
+                        help="Encode only the slice i/N (0 <= i < N) of a stable hash partition of the user ids, "
+                             "writing outputs prefixed with {dataset}_shard-i-of-N")
+    parser.add_argument("--batch-results",
+                        dest='batch_results',
+                        nargs='+',
+                        default=[],
+                        help="Batch API output and error files read by ingest-batch")
+    parser.add_argument("--embedding-backend",
+                        dest='embedding_backend',
+                        default="openai",
+                        choices=["openai", "tfidf", "onnx"],
+                        help="Backend embedding the descriptions: the OpenAI API, a local hashed TF-IDF in NumPy or a "
+                             "local ONNX sentence encoder, which requires onnxruntime and tokenizers")
+    parser.add_argument("--embedding-model-path",
+                        dest='embedding_model_path',
+                        default=None,
+                        help="Folder with the model.onnx and tokenizer.json of the onnx backend")
+    parser.add_argument("--embedding-dimensions",
+                        type=int,
+                        dest='embedding_dimensions',
+                        default=None,
+                        help="Embedding dimension: the dimensions parameter of the OpenAI embeddings API, the number "
+                             "of buckets of tfidf (1024 by default) or a truncation of the onnx embeddings. Defaults "
+                             "to the full dimension of the model")
+    parser.add_argument("--embedding-dtype",
+                        dest='embedding_dtype',
+                        default="float32",
+                        choices=STORAGE_DTYPES,
+                        help="Storage of the embedding matrix: float32, float16, int8 codes with a scale per user or "
+                             "binary sign codes, 2, 4 and 32 times smaller than float32")
+    parser.add_argument("--report-dimensions",
+                        type=int,
+                        dest='report_dimensions',
+                        nargs='+',
+                        default=None,
+                        help="Reduced dimensions compared by compression-report. Defaults to the full dimension and "
+                             "its halvings down to 256")
+    parser.add_argument("--embeddings",
+                        dest='embeddings',
+                        nargs='+',
+                        default=None,
+                        help="Embedding stores compared by evaluate, e.g. ml-1m ml-1m_tfidf. Defaults to the dataset")
+    parser.add_argument("--k",
+                        type=int,
+                        dest='ks',
+                        nargs='+',
+                        default=[10, 20],
+                        help="Cutoffs of recall@k, NDCG@k and hit rate@k")
+    parser.add_argument("--scorer",
+                        dest='scorer',
+                        default="knn",
+                        choices=SCORERS,
+                        help="Item scores of evaluate: the items of the most similar users, the similarity to the mean "
+                             "embedding of the item's users or the embedding-free popularity baseline")
+    parser.add_argument("--neighbours",
+                        type=int,
+                        dest='neighbours',
+                        default=50,
+                        help="Number of similar users of the knn scorer")
+    parser.add_argument("--holdout",
+                        type=float,
+                        dest='holdout',
+                        default=0.2,
+                        help="Fraction of the latest interactions held out by evaluate")
+    parser.add_argument("--split",
+                        dest='split',
+                        default="user",
+                        choices=SPLITS,
+                        help="Hold out the latest interactions of every user or every interaction after a global "
+                             "time cutoff")
+    parser.add_argument("--min-rating",
+                        type=float,
+                        dest='min_rating',
+                        default=None,
+                        help="Lowest rating of a relevant held-out item, by default every held-out item is relevant")
     return parser.parse_args()
 
 
+def build_dataset(mode: str, folder: str, prompt_budget: PromptBudget | None = None, streaming: bool = False,
+                  presorted: bool = False):
+    """
+    Builds the dataset of the given mode.
+
+    Args:
+        mode (str): The dataset mode, either ml-1m or amazon.
+        folder (str): The folder containing the dataset.
+        prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+        streaming (bool, optional): Whether iterating the dataset streams the interaction file. Defaults to False.
+        presorted (bool, optional): Whether the amazon interaction file is grouped by user, the MovieLens ratings
+            always are. Defaults to False.
+
+    Returns:
+        MovieDataset | MusicDataset: The dataset.
+    """
+    match mode:
+        case "ml-1m":
+            return MovieDataset(folder=folder, prompt_budget=prompt_budget, streaming=streaming)
+        case "amazon":
+            return MusicDataset(folder=folder, prompt_budget=prompt_budget, streaming=streaming, presorted=presorted)
+    raise ValueError(f"Unknown dataset {mode}")
+
+
+def build_agent(mode: str, agent: str, cache: LLMCache | None = None,
+                rate_limiter: RateLimiter | None = None, encoding: str = "user", **options) -> EmbedAgent:
+    """
+    Builds the embedding agent of the given mode.
+
+    Args:
+        mode (str): The dataset mode, either ml-1m or amazon.
+        agent (str): The agent for the LLM model.
+        cache (LLMCache, optional): The persistent cache of descriptions and embeddings. Defaults to None.
+        rate_limiter (RateLimiter, optional): The limiter of the API requests. Defaults to None.
+        encoding (str, optional): "user" for the agent describing users, "item" for the one describing catalog items.
+            Defaults to "user".
+        **options: Further EmbedAgent arguments, e.g. token and base_url.
+
+    Returns:
+        EmbedAgent: The agent.
+    """
+    match mode, encoding:
+        case "ml-1m", "user":
+            return EmbedAgentMovie(agent=agent, cache=cache, rate_limiter=rate_limiter, **options)
+        case "amazon", "user":
+            return EmbedAgentMusic(agent=agent, cache=cache, rate_limiter=rate_limiter, **options)
+        case "ml-1m", "item":
+            return ItemAgentMovie(agent=agent, cache=cache, rate_limiter=rate_limiter, **options)
+        case "amazon", "item":
+            return ItemAgentMusic(agent=agent, cache=cache, rate_limiter=rate_limiter, **options)
+    raise ValueError(f"Unknown dataset {mode} or encoding {encoding}")
+
+
+def build_embedding_backend(kind: str,
+                            result_folder: str,
+                            name: str,
+                            model_path: str | None = None,
+                            dimensions: int | None = None,
+                            batch_size: int = 64) -> EmbeddingBackend | None:
+    """
+    Builds a local embedding backend, the TF-IDF one loads the weights fitted by a previous reembed if any.
+
+    Args:
+        kind (str): "openai", "tfidf" or "onnx".
+        result_folder (str): The folder with the fitted TF-IDF weights.
+        name (str): The file name prefix of the fitted TF-IDF weights.
+        model_path (str, optional): The model folder of the onnx backend. Defaults to None.
+        dimensions (int, optional): The dimension of the tfidf embeddings, 1024 if None, or the truncated dimension
+            of the onnx embeddings. Defaults to None.
+        batch_size (int, optional): The inference batch size of the onnx backend. Defaults to 64.
+
+    Returns:
+        EmbeddingBackend | None: The backend, None for the OpenAI backend built by the agent.
+    """
+    if kind == "openai":
+        return None
+    return build_backend(kind, model_path=model_path, dimensions=dimensions, batch_size=batch_size,
+                         idf_path=tfidf_idf_path(result_folder, name))
+
+
+def tfidf_idf_path(result_folder: str, name: str) -> str:
+    """
+    Returns the file of the TF-IDF weights fitted on the descriptions of a dataset.
+
+    Args:
+        result_folder (str): The folder for the results.
+        name (str): The dataset mode.
+
+    Returns:
+        str: The path of the .npy weights.
+    """
+    return os.path.join(result_folder, f"{name}_tfidf_idf.npy")
+
+
+def select_user_ids(dataset, shard: Shard | None = None) -> list:
+    """
+    Returns the ids of the users of the dataset that belong to the shard.
+
+    Args:
+        dataset (MovieDataset | MusicDataset): The dataset.
+        shard (Shard, optional): The slice of the users, None selects every user. Defaults to None.
+
+    Returns:
+        list: The user ids in dataset order.
+    """
+    return [user_id for user_id in dataset.user_ids() if shard is None or shard.contains(user_id)]
+
+
 def evaluate_embeddings(mode: str,
                         folder: str,
                         agent: str,
                         test: bool,
-                        result_folder: str):
+                        result_folder: str,
+                        concurrency: int = 1,
+                        embedding_batch_size: int = 64,
+                        cache_path: str | None = None,
+                        resume: bool = False,
+                        checkpoint_every: int = 100,
+                        prompt_budget: PromptBudget | None = None,
+                        shard: Shard | None = None,
+                        rate_limiter: RateLimiter | None = None,
+                        embedding_backend: EmbeddingBackend | None = None,
+                        incremental: bool = False,
+                        embedding_dimensions: int | None = None,
+                        embedding_dtype: str = "float32",
+                        stream: bool = False,
+                        presorted: bool = False,
+                        encoding: str = "user",
+                        rating_center: float | None = None,
+                        half_life_days: float | None = None,
+                        metrics_interval: float = 30.0,
+                        prometheus_path: str | None = None,
+                        map_reduce_threshold: int | None = None,
+                        map_reduce_chunk_size: int = 250,
+                        map_reduce_concurrency: int = 8):
     """
     Evaluates embeddings for users in the dataset.
 
+    The item encoding describes and embeds every rated item once into {mode}_items instead and then pools the item
+    embeddings of every user into {mode}_pooled, so the number of LLM requests scales with the catalog and not with
+    the users.
+
     Args:
         folder (str): The folder containing the dataset.
         agent (str): The agent for the LLM model.
         test (bool): Whether to run in test mode.
         result_folder (str): The folder for the results.
+        concurrency (int, optional): The number of users processed concurrently. Defaults to 1.
+        embedding_batch_size (int, optional): The maximum number of descriptions per embedding request. Defaults to 64.
+        cache_path (str, optional): The SQLite file caching LLM responses, None disables caching. Defaults to None.
+        resume (bool, optional): Whether to skip users finished by a previous run. Defaults to False.
+        checkpoint_every (int, optional): The number of written users between two checkpoints. Defaults to 100.
+        prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+        shard (Shard, optional): The slice of the users to encode, None encodes every user. Defaults to None.
+        rate_limiter (RateLimiter, optional): The limiter of the API requests. Defaults to an adaptive limiter
+            without per-minute budgets and at most concurrency requests in flight.
+        embedding_backend (EmbeddingBackend, optional): The backend embedding the descriptions. Defaults to the OpenAI
+            embeddings.
+        incremental (bool, optional): Whether to encode only the users whose fingerprint differs from the previous
+            results and carry the previous records of the other users forward. Defaults to False.
+        embedding_dimensions (int, optional): The reduced dimension requested from the OpenAI embeddings. Defaults to
+            None.
+        embedding_dtype (str, optional): The storage dtype of the embeddings. Defaults to "float32".
+        stream (bool, optional): Whether to stream the users from the interaction file in chunks instead of loading
+            every interaction first. Defaults to False.
+        presorted (bool, optional): Whether the amazon interaction file is grouped by user. Defaults to False.
+        encoding (str, optional): "user" or "item". Defaults to "user".
+        rating_center (float, optional): The neutral rating of the item encoding. Defaults to the middle of the rating
+            range.
+        half_life_days (float, optional): The half-life of the recency weight of the item encoding. Defaults to None.
+        metrics_interval (float, optional): The seconds between two snapshots of the run metrics. Defaults to 30.
+        prometheus_path (str, optional): The Prometheus textfile of the run metrics. Defaults to
+            {name}_metrics.prom in the result folder.
+        map_reduce_threshold (int, optional): The number of rated items above which a user is described by
+            map-reduce. Defaults to None, i.e. a single request per user.
+        map_reduce_chunk_size (int, optional): The maximum number of rated items per map request. Defaults to 250.
+        map_reduce_concurrency (int, optional): The maximum number of map requests of one user in flight. Defaults
+            to 8.
     """
-    match mode:
-        case "ml-1m":
-            dataset = MovieDataset(folder=folder)
-            llm_agent = EmbedAgentMovie(agent=agent)
-        case "amazon":
-            dataset = MusicDataset(folder=folder)
-            llm_agent = EmbedAgentMusic(agent=agent)
+    if encoding == "item":
+        if shard is not None:
+            raise ValueError("The item encoding pools every item of a user, it cannot be sharded")
+        if stream:
+            logging.warning("The item encoding pools from the whole interaction matrix, --stream is ignored")
+            stream = False
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(max_concurrency=max(concurrency, map_reduce_concurrency)
+                                   if map_reduce_threshold else concurrency)
+    cache = LLMCache(cache_path) if cache_path else None
+    metrics = RunMetrics()
+    dataset = build_dataset(mode, folder, prompt_budget=prompt_budget, streaming=stream, presorted=presorted)
+    llm_agent = build_agent(mode, agent, cache=cache, rate_limiter=rate_limiter, encoding=encoding,
+                            embedding_backend=embedding_backend, embedding_dimensions=embedding_dimensions,
+                            metrics=metrics, map_reduce_threshold=map_reduce_threshold,
+                            map_reduce_chunk_size=map_reduce_chunk_size,
+                            map_reduce_concurrency=map_reduce_concurrency)
 
-    description_list = []
+    name = mode if shard is None else shard.name(mode)
+    if encoding == "item":
+        name = f"{mode}_items"
+    previous = PreviousResults(result_folder, name) if incremental else None
+    writer = ResultWriter(result_folder=result_folder, mode=name, resume=resume, checkpoint_every=checkpoint_every,
+                          embedding_dtype=embedding_dtype, metrics=metrics)
+    metrics.gauge("requests_in_flight", lambda: rate_limiter.in_flight)
+    metrics.gauge("rate_limiter_wait_seconds", lambda: round(rate_limiter.waited, 3))
+    if rate_limiter.max_concurrency:
+        metrics.gauge("concurrency_limit", lambda: rate_limiter.limit)
+    exporter = MetricsExporter(metrics, json_path=os.path.join(result_folder, f"{name}_metrics.json"),
+                               prometheus_path=prometheus_path or os.path.join(result_folder, f"{name}_metrics.prom"),
+                               interval=metrics_interval).start()
+    if stream:
+        # the users are read lazily, so their number is unknown until the end of the file and loading them is timed
+        # user by user
+        users = (user for user in dataset if (shard is None or shard.contains(user.id)) and not writer.is_done(user.id))
+        users = metrics.timed("load_dataset", users)
+        total = None
+    elif encoding == "item":
+        with metrics.timer("load_dataset"):
+            items = [item for item in dataset.catalog_items() if not writer.is_done(item.id)]
+        logging.info(f"Item encoding: {len(items) + len(writer.done)} rated items for {len(dataset)} users")
+        users = iter(items)
+        total = len(items)
+    else:
+        with metrics.timer("load_dataset"):
+            # the ratings are loaded here instead of within the first user
+            dataset.interactions  # noqa: B018
+            pending = [user_id for user_id in select_user_ids(dataset, shard) if not writer.is_done(user_id)]
+        if shard is not None:
+            logging.info(f"Shard {shard.index}/{shard.count}: {len(pending) + len(writer.done)} users")
+        users = (dataset.get_user(user_id) for user_id in pending)
+        total = len(pending)
+    metrics.progress(total=total)
+    # the total counts the carried users as well, so the progress bar wraps the users before they are filtered
+    users = tqdm(users, total=total)
+    if previous is not None:
+        users = carry_forward(previous, writer, users, llm_agent.fingerprint, test=test, metrics=metrics)
     error_list = {}
-    for user in tqdm(dataset):
-        try:
-            user.description = llm_agent.get_user_description(user=user, test=test)
-            if not test:
-                user.embedding = llm_agent.encode_description(user.description)
-            description_list.append(user.dict())
-        except Exception as e:
-            error_list[user.id] = str(e)
-            logging.error(f"Error processing user {user.id}:\n{e}")
-
-        break
-
-    result_path = os.path.join(result_folder, f"{mode}_description.json")
-    with open(result_path, 'w') as f:
-        json.dump(description_list, f, indent=2)
-        logging.info(f"Descriptions saved to {result_folder}/description.json")
-
-    error_path = os.path.join(result_folder, f"{mode}_errors.json")
+    prompt_tokens, truncated = [], 0
+
+    def collect(user, record: dict | None, error: Exception | None):
+        nonlocal truncated
+        if error is None:
+            record["fingerprint"] = llm_agent.fingerprint(user)
+            if "prompt_tokens" in record:
+                prompt_tokens.append(record["prompt_tokens"])
+                truncated += record["prompt_items"] < record["total_items"]
+            writer.write(record, embedding=user.embedding)
+            metrics.progress(done=1)
+        else:
+            error_list[user.id] = str(error)
+            metrics.progress(failed=1)
+            logging.error(f"Error processing user {user.id}:\n{error}")
+
+    if concurrency > 1:
+        encoder = AsyncUserEncoder(llm_agent=llm_agent, test=test, concurrency=concurrency,
+                                   embedding_batch_size=embedding_batch_size)
+        asyncio.run(encoder.run(users, collect))
+    else:
+        for user in users:
+            try:
+                with metrics.timer("user"):
+                    user.description = llm_agent.get_user_description(user=user, test=test)
+                    if not test:
+                        user.embedding = llm_agent.encode_description(user.description)
+                collect(user, user.dict(), None)
+            except Exception as e:
+                collect(user, None, e)
+
+    if not test:
+        logging.info(f"Rate limiter: {rate_limiter.rate_limited} rate limited requests, "
+                     f"{rate_limiter.waited:.1f}s waited, final concurrency limit {rate_limiter.limit:.0f}")
+        usage = usage_summary(metrics)
+        if usage["requests"]:
+            latencies = ", ".join(f"{label} {usage[key]:.2f}s" for label, key in (("hits", "hit_latency"),
+                                                                                   ("misses", "miss_latency"))
+                                  if usage[key] is not None)
+            logging.info(f"Chat usage: {usage['requests']} requests, {usage['prompt_tokens']} prompt tokens of which "
+                         f"{usage['cached_tokens']} ({usage['cached_share']:.0%}) were prefix-cached, "
+                         f"{usage['completion_tokens']} completion tokens, mean latency of prefix cache {latencies}")
+        saved = llm_agent.single_flight.saved
+        if saved:
+            logging.info(f"Coalesced requests: {saved.get('chat', 0)} chat and {saved.get('embedding', 0)} embedding "
+                         f"requests shared an identical request in flight")
+
+    if cache is not None:
+        logging.info(f"Cache hits: {cache.hits}, misses: {cache.misses}")
+        cache.close()
+
+    if prompt_tokens:
+        logging.info(f"Prompt budget: {truncated} of {len(prompt_tokens)} users truncated, "
+                     f"{sum(prompt_tokens) / len(prompt_tokens):.0f} tokens per prompt on average, "
+                     f"{max(prompt_tokens)} at most")
+
+    writer.close()
+    if previous is not None:
+        previous.discard()
+    logging.info(f"Descriptions of {len(writer.done)} users saved to {writer.result_path}")
+
+    error_path = os.path.join(result_folder, f"{name}_errors.json")
     if error_list:
         with open(error_path, 'w') as f:
             json.dump(error_list, f, indent=2)
-            logging.warning(f"Number of Errors occurred is {len(error_list)}, please, see {result_folder}/errors.json")
+            logging.warning(f"Number of Errors occurred is {len(error_list)}, please, see {error_path}")
+    elif os.path.exists(error_path):
+        os.remove(error_path)
+
+    if encoding == "item" and not test:
+        with metrics.timer("pool"):
+            pool_users(dataset, result_folder, mode, rating_center=rating_center, half_life_days=half_life_days,
+                       dtype=embedding_dtype)
+
+    exporter.close()
+    summary = metrics.summary()
+    logging.info(f"Encoded {summary['users_done']} users at {summary['users_per_second']} users/s, "
+                 f"run metrics saved to {exporter.json_path} and {exporter.prometheus_path}")
+    for stage, timing in summary["stages"].items():
+        logging.info(f"Stage {stage}: {timing['count']} calls, {timing['seconds']:.1f}s, mean {timing['mean']}s, "
+                     f"p95 {timing['p95']}s")
+
 
+def pool_users(dataset,
+               result_folder: str,
+               mode: str,
+               rating_center: float | None = None,
+               half_life_days: float | None = None,
+               dtype: str = "float32") -> int:
+    """
+    Pools the item embeddings of {mode}_items into the user embeddings {mode}_pooled, every user vector is the
+    normalized sum of the embeddings of the rated items weighted by rating and recency.
+
+    Args:
+        dataset (MovieDataset | MusicDataset): The dataset.
+        result_folder (str): The folder with the item embeddings.
+        mode (str): The dataset mode.
+        rating_center (float, optional): The neutral rating. Defaults to the middle of the rating range.
+        half_life_days (float, optional): The half-life of the recency weight. Defaults to None.
+        dtype (str, optional): The storage dtype of the user embeddings. Defaults to "float32".
+
+    Returns:
+        int: The number of users with at least one embedded item, the only ones stored.
+    """
+    store = EmbeddingStore(result_folder, f"{mode}_items")
+    matrix = dataset.interactions
+    start = time.perf_counter()
+    item_rows = np.array([store.index.get(item_id, -1) for item_id in dataset.item_ids().tolist()], dtype=np.int64)
+    weights = pooling_weights(matrix, rating_center=rating_center, half_life_days=half_life_days,
+                              mask=item_rows[matrix.item_idx] >= 0)
+    name = f"{mode}_pooled"
+    writer = EmbeddingStoreWriter(result_folder, name, dtype=dtype)
+    for first, vectors in pool_embeddings(matrix, store.vectors, item_rows, weights):
+        pooled = np.flatnonzero(vectors.any(axis=1))
+        writer.extend(matrix.user_ids[first + pooled].tolist(), vectors[pooled])
+    writer.close()
+    logging.info(f"Pooled {len(store)} item embeddings into {writer.rows} of {len(matrix)} users in "
+                 f"{time.perf_counter() - start:.1f}s, saved to {writer.matrix_path}")
+    return writer.rows
+
+
+def export_batch_requests(mode: str,
+                          folder: str,
+                          agent: str,
+                          result_folder: str,
+                          cache_path: str | None,
+                          prompt_budget: PromptBudget | None = None,
+                          shard: Shard | None = None,
+                          embedding_dimensions: int | None = None) -> dict[str, list[str]]:
+    """
+    Writes the next missing request of every user as Batch API input files.
+
+    Users without a cached description get a chat request, users whose description is cached but not its embedding
+    get an embedding request. After ingest-batch, run export-batch again to create the embedding requests.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset.
+        agent (str): The agent for the LLM model.
+        result_folder (str): The folder for the request files.
+        cache_path (str | None): The SQLite file caching LLM responses, required by the Batch API mode.
+        prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+        shard (Shard, optional): The slice of the users to export. Defaults to None.
+        embedding_dimensions (int, optional): The reduced dimension of the embedding requests. Defaults to None.
+
+    Returns:
+        dict[str, list[str]]: The written files by endpoint.
+    """
+    if not cache_path:
+        raise ValueError("The Batch API mode keeps descriptions and embeddings in the cache, do not use --no-cache")
+    cache = LLMCache(cache_path)
+    dataset = build_dataset(mode, folder, prompt_budget=prompt_budget)
+    llm_agent = build_agent(mode, agent, cache=cache, embedding_dimensions=embedding_dimensions)
+    name = mode if shard is None else shard.name(mode)
+    users = (dataset.get_user(user_id) for user_id in select_user_ids(dataset, shard))
+    paths = export_batch(llm_agent, tqdm(users), result_folder, name)
+    cache.close()
+    if not any(paths.values()):
+        logging.info("Every user is cached, run ingest-batch to write the results")
+    return paths
+
+
+def ingest_batch_results(mode: str,
+                         folder: str,
+                         agent: str,
+                         result_folder: str,
+                         cache_path: str | None,
+                         result_paths: list[str],
+                         prompt_budget: PromptBudget | None = None,
+                         shard: Shard | None = None,
+                         checkpoint_every: int = 100,
+                         embedding_dimensions: int | None = None,
+                         embedding_dtype: str = "float32"):
+    """
+    Caches Batch API responses and writes every user whose description and embedding are cached.
+
+    The results are appended to the output of previous runs, so the chat and the embedding batches can be ingested one
+    after the other. The prompt budget must match the one used by export-batch.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset.
+        agent (str): The agent for the LLM model.
+        result_folder (str): The folder for the results.
+        cache_path (str | None): The SQLite file caching LLM responses, required by the Batch API mode.
+        result_paths (list[str]): The Batch API output and error files.
+        prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+        shard (Shard, optional): The slice of the users to ingest. Defaults to None.
+        checkpoint_every (int, optional): The number of written users between two checkpoints. Defaults to 100.
+        embedding_dimensions (int, optional): The reduced dimension of the embedding requests. Defaults to None.
+        embedding_dtype (str, optional): The storage dtype of the embeddings. Defaults to "float32".
+    """
+    if not cache_path:
+        raise ValueError("The Batch API mode keeps descriptions and embeddings in the cache, do not use --no-cache")
+    cache = LLMCache(cache_path)
+    dataset = build_dataset(mode, folder, prompt_budget=prompt_budget)
+    llm_agent = build_agent(mode, agent, cache=cache, embedding_dimensions=embedding_dimensions)
+    name = mode if shard is None else shard.name(mode)
+    user_ids = {custom_id(user_id): user_id for user_id in select_user_ids(dataset, shard)}
+    errors = ingest_batch(llm_agent,
+                          lambda request_id: dataset.get_user(user_ids[request_id]) if request_id in user_ids else None,
+                          result_paths)
+
+    error_path = os.path.join(result_folder, f"{name}_errors.json")
+    if os.path.exists(error_path):
+        with open(error_path, 'r') as f:
+            errors = {**json.load(f), **errors}
+    written, no_embedding, no_description = 0, 0, 0
+    with ResultWriter(result_folder=result_folder, mode=name, resume=True, checkpoint_every=checkpoint_every,
+                      embedding_dtype=embedding_dtype) as writer:
+        for request_id, user_id in tqdm(user_ids.items()):
+            if writer.is_done(user_id):
+                errors.pop(request_id, None)
+                continue
+            user = dataset.get_user(user_id)
+            user.description, user.embedding = llm_agent.cached_encoding(user)
+            if user.embedding is None:
+                no_embedding += user.description is not None
+                no_description += user.description is None
+                continue
+            writer.write({**user.dict(), "fingerprint": llm_agent.fingerprint(user)}, embedding=user.embedding)
+            errors.pop(request_id, None)
+            written += 1
+    cache.close()
+
+    logging.info(f"Wrote {written} users, {len(writer.done)} of {len(user_ids)} are done, "
+                 f"saved to {writer.result_path}")
+    if no_embedding:
+        logging.info(f"{no_embedding} users wait for their embedding, run export-batch again for the embedding batch")
+    if no_description:
+        logging.info(f"{no_description} users have no description yet")
+    if errors:
+        with open(error_path, 'w') as f:
+            json.dump(errors, f, indent=2)
+        logging.warning(f"Number of Errors occurred is {len(errors)}, please, see {error_path}")
+    elif os.path.exists(error_path):
+        os.remove(error_path)
+
+
+def reembed_results(mode: str, result_folder: str, backend: EmbeddingBackend, label: str,
+                    batch_size: int = 1024, dtype: str = "float32") -> int:
+    """
+    Embeds the descriptions of a previous run with a local backend into {mode}_{label}_embeddings.npy.
+
+    Args:
+        mode (str): The dataset mode.
+        result_folder (str): The folder with the {mode}_description.jsonl of the previous run.
+        backend (EmbeddingBackend): The backend embedding the descriptions.
+        label (str): The name of the backend in the store file name.
+        batch_size (int, optional): The number of descriptions per backend call. Defaults to 1024.
+        dtype (str, optional): The storage dtype of the new store. Defaults to "float32".
+
+    Returns:
+        int: The number of embedded users.
+    """
+    result_path = os.path.join(result_folder, f"{mode}_description.jsonl")
+    name = f"{mode}_{label}"
+    return reembed(backend, result_path, result_folder, name, batch_size=batch_size,
+                   idf_path=tfidf_idf_path(result_folder, mode), dtype=dtype)
+
+
+def evaluate_recommendations(mode: str,
+                             folder: str,
+                             result_folder: str,
+                             names: list[str] | None = None,
+                             ks: list[int] = (10, 20),
+                             scorer: str = "knn",
+                             neighbours: int = 50,
+                             holdout: float = 0.2,
+                             split: str = "user",
+                             min_rating: float | None = None) -> list[dict]:
+    """
+    Measures how well the embedding stores recommend the held-out interactions of a temporal split and saves the
+    report to {mode}_evaluation.json.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset.
+        result_folder (str): The folder with the embedding stores.
+        names (list[str], optional): The names of the compared stores. Defaults to the mode.
+        ks (list[int], optional): The cutoffs. Defaults to (10, 20).
+        scorer (str, optional): "knn", "projection" or "popularity". Defaults to "knn".
+        neighbours (int, optional): The number of similar users of the knn scorer. Defaults to 50.
+        holdout (float, optional): The fraction of held-out interactions. Defaults to 0.2.
+        split (str, optional): "user" or "global". Defaults to "user".
+        min_rating (float, optional): The lowest rating of a relevant held-out item. Defaults to None.
+
+    Returns:
+        list[dict]: The metrics of every store.
+    """
+    evaluator = RecommendationEvaluator(build_dataset(mode, folder).interactions, test_fraction=holdout, split=split,
+                                        min_rating=min_rating)
+    report = []
+    for name in names or [mode]:
+        store = EmbeddingStore(result_folder, name)
+        result = {"embeddings": name, **evaluator.evaluate(store.ids, store.vectors, ks=ks, scorer=scorer,
+                                                              neighbours=neighbours)}
+        logging.info(f"{name}: " + ", ".join(f"{key} {value}" for key, value in result.items()
+                                             if key not in ("embeddings", "scorer")))
+        report.append(result)
+    report_path = os.path.join(result_folder, f"{mode}_evaluation.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Evaluation report saved to {report_path}")
+    return report
+
+
+def report_compression(mode: str,
+                       result_folder: str,
+                       names: list[str] | None = None,
+                       dimensions: list[int] | None = None,
+                       k: int = 10) -> list[dict]:
+    """
+    Reports the memory saved and the similar-user recall lost by reduced dimensions and storage dtypes against the
+    full float32 embeddings of the stores and saves the report to {mode}_compression.json.
+
+    Args:
+        mode (str): The dataset mode.
+        result_folder (str): The folder with the embedding stores.
+        names (list[str], optional): The names of the stores, ideally float32 ones. Defaults to the mode.
+        dimensions (list[int], optional): The reduced dimensions. Defaults to the full dimension and its halvings
+            down to 256.
+        k (int, optional): The number of similar users per query. Defaults to 10.
+
+    Returns:
+        list[dict]: One entry per store, dimension and dtype.
+    """
+    report = []
+    for name in names or [mode]:
+        store = EmbeddingStore(result_folder, name)
+        if store.dtype != "float32":
+            logging.warning(f"{name} is stored as {store.dtype}, the baseline is its decoded embeddings")
+        sizes = dimensions or [None] + [dim for dim in (1024, 512, 256) if dim < store.dim]
+        for result in compression_report(store.vectors, dimensions=sizes, k=k):
+            logging.info(f"{name} {result['dimensions']}d {result['dtype']}: {result['megabytes']} MB, "
+                         f"{result['memory_saved']:.1%} saved, recall@{k} {result[f'recall@{k}']}")
+            report.append({"embeddings": name, **result})
+    report_path = os.path.join(result_folder, f"{mode}_compression.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Compression report saved to {report_path}")
+    return report
+
+
+def merge_results(mode: str, folder: str, result_folder: str) -> dict:
+    """
+    Merges the outputs of the shards of a dataset into one result set and one error report.
+
+    Args:
+        mode (str): The dataset mode.
+        folder (str): The folder containing the dataset, used to check for missing users.
+        result_folder (str): The folder with the shard outputs.
+
+    Returns:
+        dict: The merge report with the missing and duplicate users.
+    """
+    return merge_shards(result_folder, mode, build_dataset(mode, folder).user_ids())
 
 
 if __name__ == '__main__':
@@ -96,9 +867,79 @@ if __name__ == '__main__':
     """
     args = parse_args()
 
+    budget = None
+    if args.prompt_budget is not None:
+        counter = tiktoken_counter() if args.token_counter == "tiktoken" else approximate_token_count  # noqa: S105
+        budget = PromptBudget(max_tokens=args.prompt_budget, strategy=args.prompt_strategy, token_counter=counter)
+
     folder = os.path.join("data","ml-1m") if args.dataset == "ml-1m" else os.path.join("data/Amazon_CDs_and_Vinyl")
+    cache_path = None if args.no_cache else args.cache_path
+    if args.command == "merge":
+        report = merge_results(mode=args.dataset, folder=folder, result_folder=args.result_folder)
+        raise SystemExit(1 if report["missing"] or report["duplicates"] else 0)
+    if args.command == "evaluate":
+        evaluate_recommendations(mode=args.dataset, folder=folder, result_folder=args.result_folder,
+                                 names=args.embeddings, ks=args.ks, scorer=args.scorer, neighbours=args.neighbours,
+                                 holdout=args.holdout, split=args.split, min_rating=args.min_rating)
+        raise SystemExit(0)
+    if args.command == "compression-report":
+        report_compression(mode=args.dataset, result_folder=args.result_folder, names=args.embeddings,
+                           dimensions=args.report_dimensions, k=args.ks[0])
+        raise SystemExit(0)
+    if args.command == "pool":
+        pool_users(build_dataset(args.dataset, folder), result_folder=args.result_folder, mode=args.dataset,
+                   rating_center=args.rating_center, half_life_days=args.half_life_days, dtype=args.embedding_dtype)
+        raise SystemExit(0)
+    if args.command == "export-batch":
+        export_batch_requests(mode=args.dataset, folder=folder, agent=args.agent, result_folder=args.result_folder,
+                              cache_path=cache_path, prompt_budget=budget, shard=args.shard,
+                              embedding_dimensions=args.embedding_dimensions)
+        raise SystemExit(0)
+    if args.command == "ingest-batch":
+        ingest_batch_results(mode=args.dataset, folder=folder, agent=args.agent, result_folder=args.result_folder,
+                             cache_path=cache_path, result_paths=args.batch_results, prompt_budget=budget,
+                             shard=args.shard, checkpoint_every=args.checkpoint_every,
+                             embedding_dimensions=args.embedding_dimensions, embedding_dtype=args.embedding_dtype)
+        raise SystemExit(0)
+
+    embedding_backend = build_embedding_backend(args.embedding_backend, args.result_folder, args.dataset,
+                                                model_path=args.embedding_model_path,
+                                                dimensions=args.embedding_dimensions,
+                                                batch_size=args.embedding_batch_size)
+    if args.command == "reembed":
+        if embedding_backend is None:
+            raise SystemExit("reembed runs a local --embedding-backend, either tfidf or onnx")
+        reembed_results(mode=args.dataset, result_folder=args.result_folder, backend=embedding_backend,
+                        label=args.embedding_backend, dtype=args.embedding_dtype)
+        raise SystemExit(0)
+
     evaluate_embeddings(mode=args.dataset,
                         folder=folder,
                         agent=args.agent,
                         test=args.test,
-                        result_folder=args.result_folder)
+                        result_folder=args.result_folder,
+                        concurrency=args.concurrency,
+                        embedding_batch_size=args.embedding_batch_size,
+                        cache_path=cache_path,
+                        resume=args.resume,
+                        checkpoint_every=args.checkpoint_every,
+                        prompt_budget=budget,
+                        shard=args.shard,
+                        rate_limiter=RateLimiter(requests_per_minute=args.requests_per_minute,
+                                                 tokens_per_minute=args.tokens_per_minute,
+                                                 max_concurrency=max(args.concurrency, args.map_reduce_concurrency)
+                                                 if args.map_reduce_threshold else args.concurrency),
+                        embedding_backend=embedding_backend,
+                        incremental=args.incremental,
+                        embedding_dimensions=args.embedding_dimensions,
+                        embedding_dtype=args.embedding_dtype,
+                        stream=args.stream,
+                        presorted=args.presorted,
+                        encoding=args.encoding,
+                        rating_center=args.rating_center,
+                        half_life_days=args.half_life_days,
+                        metrics_interval=args.metrics_interval,
+                        prometheus_path=args.prometheus_textfile,
+                        map_reduce_threshold=args.map_reduce_threshold or None,
+                        map_reduce_chunk_size=args.map_reduce_chunk_size,
+                        map_reduce_concurrency=args.map_reduce_concurrency)
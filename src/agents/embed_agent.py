@@ -1,11 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
-from functools import cache
 from textwrap import dedent
+import asyncio
 import yaml
 
 from src.movie.movie_user import MovieUser
 from src.music.music_user import MusicUser
-from src.agents.openai_adapter import OpenAIAdapter
+from src.agents.embedding_backends import EmbeddingBackend, OpenAIEmbeddingBackend
+from src.agents.llm_cache import LLMCache
+from src.agents.openai_adapter import AsyncOpenAIAdapter, OpenAIAdapter, embedding_options
+from src.agents.rate_limiter import RateLimiter
+from src.agents.single_flight import SingleFlight
+from src.data.catalog_item import CatalogItem
+from src.data.interaction_matrix import UserView
+from src.monitoring.run_metrics import RunMetrics
 
 class EmbedAgent:
     """
@@ -13,40 +21,145 @@ class EmbedAgent:
 
     Attributes:
         agent (OpenAIAdapter): The adapter for the OpenAI API.
+        async_agent (AsyncOpenAIAdapter): The asyncio adapter for the OpenAI API.
+        embedding_model (str): The OpenAI model used to embed descriptions.
+        embedding_dimensions (int | None): The reduced dimension requested from the OpenAI model, None for the full one.
+        embedding_backend (EmbeddingBackend): The backend embedding descriptions, its name keys the cached embeddings.
+        cache (LLMCache | None): The persistent cache of descriptions and embeddings.
+        rate_limiter (RateLimiter): The limiter shared by the chat and embedding requests of both adapters.
+        metrics (RunMetrics): The stage timings and counters of the run, shared with both adapters, including the token
+            usage and the prefix-cached prompt tokens of the chat requests, see usage_summary().
+        single_flight (SingleFlight): The coalescing of identical in-flight requests, shared with both adapters.
+        map_reduce_threshold (int | None): The number of rated items above which a user is described by map-reduce,
+            None describes every user with a single request.
+        map_reduce_chunk_size (int): The maximum number of rated items summarized by one map request.
+        map_reduce_concurrency (int): The maximum number of map requests of one user in flight at the same time.
+        MAP_PROMPT (str | None): The system message of the map requests, set by the subclasses.
+        REDUCE_PROMPT (str): The template of the user message of the reduce request.
 
     Methods:
+        build_prompt(user): Builds the chat messages for the user.
+        map_prompt(chunk: str): Builds the chat messages summarizing a chunk of the history of a user.
+        reduce_prompt(partials: list[str]): Builds the chat messages merging the partial profiles of a user.
+        map_reduce_chunks(user): Returns the chunk prompts of a user described by map-reduce.
         get_user_description(item, test: bool = False): Gets the user description.
         encode_description(description: str): Encodes the description into embeddings.
+        encode_descriptions(descriptions: list[str]): Encodes several descriptions in a single request.
         encode_user(user, test: bool = False): Encodes the user into embeddings.
+        aget_user_description(user, test: bool = False): Gets the user description asynchronously.
+        aencode_description(description: str): Encodes the description into embeddings asynchronously.
+        aencode_descriptions(descriptions: list[str]): Encodes several descriptions asynchronously.
+        aencode_user(user, test: bool = False): Encodes the user into embeddings asynchronously.
+        fingerprint(user): Returns the fingerprint of the prompt and the models encoding the user.
+        cached_encoding(user): Returns the cached description and embedding of the user.
+        batch_request(user, custom_id: str): Returns the Batch API request of the next missing step of the user.
+        ingest_batch_response(user, body: dict): Caches a Batch API response of the user.
     """
 
-    def __init__(self, agent: Literal["openai"], model: str | None = None) -> None:
+    MAP_PROMPT = None
+    REDUCE_PROMPT = ("The ratings of this user are too many for a single request, so they were split into {count} "
+                     "parts in chronological order and every part was summarized into a partial profile. Merge the "
+                     "partial profiles into one profile of the user.\n\n{parts}")
+
+    def __init__(self,
+                 agent: Literal["openai"],
+                 model: str | None = None,
+                 embedding_model: str = "text-embedding-3-small",
+                 cache: LLMCache | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 token: str | None = None,
+                 base_url: str | None = None,
+                 embedding_backend: EmbeddingBackend | None = None,
+                 embedding_dimensions: int | None = None,
+                 metrics: RunMetrics | None = None,
+                 map_reduce_threshold: int | None = None,
+                 map_reduce_chunk_size: int = 250,
+                 map_reduce_concurrency: int = 8) -> None:
         """
         Initializes the EmbedAgent with the provided agent and model.
 
         Args:
             agent (Literal["openai"]): The agent to use for embeddings.
             model (str, optional): The model to use for generating embeddings. Defaults to None.
+            embedding_model (str, optional): The model used to embed descriptions. Defaults to "text-embedding-3-small".
+            cache (LLMCache, optional): The persistent cache of descriptions and embeddings. Defaults to None.
+            rate_limiter (RateLimiter, optional): The limiter of the API requests. Defaults to an unlimited one.
+            token (str, optional): The API token. Defaults to None, i.e. the openai key of token.yaml.
+            base_url (str, optional): The URL of an OpenAI-compatible API, e.g. a local mock server. Defaults to None.
+            embedding_backend (EmbeddingBackend, optional): The backend embedding descriptions. Defaults to the
+                OpenAI embedding_model.
+            embedding_dimensions (int, optional): The reduced dimension requested from the OpenAI embedding_model.
+                Defaults to None, i.e. the full dimension of the model.
+            metrics (RunMetrics, optional): The metrics shared with the rest of the run. Defaults to new ones.
+            map_reduce_threshold (int, optional): The number of rated items above which a user is described by
+                summarizing chunks of the history concurrently and merging the partial profiles. Defaults to None,
+                i.e. a single request per user.
+            map_reduce_chunk_size (int, optional): The maximum number of rated items per map request. Defaults to 250.
+            map_reduce_concurrency (int, optional): The maximum number of map requests of one user in flight at the
+                same time, in both the sequential and the asyncio pipeline. Defaults to 8.
         """
+        self.embedding_model = embedding_model
+        self.map_reduce_threshold = map_reduce_threshold
+        self.map_reduce_chunk_size = map_reduce_chunk_size
+        self.map_reduce_concurrency = map_reduce_concurrency
+        self.embedding_dimensions = embedding_dimensions
+        self.cache = cache
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.single_flight = SingleFlight(self.metrics)
         if agent == "openai":
-            with open('token.yaml', 'r') as file:
-                token = yaml.safe_load(file)['openai']
-            self.agent = OpenAIAdapter(token=token, model=model)
+            if token is None:
+                with open('token.yaml', 'r') as file:
+                    token = yaml.safe_load(file)['openai']
+            self.agent = OpenAIAdapter(token=token, model=model, rate_limiter=self.rate_limiter, base_url=base_url,
+                                       metrics=self.metrics, single_flight=self.single_flight)
+            self.async_agent = AsyncOpenAIAdapter(token=token, model=model, rate_limiter=self.rate_limiter,
+                                                  base_url=base_url, metrics=self.metrics,
+                                                  single_flight=self.single_flight)
+        if embedding_backend is None:
+            embedding_backend = OpenAIEmbeddingBackend(self.agent, self.async_agent, model=embedding_model,
+                                                       dimensions=embedding_dimensions)
+        self.embedding_backend = embedding_backend
 
-    def get_user_description(self, item, test: bool = False) -> str:
+    def build_prompt(self, user) -> list[dict[str, str]]:
         """
-        Gets the user description. This method should be implemented by the subclass.
+        Builds the chat messages for the user. This method should be implemented by the subclass.
 
         Args:
-            item: The item to get the description for.
+            user: The user to build the prompt for.
+
+        Returns:
+            list[dict[str, str]]: The messages to send to the chat model.
+        """
+        raise NotImplementedError
+
+    def get_user_description(self, user, test: bool = False) -> str | list:
+        """
+        Gets the user description, reusing a cached response for an identical prompt. Users above the map-reduce
+        threshold are described by summarizing their chunks concurrently in a thread pool and merging the partial
+        profiles.
+
+        Args:
+            user: The user to get the description for.
             test (bool, optional): Whether to run in test mode. Defaults to False.
 
         Returns:
-            str: The description of the user.
+            str | list: The description of the user or the prompt if in test mode, for map-reduce the reduce prompt
+                over the chunk prompts.
         """
-        pass
+        with self.metrics.timer("build_prompt"):
+            chunks = self.map_reduce_chunks(user)
+            prompts = [self.build_prompt(user)] if chunks is None else [self.map_prompt(chunk) for chunk in chunks]
+        if test:
+            return prompts[0] if chunks is None else self.reduce_prompt(chunks)
+        if chunks is None:
+            return self.__describe(prompts[0])
+        with self.metrics.timer("map_reduce"):
+            with ThreadPoolExecutor(max_workers=min(self.map_reduce_concurrency, len(prompts)),
+                                    thread_name_prefix="map-reduce") as pool:
+                partials = list(pool.map(self.__describe, prompts))
+            return self.__describe(self.reduce_prompt(partials))
 
-    @cache
     def encode_description(self, description: str) -> list[float]:
         """
         Encodes the description into embeddings.
@@ -57,7 +170,26 @@ class EmbedAgent:
         Returns:
             list[float]: The embeddings of the description.
         """
-        return self.agent.get_embedding(description)
+        return self.encode_descriptions([description])[0]
+
+    def encode_descriptions(self, descriptions: list[str]) -> list[list[float]]:
+        """
+        Encodes several descriptions into embeddings with a single backend call. Cached descriptions are not sent.
+
+        Args:
+            descriptions (list[str]): The descriptions to encode.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the descriptions.
+        """
+        embeddings, missing = self.__cached_embeddings(descriptions)
+        if missing:
+            with self.metrics.timer("embed"):
+                fresh = dict(zip(missing, self.embedding_backend.embed(missing), strict=True))
+            self.__store_embeddings(fresh)
+            embeddings = [fresh[description] if embedding is None else embedding
+                          for description, embedding in zip(descriptions, embeddings, strict=True)]
+        return embeddings
 
     def encode_user(self, user, test: bool = False) -> list[float]:
         """
@@ -73,86 +205,419 @@ class EmbedAgent:
         description = self.get_user_description(user, test)
         return self.encode_description(description)
 
+    async def aget_user_description(self, user, test: bool = False) -> str | list:
+        """
+        Gets the user description without blocking the event loop. Users above the map-reduce threshold are described
+        by summarizing their chunks concurrently and merging the partial profiles.
+
+        Args:
+            user: The user to get the description for.
+            test (bool, optional): Whether to run in test mode. Defaults to False.
+
+        Returns:
+            str | list: The description of the user or the prompt if in test mode, for map-reduce the reduce prompt
+                over the chunk prompts.
+        """
+        with self.metrics.timer("build_prompt"):
+            chunks = self.map_reduce_chunks(user)
+            prompts = [self.build_prompt(user)] if chunks is None else [self.map_prompt(chunk) for chunk in chunks]
+        if test:
+            return prompts[0] if chunks is None else self.reduce_prompt(chunks)
+        if chunks is None:
+            return await self.__adescribe(prompts[0])
+        slots = asyncio.Semaphore(self.map_reduce_concurrency)
+
+        async def summarize(prompt: list) -> str:
+            async with slots:
+                return await self.__adescribe(prompt)
+
+        with self.metrics.timer("map_reduce"):
+            partials = await asyncio.gather(*(summarize(prompt) for prompt in prompts))
+            return await self.__adescribe(self.reduce_prompt(list(partials)))
+
+    def map_prompt(self, chunk: str) -> list[dict[str, str]]:
+        """
+        Builds the chat messages summarizing a chunk of the history of a user into a partial profile.
+
+        Args:
+            chunk (str): The prompt rendering the chunk, see UserView.chunk_prompts().
+
+        Returns:
+            list[dict[str, str]]: The system and user messages.
+        """
+        if self.MAP_PROMPT is None:
+            raise NotImplementedError(f"{type(self).__name__} does not support map-reduce descriptions")
+        return [{"role": "system", "content": self.MAP_PROMPT},
+                {"role": "user", "content": chunk}]
+
+    def reduce_prompt(self, partials: list[str]) -> list[dict[str, str]]:
+        """
+        Builds the chat messages merging the partial profiles of a user, with the system message of the single-request
+        descriptions, so that both kinds of descriptions have the same structure.
+
+        Args:
+            partials (list[str]): The partial profiles in chronological order.
+
+        Returns:
+            list[dict[str, str]]: The system and user messages.
+        """
+        parts = "\n\n".join(f"Part {number}:\n{partial}" for number, partial in enumerate(partials, 1))
+        return [{"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": self.REDUCE_PROMPT.format(count=len(partials), parts=parts)}]
+
+    def map_reduce_chunks(self, user) -> list[str] | None:
+        """
+        Returns the chunk prompts of a user above the map-reduce threshold.
+
+        Args:
+            user: The user to describe.
+
+        Returns:
+            list[str] | None: The prompts of the chronological chunks, None for a single-request description.
+        """
+        if self.map_reduce_threshold is None or not isinstance(user, UserView):
+            return None
+        if len(user) <= self.map_reduce_threshold:
+            return None
+        return user.chunk_prompts(self.map_reduce_chunk_size)
+
+    async def aencode_description(self, description: str) -> list[float]:
+        """
+        Encodes the description into embeddings without blocking the event loop.
+
+        Args:
+            description (str): The description to encode.
+
+        Returns:
+            list[float]: The embeddings of the description.
+        """
+        return (await self.aencode_descriptions([description]))[0]
+
+    async def aencode_descriptions(self, descriptions: list[str]) -> list[list[float]]:
+        """
+        Encodes several descriptions into embeddings with a single backend call without blocking the event loop.
+
+        Args:
+            descriptions (list[str]): The descriptions to encode.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the descriptions.
+        """
+        embeddings, missing = self.__cached_embeddings(descriptions)
+        if missing:
+            with self.metrics.timer("embed"):
+                fresh = dict(zip(missing, await self.embedding_backend.aembed(missing), strict=True))
+            self.__store_embeddings(fresh)
+            embeddings = [fresh[description] if embedding is None else embedding
+                          for description, embedding in zip(descriptions, embeddings, strict=True)]
+        return embeddings
+
+    async def aencode_user(self, user, test: bool = False) -> list[float]:
+        """
+        Encodes the user into embeddings without blocking the event loop.
+
+        Args:
+            user: The user to encode.
+            test (bool, optional): Whether to run in test mode. Defaults to False.
+
+        Returns:
+            list[float]: The embeddings of the user.
+        """
+        description = await self.aget_user_description(user, test)
+        return await self.aencode_description(description)
+
+    def fingerprint(self, user) -> str:
+        """
+        Returns the fingerprint of everything the encoding of the user depends on: the prompt, which renders the
+        user's ratings, the chat model and the embedding backend. The prompts of the chunks replace the prompt of
+        users described by map-reduce.
+
+        Args:
+            user: The user to fingerprint.
+
+        Returns:
+            str: The SHA-256 hex digest, identical for unchanged users between runs.
+        """
+        chunks = self.map_reduce_chunks(user)
+        messages = self.build_prompt(user) if chunks is None else [self.map_prompt(chunk) for chunk in chunks]
+        payload = {"embedding_model": self.embedding_backend.name, "messages": messages}
+        return LLMCache.make_key("fingerprint", self.agent.model, payload)
+
+    def cached_encoding(self, user) -> tuple[str | None, list[float] | None]:
+        """
+        Returns the cached description of the user and the cached embedding of that description.
+
+        Args:
+            user: The user to look up.
+
+        Returns:
+            tuple[str | None, list[float] | None]: The description and the embedding, None if not cached.
+        """
+        self.__require_cache()
+        description = self.__cached_description(self.build_prompt(user))
+        if description is None:
+            return None, None
+        return description, self.cache.get_embedding(self.embedding_backend.name, description)
+
+    def batch_request(self, user, custom_id: str) -> dict | None:
+        """
+        Returns the Batch API request of the next step missing from the cache: the chat request if the description is
+        not cached, otherwise the embedding request if its embedding is not cached.
+
+        Args:
+            user: The user to encode.
+            custom_id (str): The id of the request, used to join the response back onto the user.
+
+        Returns:
+            dict | None: The request line or None if the user is fully cached.
+        """
+        self.__require_cache()
+        prompt = self.build_prompt(user)
+        description = self.__cached_description(prompt)
+        if description is None:
+            return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": self.agent.model, "messages": prompt}}
+        if self.cache.get_embedding(self.embedding_backend.name, description) is None:
+            return {"custom_id": custom_id, "method": "POST", "url": "/v1/embeddings",
+                    "body": {"model": self.embedding_model, "input": description.replace("\n", " "),
+                             **embedding_options(self.embedding_dimensions)}}
+        return None
+
+    def ingest_batch_response(self, user, body: dict):
+        """
+        Caches a Batch API response of the user, so that the user is encoded without any further request.
+
+        Args:
+            user: The user the response belongs to.
+            body (dict): The body of a chat completion or embedding response.
+        """
+        self.__require_cache()
+        prompt = self.build_prompt(user)
+        if body.get("object") == "chat.completion":
+            self.__store_description(prompt, body["choices"][0]["message"]["content"])
+            return
+        description = self.__cached_description(prompt)
+        if description is None:
+            raise ValueError(f"Embedding response for user {user.id} without a cached description")
+        self.__store_embeddings({description: body["data"][0]["embedding"]})
+
+    def __require_cache(self):
+        if self.cache is None:
+            raise ValueError("The Batch API mode keeps descriptions and embeddings in the cache, enable the cache")
+
+    def __describe(self, prompt: list) -> str:
+        with self.metrics.timer("describe"):
+            description = self.__cached_description(prompt)
+            if description is None:
+                description = self.agent.send_prompt(prompt).choices[0].message.content
+                self.__store_description(prompt, description)
+        return description
+
+    async def __adescribe(self, prompt: list) -> str:
+        with self.metrics.timer("describe"):
+            description = self.__cached_description(prompt)
+            if description is None:
+                response = await self.async_agent.send_prompt(prompt)
+                description = response.choices[0].message.content
+                self.__store_description(prompt, description)
+        return description
+
+    def __cached_description(self, prompt: list) -> str | None:
+        if self.cache is None:
+            return None
+        description = self.cache.get_description(self.agent.model, prompt)
+        self.metrics.count("cache_misses" if description is None else "cache_hits", kind="description")
+        return description
+
+    def __store_description(self, prompt: list, description: str):
+        if self.cache is not None:
+            self.cache.set_description(self.agent.model, prompt, description)
+
+    def __cached_embeddings(self, descriptions: list[str]) -> tuple[list[list[float] | None], list[str]]:
+        if self.cache is None:
+            embeddings = [None] * len(descriptions)
+        else:
+            embeddings = [self.cache.get_embedding(self.embedding_backend.name, description)
+                          for description in descriptions]
+        missing = list(dict.fromkeys(description
+                                     for description, embedding in zip(descriptions, embeddings, strict=True)
+                                     if embedding is None))
+        if self.cache is not None:
+            self.metrics.count("cache_hits", len(descriptions) - len(missing), kind="embedding")
+            self.metrics.count("cache_misses", len(missing), kind="embedding")
+        return embeddings, missing
+
+    def __store_embeddings(self, embeddings: dict[str, list[float]]):
+        if self.cache is not None:
+            for description, embedding in embeddings.items():
+                self.cache.set_embedding(self.embedding_backend.name, description, embedding)
+
 
 class EmbedAgentMovie(EmbedAgent):
     """A class used to interact with the embedding agent specifically for movie users.
 
+    Attributes:
+        SYSTEM_PROMPT (str): The system message shared by every user, the static prefix of every request.
+        MAP_PROMPT (str): The system message summarizing a chunk of a long history.
+
     Methods:
-        get_user_description(user: MovieUser, test: bool = False): Gets the user description.
+        build_prompt(user: MovieUser): Builds the chat messages for the user.
     """
 
-    @cache
-    def get_user_description(self, user: MovieUser, test: bool = False) -> str | list:
-        """Gets the user description.
+    SYSTEM_PROMPT = dedent(
+        """
+        You will be presented with user ratings and your job is to provide a general
+        summarization of users preferences. You should pay attention to movie genres, its release year,
+        main cast, director, awards, critical acclaims, and other relevant information.
+        The response should be split into several parts: first should provide the analysis of movie
+        preferences based on its year. The second should be focused on genres and plot twists.
+        The third one should describe preferences in cast and directors.
+        The fourth should characterise users choice based on correlation between users ranking and critical
+        acclamation and reviews of movies. The fifth paragraph should describe the movies with user dislike
+        based on assigned rating 3 and below. What do these low-ranked movies have in common?
+        Provided user's profile as a general description of the user's preferences should avoid mentioning
+        the actual movies and ratings or user personal data. Try to predict favourite users actor, director,
+        genre, etc. The user profile should be useful for further movie recommendations and it should be at
+        least 5 paragraphs long. The description should include characteristics of the most relevant genres
+        to the user. Avoid mentioning specific movies in response.
+        """).replace("\n", " ")
+
+    MAP_PROMPT = dedent(
+        """
+        You will be presented with one part of the ratings of a user, in chronological order, and your job is
+        to summarize the preferences shown by this part only. You should pay attention to movie release years,
+        genres and plot twists, cast and directors, the correlation between the user's ratings and critical
+        acclamation, and what the movies rated 3 and below have in common. The summary will be merged with the
+        summaries of the other parts into one profile of the user, so it should be dense and factual, about
+        one paragraph long. Avoid mentioning specific movies in response.
+        """).replace("\n", " ")
+
+    def build_prompt(self, user: MovieUser) -> list[dict[str, str]]:
+        """Builds the chat messages for the user.
 
         Args:
-            user (MovieUser): The user to get the description for.
-            test (bool, optional): Whether to run in test mode. Defaults to False.
+            user (MovieUser): The user to build the prompt for.
 
         Returns:
-            str | list: The description of the user or the prompt if in test mode.
-        """
-        prompt = [
-            {
-                "role": "system",
-                "content": dedent(
-                    """
-                    You will be presented with user ratings and your job is to provide a general
-                    summarization of users preferences. You should pay attention to movie genres, its release year,
-                    main cast, director, awards, critical acclaims, and other relevant information.
-                    The response should be split into several parts: first should provide the analysis of movie
-                    preferences based on its year. The second should be focused on genres and plot twists.
-                    The third one should describe preferences in cast and directors.
-                    The fourth should characterise users choice based on correlation between users ranking and critical
-                    acclamation and reviews of movies. The fifth paragraph should describe the movies with user dislike
-                    based on assigned rating 3 and below. What do these low-ranked movies have in common?
-                    Provided user's profile as a general description of the user's preferences should avoid mentioning
-                    the actual movies and ratings or user personal data. Try to predict favourite users actor, director,
-                    genre, etc. The user profile should be useful for further movie recommendations and it should be at
-                    least 5 paragraphs long. The description should include characteristics of the most relevant genres
-                    to the user. Avoid mentioning specific movies in response.
-                    """).replace("\n", " ")
-            },
-            {
-                "role": "user",
-                "content": user.prompt()
-            }
-        ]
-        if test:
-            return prompt
-        return self.agent.send_prompt(prompt).choices[0].message.content
+            list[dict[str, str]]: The system and user messages.
+        """
+        return [{"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": user.prompt()}]
 
 
 class EmbedAgentMusic(EmbedAgent):
+    """A class used to interact with the embedding agent specifically for music users.
 
-    @cache
-    def get_user_description(self, user: MusicUser, test: bool = False):
-
-        prompt = [
-            {
-                "role": "system",
-                "content": dedent("You will be presented with user ratings and your job is to provide a general"
-                                  "summarization of users preferences.  You should pay attention to misic genres,"
-                                  "its release year, musicians, used instruments, text meaning, awards,"
-                                  "critical acclaims, and other relevant information. The response should be splitted"
-                                  "on several parts, first should provide the analysis of music albums preferences"
-                                  "based on its year. The second should be focused on genres and lyrics."
-                                  "The third one should describe preferences in musicians and instruments."
-                                  "The fourth should characterise users choice based on correlation between users"
-                                  "ranking and critical acclamation and reviews of music a,bums. The fifth paragraph"
-                                  "should describe the albums which user dislikes based on assigned rating 3 and below."
-                                  "What this low-ranked albums have in common? Provided user's profile as a general"
-                                  "description of the user's preferences should avoid mentioning the actual albums and"
-                                  "ratings or user personal data. Try to predict favourite users musicians, bands,"
-                                  "genre, etc. The user profile should be useful for further music recommendations and"
-                                  "it should be at least 5 paragraph long. The description should include"
-                                  "characteristic of the most relevant genres to the user."
-                                  "A void mentioning specific albums in response.").replace("\n", " ")
-            },
-            {
-                "role": "user",
-                "content": user.prompt()}
-        ]
-        if test:
-            return prompt
-        return  self.agent.send_prompt(prompt).choices[0].message.content
+    Attributes:
+        SYSTEM_PROMPT (str): The system message shared by every user, the static prefix of every request.
+        MAP_PROMPT (str): The system message summarizing a chunk of a long history.
+
+    Methods:
+        build_prompt(user: MusicUser): Builds the chat messages for the user.
+    """
+
+    SYSTEM_PROMPT = dedent("You will be presented with user ratings and your job is to provide a general"
+                           "summarization of users preferences.  You should pay attention to misic genres,"
+                           "its release year, musicians, used instruments, text meaning, awards,"
+                           "critical acclaims, and other relevant information. The response should be splitted"
+                           "on several parts, first should provide the analysis of music albums preferences"
+                           "based on its year. The second should be focused on genres and lyrics."
+                           "The third one should describe preferences in musicians and instruments."
+                           "The fourth should characterise users choice based on correlation between users"
+                           "ranking and critical acclamation and reviews of music a,bums. The fifth paragraph"
+                           "should describe the albums which user dislikes based on assigned rating 3 and below."
+                           "What this low-ranked albums have in common? Provided user's profile as a general"
+                           "description of the user's preferences should avoid mentioning the actual albums and"
+                           "ratings or user personal data. Try to predict favourite users musicians, bands,"
+                           "genre, etc. The user profile should be useful for further music recommendations and"
+                           "it should be at least 5 paragraph long. The description should include"
+                           "characteristic of the most relevant genres to the user."
+                           "A void mentioning specific albums in response.").replace("\n", " ")
+
+    MAP_PROMPT = dedent(
+        """
+        You will be presented with one part of the ratings of a user, in chronological order, and your job is
+        to summarize the preferences shown by this part only. You should pay attention to music genres, release
+        years, musicians, instruments and lyrics, the correlation between the user's ratings and critical
+        acclamation, and what the albums rated 3 and below have in common. The summary will be merged with the
+        summaries of the other parts into one profile of the user, so it should be dense and factual, about
+        one paragraph long. Avoid mentioning specific albums in response.
+        """).replace("\n", " ")
+
+    def build_prompt(self, user: MusicUser) -> list[dict[str, str]]:
+        """Builds the chat messages for the user.
+
+        Args:
+            user (MusicUser): The user to build the prompt for.
+
+        Returns:
+            list[dict[str, str]]: The system and user messages.
+        """
+        return [{"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": user.prompt()}]
+
+
+class ItemAgentMovie(EmbedAgentMovie):
+    """A class used to describe single movies for the item encoding, whose embeddings are pooled per user.
+
+    Attributes:
+        SYSTEM_PROMPT (str): The system message shared by every movie, the static prefix of every request.
+
+    Methods:
+        build_prompt(item: CatalogItem): Builds the chat messages for the movie.
+    """
+
+    SYSTEM_PROMPT = dedent(
+        """
+        You will be presented with a movie title, its release year and genres and your job is to describe
+        the movie for a recommender system. You should pay attention to its genres, era, plot themes, tone,
+        main cast, director, awards, critical acclaim and the audience it appeals to. The description should
+        characterise what kind of viewer enjoys the movie and which similar movies they would like, without
+        retelling the plot. If the movie is unknown to you, describe it based on its title, year and genres.
+        The description should be one paragraph long.
+        """).replace("\n", " ")
+
+    def build_prompt(self, item: CatalogItem) -> list[dict[str, str]]:
+        """Builds the chat messages for the movie.
+
+        Args:
+            item (CatalogItem): The movie to build the prompt for.
+
+        Returns:
+            list[dict[str, str]]: The system and user messages.
+        """
+        return [{"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": item.prompt()}]
+
+
+class ItemAgentMusic(EmbedAgentMusic):
+    """A class used to describe single albums for the item encoding, whose embeddings are pooled per user.
+
+    Attributes:
+        SYSTEM_PROMPT (str): The system message shared by every album, the static prefix of every request.
+
+    Methods:
+        build_prompt(item: CatalogItem): Builds the chat messages for the album.
+    """
+
+    SYSTEM_PROMPT = dedent(
+        """
+        You will be presented with a music album title, its artist, categories and format and your job is
+        to describe the album for a recommender system. You should pay attention to its genres, era,
+        musicians, instruments, lyrics, mood, critical acclaim and the audience it appeals to. The description
+        should characterise what kind of listener enjoys the album and which similar music they would like.
+        If the album is unknown to you, describe it based on its title, artist and categories.
+        The description should be one paragraph long.
+        """).replace("\n", " ")
+
+    def build_prompt(self, item: CatalogItem) -> list[dict[str, str]]:
+        """Builds the chat messages for the album.
+
+        Args:
+            item (CatalogItem): The album to build the prompt for.
+
+        Returns:
+            list[dict[str, str]]: The system and user messages.
+        """
+        return [{"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": item.prompt()}]
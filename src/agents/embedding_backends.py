@@ -0,0 +1,358 @@
+from collections.abc import Iterable
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import zlib
+
+import numpy as np
+
+from src.agents.openai_adapter import AsyncOpenAIAdapter, OpenAIAdapter
+from src.storage.quantization import truncate
+
+
+class EmbeddingBackend:
+    """
+    A class used as the interface of the services and models turning descriptions into embeddings.
+
+    Attributes:
+        name (str): The identifier of the backend and its model, used as the cache key of its embeddings.
+
+    Methods:
+        embed(texts: list[str]): Embeds a batch of texts.
+        embed_array(texts: list[str]): Embeds a batch of texts into a float32 matrix.
+        aembed(texts: list[str]): Embeds a batch of texts without blocking the event loop.
+    """
+
+    name = "backend"
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds a batch of texts. This method should be implemented by the subclass.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the texts.
+        """
+        raise NotImplementedError
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        """
+        Embeds a batch of texts into a float32 matrix, local backends skip the conversion to lists.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            np.ndarray: The (len(texts), dimension) matrix of embeddings.
+        """
+        return np.asarray(self.embed(texts), dtype=np.float32)
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds a batch of texts without blocking the event loop, local backends run in a worker thread.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the texts.
+        """
+        return await asyncio.to_thread(self.embed, texts)
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """
+    A class used to embed texts with the OpenAI embeddings endpoint.
+
+    Attributes:
+        name (str): The embedding model, suffixed with the reduced dimension if any.
+        model (str): The embedding model.
+        dimensions (int | None): The reduced dimension requested from the API, None for the full dimension.
+        agent (OpenAIAdapter): The adapter used by embed().
+        async_agent (AsyncOpenAIAdapter): The adapter used by aembed().
+    """
+
+    def __init__(self, agent: OpenAIAdapter, async_agent: AsyncOpenAIAdapter, model: str = "text-embedding-3-small",
+                 dimensions: int | None = None):
+        """
+        Initializes the OpenAIEmbeddingBackend with the provided adapters and model.
+
+        Args:
+            agent (OpenAIAdapter): The adapter for synchronous requests.
+            async_agent (AsyncOpenAIAdapter): The adapter for asyncio requests.
+            model (str, optional): The embedding model. Defaults to "text-embedding-3-small".
+            dimensions (int, optional): The reduced dimension of text-embedding-3 models. Defaults to None.
+        """
+        self.name = model if dimensions is None else f"{model}-{dimensions}d"
+        self.model = model
+        self.dimensions = dimensions
+        self.agent = agent
+        self.async_agent = async_agent
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return self.agent.get_embeddings(texts, model=self.model, dimensions=self.dimensions)
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        return await self.async_agent.get_embeddings(texts, model=self.model, dimensions=self.dimensions)
+
+
+class TruncatedBackend(EmbeddingBackend):
+    """
+    A class used to reduce the dimension of the embeddings of another backend locally.
+
+    The first dimensions of every embedding are kept and the embedding is scaled back to unit norm, which is what the
+    dimensions parameter of the OpenAI embeddings endpoint does for text-embedding-3 models.
+
+    Attributes:
+        name (str): The name of the wrapped backend, suffixed with the reduced dimension.
+        backend (EmbeddingBackend): The wrapped backend.
+        dimensions (int): The reduced dimension.
+    """
+
+    def __init__(self, backend: EmbeddingBackend, dimensions: int):
+        """
+        Initializes the TruncatedBackend.
+
+        Args:
+            backend (EmbeddingBackend): The wrapped backend.
+            dimensions (int): The reduced dimension.
+        """
+        self.backend = backend
+        self.dimensions = dimensions
+
+    @property
+    def name(self) -> str:
+        return f"{self.backend.name}-{self.dimensions}d"
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        return truncate(self.backend.embed_array(texts), self.dimensions)
+
+
+class HashedTfidfBackend(EmbeddingBackend):
+    """
+    A class used to embed texts as hashed TF-IDF vectors with NumPy only.
+
+    Words and, optionally, pairs of consecutive words are hashed into a fixed number of signed buckets, counts are
+    damped with log1p, weighted by inverse document frequencies if fitted and L2-normalized. Word hashes are memoized,
+    bigram hashes and the bucket counts of a whole batch are computed with vectorized NumPy operations.
+
+    Attributes:
+        name (str): The identifier of the dimension, the n-grams and the fitted idf.
+        dimensions (int): The number of buckets, i.e. the dimension of the embeddings.
+        bigrams (bool): Whether pairs of consecutive words are hashed as well.
+        idf (np.ndarray | None): The inverse document frequency of every bucket, None for plain term frequencies.
+
+    Methods:
+        fit(texts: Iterable[str]): Fits the inverse document frequencies on a corpus.
+        save_idf(path: str): Saves the fitted inverse document frequencies.
+        embed(texts: list[str]): Embeds a batch of texts.
+        embed_array(texts: list[str]): Embeds a batch of texts into a float32 matrix.
+    """
+
+    TOKEN_PATTERN = re.compile(r"\w\w+")
+
+    def __init__(self, dimensions: int = 1024, bigrams: bool = True, idf_path: str | None = None):
+        """
+        Initializes the HashedTfidfBackend, loading the inverse document frequencies if idf_path exists.
+
+        Args:
+            dimensions (int, optional): The dimension of the embeddings. Defaults to 1024.
+            bigrams (bool, optional): Whether pairs of consecutive words are hashed as well. Defaults to True.
+            idf_path (str, optional): The .npy file of fitted inverse document frequencies. Defaults to None.
+        """
+        self.dimensions = dimensions
+        self.bigrams = bigrams
+        self.idf = None
+        self.__hashes = {}
+        if idf_path and os.path.exists(idf_path):
+            idf = np.load(idf_path)
+            if idf.shape != (dimensions,):
+                raise ValueError(f"{idf_path} holds {idf.shape[0]} idf weights, expected {dimensions}")
+            self.idf = idf
+            logging.info(f"Loaded TF-IDF weights from {idf_path}")
+
+    @property
+    def name(self) -> str:
+        idf = "tf" if self.idf is None else hashlib.sha1(self.idf.tobytes(), usedforsecurity=False).hexdigest()[:8]
+        return f"hashed-tfidf-{self.dimensions}-{'12' if self.bigrams else '1'}gram-{idf}"
+
+    def fit(self, texts: Iterable[str], batch_size: int = 1024) -> "HashedTfidfBackend":
+        """
+        Fits smoothed inverse document frequencies of the buckets on a corpus.
+
+        Args:
+            texts (Iterable[str]): The corpus, read once.
+            batch_size (int, optional): The number of texts counted at once. Defaults to 1024.
+
+        Returns:
+            HashedTfidfBackend: The backend itself.
+        """
+        document_frequency = np.zeros(self.dimensions, dtype=np.int64)
+        documents = 0
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == batch_size:
+                document_frequency += (self.__counts(batch) != 0).sum(axis=0)
+                documents += len(batch)
+                batch = []
+        if batch:
+            document_frequency += (self.__counts(batch) != 0).sum(axis=0)
+            documents += len(batch)
+        self.idf = (np.log((1 + documents) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self
+
+    def save_idf(self, path: str):
+        """
+        Saves the fitted inverse document frequencies.
+
+        Args:
+            path (str): The .npy file.
+        """
+        if self.idf is None:
+            raise ValueError("The TF-IDF weights are not fitted")
+        np.save(path, self.idf)
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        counts = self.__counts(texts)
+        weights = np.sign(counts) * np.log1p(np.abs(counts))
+        if self.idf is not None:
+            weights *= self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return (weights / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+    def __counts(self, texts: list[str]) -> np.ndarray:
+        hashes, lengths = [], []
+        for text in texts:
+            words = self.TOKEN_PATTERN.findall(text.lower())
+            word_hashes = np.fromiter((self.__hash(word) for word in words), dtype=np.uint32, count=len(words))
+            if self.bigrams and len(word_hashes) > 1:
+                pair_hashes = word_hashes[:-1] * np.uint32(0x01000193) ^ word_hashes[1:]
+                word_hashes = np.concatenate((word_hashes, pair_hashes))
+            hashes.append(word_hashes)
+            lengths.append(len(word_hashes))
+        hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint32)
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        buckets = (hashes % np.uint32(self.dimensions)).astype(np.int64)
+        signs = np.where(hashes & np.uint32(0x80000000), -1.0, 1.0)
+        counts = np.bincount(rows * self.dimensions + buckets, weights=signs, minlength=len(texts) * self.dimensions)
+        return counts.reshape(len(texts), self.dimensions)
+
+    def __hash(self, word: str) -> int:
+        value = self.__hashes.get(word)
+        if value is None:
+            value = self.__hashes[word] = zlib.crc32(word.encode("utf-8"))
+        return value
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    A class used to embed texts on the CPU with a sentence encoder exported to ONNX.
+
+    The model folder must contain model.onnx and the tokenizer.json of a Hugging Face tokenizer. Texts are sorted by
+    length and run in batches to keep padding low, the token embeddings are mean-pooled over the attention mask and
+    L2-normalized. Requires the optional onnxruntime and tokenizers packages.
+
+    Attributes:
+        name (str): The identifier of the model folder.
+        batch_size (int): The number of texts per inference call.
+        max_length (int): The maximum number of tokens per text.
+    """
+
+    def __init__(self, model_path: str, batch_size: int = 64, max_length: int = 256, threads: int | None = None):
+        """
+        Initializes the OnnxBackend and loads the model and the tokenizer.
+
+        Args:
+            model_path (str): The folder with model.onnx and tokenizer.json.
+            batch_size (int, optional): The number of texts per inference call. Defaults to 64.
+            max_length (int, optional): The maximum number of tokens per text. Defaults to 256.
+            threads (int, optional): The number of intra-op threads. Defaults to None (onnxruntime default).
+        """
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The ONNX embedding backend requires the onnxruntime and tokenizers packages, "
+                              "install them with `pip install onnxruntime tokenizers`") from e
+        self.name = f"onnx-{os.path.basename(os.path.normpath(model_path))}"
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.__tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.__tokenizer.enable_truncation(max_length)
+        self.__tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.__session = onnxruntime.InferenceSession(os.path.join(model_path, "model.onnx"), options,
+                                                      providers=["CPUExecutionProvider"])
+        self.__inputs = {model_input.name for model_input in self.__session.get_inputs()}
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        embeddings = np.zeros((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors = self.__run([texts[i] for i in batch])
+            if embeddings.shape[1] == 0:
+                embeddings = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+            embeddings[batch] = vectors
+        return embeddings
+
+    def __run(self, texts: list[str]) -> np.ndarray:
+        encodings = self.__tokenizer.encode_batch(texts)
+        feed = {"input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)}
+        if "token_type_ids" in self.__inputs:
+            feed["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        tokens = self.__session.run(None, {key: value for key, value in feed.items() if key in self.__inputs})[0]
+        mask = feed["attention_mask"][:, :, None].astype(np.float32)
+        pooled = (tokens * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+
+def build_backend(kind: str, agent=None, async_agent=None, model: str = "text-embedding-3-small",
+                  model_path: str | None = None, dimensions: int | None = None, idf_path: str | None = None,
+                  batch_size: int = 64) -> EmbeddingBackend:
+    """
+    Builds an embedding backend by name.
+
+    Args:
+        kind (str): "openai", "tfidf" or "onnx".
+        agent (OpenAIAdapter, optional): The synchronous adapter of the openai backend. Defaults to None.
+        async_agent (AsyncOpenAIAdapter, optional): The asyncio adapter of the openai backend. Defaults to None.
+        model (str, optional): The OpenAI embedding model. Defaults to "text-embedding-3-small".
+        model_path (str, optional): The model folder of the onnx backend. Defaults to None.
+        dimensions (int, optional): The embedding dimension: requested from the API by the openai backend, the number
+            of buckets of the tfidf backend, 1024 if None, and a local truncation of the onnx embeddings. Defaults to
+            None, i.e. the full dimension of the model.
+        idf_path (str, optional): The fitted idf weights of the tfidf backend. Defaults to None.
+        batch_size (int, optional): The inference batch size of the onnx backend. Defaults to 64.
+
+    Returns:
+        EmbeddingBackend: The backend.
+    """
+    match kind:
+        case "openai":
+            return OpenAIEmbeddingBackend(agent, async_agent, model=model, dimensions=dimensions)
+        case "tfidf":
+            return HashedTfidfBackend(dimensions=dimensions or 1024, idf_path=idf_path)
+        case "onnx":
+            if not model_path:
+                raise ValueError("The onnx embedding backend requires a model path")
+            backend = OnnxBackend(model_path, batch_size=batch_size)
+            return backend if dimensions is None else TruncatedBackend(backend, dimensions)
+    raise ValueError(f"Unknown embedding backend {kind}")
@@ -0,0 +1,151 @@
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+class LLMCache:
+    """
+    A class used to persist LLM responses between runs.
+
+    Entries are content-addressed: the key is a hash of the model and the request payload, i.e. the prompt messages
+    for chat completions and the text for embeddings. Values live in a SQLite file that can be shared between runs,
+    datasets and processes, and a size-bounded in-memory LRU sits in front of it.
+
+    Attributes:
+        path (str): The path to the SQLite file.
+        max_memory_items (int): The maximum number of entries kept in the in-memory LRU.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that were not cached.
+
+    Methods:
+        make_key(kind: str, model: str, payload): Builds the content address of a request.
+        get_description(model: str, messages: list): Returns the cached chat response for the messages.
+        set_description(model: str, messages: list, description: str): Stores a chat response.
+        get_embedding(model: str, text: str): Returns the cached embedding of the text.
+        set_embedding(model: str, text: str, embedding: list[float]): Stores an embedding.
+        close(): Closes the underlying database.
+    """
+
+    def __init__(self, path: str = os.path.join(".cache", "llm_cache.sqlite"), max_memory_items: int = 10_000):
+        """
+        Initializes the LLMCache with the provided database path and LRU size.
+
+        Args:
+            path (str, optional): The path to the SQLite file. Defaults to ".cache/llm_cache.sqlite".
+            max_memory_items (int, optional): The maximum number of entries kept in memory. Defaults to 10000.
+        """
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.misses = 0
+        self.__memory = OrderedDict()
+        self.__lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.__connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    @staticmethod
+    def make_key(kind: str, model: str, payload) -> str:
+        """
+        Builds the content address of a request.
+
+        Args:
+            kind (str): The kind of the request, e.g. "chat" or "embedding".
+            model (str): The model serving the request.
+            payload: The JSON-serializable request payload.
+
+        Returns:
+            str: The SHA-256 hex digest identifying the request.
+        """
+        canonical = json.dumps([kind, model, payload], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get_description(self, model: str, messages: list) -> str | None:
+        """
+        Returns the cached chat response for the messages.
+
+        Args:
+            model (str): The chat model.
+            messages (list): The prompt messages.
+
+        Returns:
+            str | None: The cached response or None if the request is not cached.
+        """
+        value = self.__get(self.make_key("chat", model, messages))
+        return None if value is None else value.decode("utf-8")
+
+    def set_description(self, model: str, messages: list, description: str):
+        """
+        Stores a chat response.
+
+        Args:
+            model (str): The chat model.
+            messages (list): The prompt messages.
+            description (str): The response to store.
+        """
+        self.__set(self.make_key("chat", model, messages), description.encode("utf-8"))
+
+    def get_embedding(self, model: str, text: str) -> list[float] | None:
+        """
+        Returns the cached embedding of the text.
+
+        Args:
+            model (str): The embedding model.
+            text (str): The embedded text.
+
+        Returns:
+            list[float] | None: The cached embedding or None if the text is not cached.
+        """
+        value = self.__get(self.make_key("embedding", model, text))
+        return None if value is None else array("d", value).tolist()
+
+    def set_embedding(self, model: str, text: str, embedding: list[float]):
+        """
+        Stores an embedding.
+
+        Args:
+            model (str): The embedding model.
+            text (str): The embedded text.
+            embedding (list[float]): The embedding to store.
+        """
+        self.__set(self.make_key("embedding", model, text), array("d", embedding).tobytes())
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        with self.__lock:
+            self.__connection.close()
+
+    def __get(self, key: str) -> bytes | None:
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                return self.__memory[key]
+            row = self.__connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__remember(key, row[0])
+            return row[0]
+
+    def __set(self, key: str, value: bytes):
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, value))
+            self.__remember(key, value)
+
+    def __remember(self, key: str, value: bytes):
+        self.__memory[key] = value
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.max_memory_items:
+            self.__memory.popitem(last=False)
@@ -1,5 +1,233 @@
-from openai import OpenAI, RateLimitError
+import time
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 import backoff
+import httpx
+
+from src.agents.llm_cache import LLMCache
+from src.agents.rate_limiter import RateLimiter
+from src.agents.single_flight import SingleFlight
+from src.data.prompt_budget import approximate_token_count
+from src.monitoring.run_metrics import RunMetrics
+
+COMPLETION_TOKENS = 600
+# the client retries are disabled so that every 429 reaches the rate limiter, backoff retries these instead. Rate
+# limits only delay a request, so they are retried for up to RATE_LIMIT_MAX_TIME seconds, connection and server
+# errors get a short budget of their own so that a broken setup fails fast
+RATE_LIMIT_MAX_TIME = 600
+TRANSIENT_ERRORS = (APIConnectionError, InternalServerError)
+TRANSIENT_MAX_TRIES = 5
+TRANSIENT_MAX_TIME = 60
+# errors raised before the request leaves the client, e.g. an empty token yields an illegal "Bearer " header
+PERMANENT_CAUSES = (httpx.LocalProtocolError, httpx.UnsupportedProtocol, httpx.InvalidURL)
+
+
+def estimate_chat_tokens(messages: list, completion_tokens: int = COMPLETION_TOKENS) -> int:
+    """
+    Estimates the tokens a chat request counts against the tokens-per-minute limit.
+
+    Args:
+        messages (list): The prompt messages.
+        completion_tokens (int, optional): The expected length of the response. Defaults to 600.
+
+    Returns:
+        int: The estimated prompt and completion tokens.
+    """
+    return sum(approximate_token_count(message["content"]) + 4 for message in messages) + 3 + completion_tokens
+
+
+def estimate_embedding_tokens(texts: list[str]) -> int:
+    """
+    Estimates the tokens an embedding request counts against the tokens-per-minute limit.
+
+    Args:
+        texts (list[str]): The embedded texts.
+
+    Returns:
+        int: The estimated input tokens.
+    """
+    return sum(approximate_token_count(text) for text in texts)
+
+
+def usage_tokens(response) -> int | None:
+    """
+    Returns the total tokens a response reports, which replace the estimate of its request in the rate limiter.
+
+    Args:
+        response: The chat completion or embeddings response.
+
+    Returns:
+        int | None: The prompt and completion tokens, None if the response does not report its usage.
+    """
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def embedding_options(dimensions: int | None) -> dict:
+    """
+    Returns the optional arguments of an embeddings request, the dimensions parameter is only sent when set.
+
+    Args:
+        dimensions (int | None): The reduced embedding dimension.
+
+    Returns:
+        dict: The keyword arguments of embeddings.create.
+    """
+    return {} if dimensions is None else {"dimensions": dimensions}
+
+
+def cached_prompt_tokens(response) -> int:
+    """
+    Returns the prompt tokens served from the provider-side prefix cache, 0 if the response does not report them.
+
+    Args:
+        response: The chat completion response.
+
+    Returns:
+        int: The cached prompt tokens.
+    """
+    details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+    # older clients keep the details as the raw dict of the response
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def request_kind(details: dict) -> str:
+    """
+    Returns the kind of the request a backoff handler was called for.
+
+    Args:
+        details (dict): The backoff details, target is the retried adapter method.
+
+    Returns:
+        str: "chat" or "embedding".
+    """
+    return "chat" if details["target"].__name__.endswith("send_prompt") else "embedding"
+
+
+def is_permanent(error: Exception) -> bool:
+    """
+    Checks whether a connection error is caused by the request itself, e.g. a malformed header or URL, so that
+    retrying it cannot succeed.
+
+    Args:
+        error (Exception): The error raised by the client.
+
+    Returns:
+        bool: True if the request must not be retried, False otherwise.
+    """
+    cause = error.__cause__
+    while cause is not None:
+        if isinstance(cause, PERMANENT_CAUSES):
+            return True
+        cause = cause.__cause__
+    return False
+
+
+def count_retry(details: dict):
+    """
+    Counts a retried request and whether it was rate limited, the on_backoff handler of the adapter methods.
+
+    Args:
+        details (dict): The backoff details, args[0] is the adapter.
+    """
+    metrics, kind = details["args"][0].metrics, request_kind(details)
+    metrics.count("retries", kind=kind)
+    if getattr(details["exception"], "status_code", None) == 429:
+        metrics.count("rate_limited", kind=kind)
+
+
+def count_giveup(details: dict):
+    """
+    Counts a request that failed for good, the on_giveup handler of the adapter methods.
+
+    Args:
+        details (dict): The backoff details, args[0] is the adapter.
+    """
+    metrics, kind = details["args"][0].metrics, request_kind(details)
+    metrics.count("failed_requests", kind=kind)
+    if getattr(details["exception"], "status_code", None) == 429:
+        metrics.count("rate_limited", kind=kind)
+
+
+def chat_key(model: str, messages: list) -> str:
+    """
+    Returns the key identifying a chat request, the same one the LLMCache stores its response under.
+
+    Args:
+        model (str): The chat model.
+        messages (list): The prompt messages.
+
+    Returns:
+        str: The key of the request.
+    """
+    return LLMCache.make_key("chat", model, messages)
+
+
+def embedding_key(model: str, text: str, dimensions: int | None) -> str:
+    """
+    Returns the key identifying an embedding request of a text, built like the LLMCache keys with the dimensions.
+
+    Args:
+        model (str): The embedding model.
+        text (str): The embedded text.
+        dimensions (int | None): The reduced embedding dimension, None for the full one.
+
+    Returns:
+        str: The key of the embedding.
+    """
+    return LLMCache.make_key("embedding", model, {"text": text, "dimensions": dimensions})
+
+
+def record_usage(metrics: RunMetrics, kind: str, response, seconds: float | None = None):
+    """
+    Adds the token usage reported by a response to the token counters. Chat responses are also counted, with their
+    latency, by whether their prompt prefix was served from the provider-side cache, so that the latency and the cost
+    of prefix cache hits and misses can be compared, see usage_summary().
+
+    Args:
+        metrics (RunMetrics): The metrics of the run.
+        kind (str): "chat" or "embedding".
+        response: The chat completion or embeddings response.
+        seconds (float, optional): The latency of the request. Defaults to None (not recorded).
+    """
+    usage = getattr(response, "usage", None)
+    metrics.count("prompt_tokens", getattr(usage, "prompt_tokens", None) or 0, kind=kind)
+    if kind == "chat":
+        cached = cached_prompt_tokens(response)
+        prefix_cache = "hit" if cached else "miss"
+        metrics.count("completion_tokens", getattr(usage, "completion_tokens", None) or 0, kind=kind)
+        metrics.count("cached_prompt_tokens", cached, kind=kind)
+        metrics.count("chat_responses", prefix_cache=prefix_cache)
+        if seconds is not None:
+            metrics.count("chat_response_seconds", seconds, prefix_cache=prefix_cache)
+
+
+def usage_summary(metrics: RunMetrics) -> dict:
+    """
+    Returns the token usage of the chat requests of a run, the cached share of the prompt tokens and the mean latencies
+    of the requests with and without a prefix cache hit, read from the counters of record_usage().
+
+    Args:
+        metrics (RunMetrics): The metrics of the run.
+
+    Returns:
+        dict: The usage summary.
+    """
+    hits, misses = (metrics.value("chat_responses", prefix_cache=prefix_cache) for prefix_cache in ("hit", "miss"))
+    hit_seconds, miss_seconds = (metrics.value("chat_response_seconds", prefix_cache=prefix_cache)
+                                 for prefix_cache in ("hit", "miss"))
+    prompt_tokens = metrics.value("prompt_tokens", kind="chat")
+    cached_tokens = metrics.value("cached_prompt_tokens", kind="chat")
+    return {"requests": hits + misses,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": metrics.value("completion_tokens", kind="chat"),
+            "cached_share": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "cache_hits": hits,
+            "hit_latency": hit_seconds / hits if hits else None,
+            "miss_latency": miss_seconds / misses if misses else None}
 
 
 class OpenAIAdapter:
@@ -9,27 +237,43 @@ class OpenAIAdapter:
     Attributes:
         client (OpenAI): The OpenAI client initialized with the provided API token.
         model (str): The model to use for generating completions. Defaults to "gpt-3.5-turbo".
+        rate_limiter (RateLimiter): The limiter pacing the chat and embedding requests.
+        metrics (RunMetrics): The request timings, token counts, retries and 429 responses of the run.
+        single_flight (SingleFlight): Coalesces identical requests in flight at the same time.
 
     Methods:
         send_prompt(messages: list): Sends a list of messages to the OpenAI API and returns the response.
         get_embedding(text: str, model: str = "text-embedding-3-small"): Gets the embedding for the provided text.
+        get_embeddings(texts: list[str], model: str = "text-embedding-3-small"): Gets the embeddings for several
+            texts in a single request.
     """
 
-    def __init__(self, token: str, model: str | None = None):
+    def __init__(self, token: str, model: str | None = None, rate_limiter: RateLimiter | None = None,
+                 base_url: str | None = None, metrics: RunMetrics | None = None,
+                 single_flight: SingleFlight | None = None):
         """
         Initializes the OpenAIAdapter with the provided API token and model.
 
         Args:
             token (str): The API token for authenticating with the OpenAI API.
             model (str, optional): The model to use for generating completions. Defaults to "gpt-3.5-turbo".
+            rate_limiter (RateLimiter, optional): The limiter shared with other adapters. Defaults to an unlimited one.
+            base_url (str, optional): The URL of an OpenAI-compatible API, e.g. a local mock server. Defaults to None,
+                i.e. the OpenAI API or the OPENAI_BASE_URL environment variable.
+            metrics (RunMetrics, optional): The metrics shared with the rest of the run. Defaults to new ones.
+            single_flight (SingleFlight, optional): The coalescing of requests shared with other adapters. Defaults to
+                a new one.
         """
-        self.client = OpenAI(api_key=token)
+        self.client = OpenAI(api_key=token, base_url=base_url, max_retries=0)
         self.model = model if model else "gpt-3.5-turbo"
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.single_flight = single_flight if single_flight is not None else SingleFlight(self.metrics)
 
-    @backoff.on_exception(backoff.expo, RateLimitError, max_time=600)
     def send_prompt(self, messages: list):
         """
-        Sends a list of messages to the OpenAI API and returns the response.
+        Sends a list of messages to the OpenAI API and returns the response. Threads sending identical messages at
+        the same time share a single request.
 
         Args:
             messages (list): A list of messages to send to the OpenAI API.
@@ -37,11 +281,8 @@ class OpenAIAdapter:
         Returns:
             dict: The response from the OpenAI API.
         """
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages
-        )
-        return response
+        return self.single_flight.run_one("chat", chat_key(self.model, messages),
+                                          lambda: self.__send_prompt(messages))
 
     def get_embedding(self, text: str, model="text-embedding-3-small"):
         """
@@ -54,5 +295,172 @@ class OpenAIAdapter:
         Returns:
             list: The embedding of the provided text.
         """
-        text = text.replace("\n", " ")
-        return self.client.embeddings.create(input=[text], model=model).data[0].embedding
\ No newline at end of file
+        return self.get_embeddings([text], model=model)[0]
+
+    def get_embeddings(self, texts: list[str], model="text-embedding-3-small",
+                       dimensions: int | None = None) -> list[list[float]]:
+        """
+        Gets the embeddings for several texts in a single request. Texts another thread is already embedding are not
+        sent again, they share the result of that request.
+
+        Args:
+            texts (list[str]): The texts to get the embeddings for.
+            model (str, optional): The model to use for generating the embeddings. Defaults to "text-embedding-3-small".
+            dimensions (int, optional): The reduced dimension returned by text-embedding-3 models. Defaults to None,
+                i.e. the full dimension of the model.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the provided texts.
+        """
+        texts = [text.replace("\n", " ") for text in texts]
+        keys = [embedding_key(model, text, dimensions) for text in texts]
+        return self.single_flight.run("embedding", keys, lambda owned: self.__get_embeddings(
+            [texts[position] for position in owned], model, dimensions))
+
+    @backoff.on_exception(backoff.expo, RateLimitError, max_time=RATE_LIMIT_MAX_TIME, on_backoff=count_retry,
+                          on_giveup=count_giveup)
+    @backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=TRANSIENT_MAX_TRIES, max_time=TRANSIENT_MAX_TIME,
+                          giveup=is_permanent, on_backoff=count_retry, on_giveup=count_giveup)
+    def __send_prompt(self, messages: list):
+        with self.rate_limiter.request("chat", estimate_chat_tokens(messages)) as permit:
+            started = time.monotonic()
+            with self.metrics.timer("chat_request"):
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages
+                )
+            record_usage(self.metrics, "chat", response, time.monotonic() - started)
+            permit.used_tokens = usage_tokens(response)
+        return response
+
+    @backoff.on_exception(backoff.expo, RateLimitError, max_time=RATE_LIMIT_MAX_TIME, on_backoff=count_retry,
+                          on_giveup=count_giveup)
+    @backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=TRANSIENT_MAX_TRIES, max_time=TRANSIENT_MAX_TIME,
+                          giveup=is_permanent, on_backoff=count_retry, on_giveup=count_giveup)
+    def __get_embeddings(self, texts: list[str], model: str, dimensions: int | None) -> list[list[float]]:
+        with self.rate_limiter.request("embedding", estimate_embedding_tokens(texts)) as permit:
+            with self.metrics.timer("embedding_request"):
+                response = self.client.embeddings.create(input=texts, model=model, **embedding_options(dimensions))
+            record_usage(self.metrics, "embedding", response)
+            permit.used_tokens = usage_tokens(response)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class AsyncOpenAIAdapter:
+    """
+    An asyncio counterpart of OpenAIAdapter built on top of the AsyncOpenAI client.
+
+    Attributes:
+        client (AsyncOpenAI): The asynchronous OpenAI client initialized with the provided API token.
+        model (str): The model to use for generating completions. Defaults to "gpt-3.5-turbo".
+        rate_limiter (RateLimiter): The limiter pacing the chat and embedding requests.
+        metrics (RunMetrics): The request timings, token counts, retries and 429 responses of the run.
+        single_flight (SingleFlight): Coalesces identical requests in flight at the same time.
+
+    Methods:
+        send_prompt(messages: list): Sends a list of messages to the OpenAI API and returns the response.
+        get_embedding(text: str, model: str = "text-embedding-3-small"): Gets the embedding for the provided text.
+        get_embeddings(texts: list[str], model: str = "text-embedding-3-small"): Gets the embeddings for several
+            texts in a single request.
+    """
+
+    def __init__(self, token: str, model: str | None = None, rate_limiter: RateLimiter | None = None,
+                 base_url: str | None = None, metrics: RunMetrics | None = None,
+                 single_flight: SingleFlight | None = None):
+        """
+        Initializes the AsyncOpenAIAdapter with the provided API token and model.
+
+        Args:
+            token (str): The API token for authenticating with the OpenAI API.
+            model (str, optional): The model to use for generating completions. Defaults to "gpt-3.5-turbo".
+            rate_limiter (RateLimiter, optional): The limiter shared with other adapters. Defaults to an unlimited one.
+            base_url (str, optional): The URL of an OpenAI-compatible API, e.g. a local mock server. Defaults to None,
+                i.e. the OpenAI API or the OPENAI_BASE_URL environment variable.
+            metrics (RunMetrics, optional): The metrics shared with the rest of the run. Defaults to new ones.
+            single_flight (SingleFlight, optional): The coalescing of requests shared with other adapters. Defaults to
+                a new one.
+        """
+        self.client = AsyncOpenAI(api_key=token, base_url=base_url, max_retries=0)
+        self.model = model if model else "gpt-3.5-turbo"
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.single_flight = single_flight if single_flight is not None else SingleFlight(self.metrics)
+
+    async def send_prompt(self, messages: list):
+        """
+        Sends a list of messages to the OpenAI API and returns the response. Coroutines sending identical messages at
+        the same time share a single request.
+
+        Args:
+            messages (list): A list of messages to send to the OpenAI API.
+
+        Returns:
+            dict: The response from the OpenAI API.
+        """
+        return await self.single_flight.arun_one("chat", chat_key(self.model, messages),
+                                                 lambda: self.__send_prompt(messages))
+
+    async def get_embedding(self, text: str, model="text-embedding-3-small"):
+        """
+        Gets the embedding for the provided text.
+
+        Args:
+            text (str): The text to get the embedding for.
+            model (str, optional): The model to use for generating the embedding. Defaults to "text-embedding-3-small".
+
+        Returns:
+            list: The embedding of the provided text.
+        """
+        return (await self.get_embeddings([text], model=model))[0]
+
+    async def get_embeddings(self, texts: list[str], model="text-embedding-3-small",
+                             dimensions: int | None = None) -> list[list[float]]:
+        """
+        Gets the embeddings for several texts in a single request. Texts another coroutine is already embedding are
+        not sent again, they share the result of that request.
+
+        Args:
+            texts (list[str]): The texts to get the embeddings for.
+            model (str, optional): The model to use for generating the embeddings. Defaults to "text-embedding-3-small".
+            dimensions (int, optional): The reduced dimension returned by text-embedding-3 models. Defaults to None,
+                i.e. the full dimension of the model.
+
+        Returns:
+            list[list[float]]: The embeddings in the same order as the provided texts.
+        """
+        texts = [text.replace("\n", " ") for text in texts]
+        keys = [embedding_key(model, text, dimensions) for text in texts]
+
+        async def fetch(owned: list[int]) -> list[list[float]]:
+            return await self.__get_embeddings([texts[position] for position in owned], model, dimensions)
+
+        return await self.single_flight.arun("embedding", keys, fetch)
+
+    @backoff.on_exception(backoff.expo, RateLimitError, max_time=RATE_LIMIT_MAX_TIME, on_backoff=count_retry,
+                          on_giveup=count_giveup)
+    @backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=TRANSIENT_MAX_TRIES, max_time=TRANSIENT_MAX_TIME,
+                          giveup=is_permanent, on_backoff=count_retry, on_giveup=count_giveup)
+    async def __send_prompt(self, messages: list):
+        async with self.rate_limiter.arequest("chat", estimate_chat_tokens(messages)) as permit:
+            started = time.monotonic()
+            with self.metrics.timer("chat_request"):
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages
+                )
+            record_usage(self.metrics, "chat", response, time.monotonic() - started)
+            permit.used_tokens = usage_tokens(response)
+        return response
+
+    @backoff.on_exception(backoff.expo, RateLimitError, max_time=RATE_LIMIT_MAX_TIME, on_backoff=count_retry,
+                          on_giveup=count_giveup)
+    @backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=TRANSIENT_MAX_TRIES, max_time=TRANSIENT_MAX_TIME,
+                          giveup=is_permanent, on_backoff=count_retry, on_giveup=count_giveup)
+    async def __get_embeddings(self, texts: list[str], model: str, dimensions: int | None) -> list[list[float]]:
+        async with self.rate_limiter.arequest("embedding", estimate_embedding_tokens(texts)) as permit:
+            with self.metrics.timer("embedding_request"):
+                response = await self.client.embeddings.create(input=texts, model=model,
+                                                               **embedding_options(dimensions))
+            record_usage(self.metrics, "embedding", response)
+            permit.used_tokens = usage_tokens(response)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
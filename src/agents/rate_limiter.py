@@ -0,0 +1,326 @@
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import logging
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A class used to spread a per-minute budget evenly over time.
+
+    The bucket holds at most the budget of a few seconds and refills continuously, so bursts are bounded by the
+    capacity and the long-run rate never exceeds rate_per_minute.
+
+    Attributes:
+        rate_per_minute (float): The budget refilled every minute.
+        capacity (float): The maximum budget held by the bucket.
+        level (float): The budget currently available, negative after an overdraft.
+
+    Methods:
+        wait_time(amount: float): Returns the seconds until the amount is available.
+        consume(amount: float): Takes the amount from the bucket.
+        drain(): Empties the bucket.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        """
+        Initializes a full TokenBucket.
+
+        Args:
+            rate_per_minute (float): The budget refilled every minute.
+            burst_seconds (float, optional): The number of seconds of budget the bucket holds. Defaults to 1.0.
+        """
+        self.rate_per_minute = rate_per_minute
+        self.capacity = max(rate_per_minute * burst_seconds / 60, 1)
+        self.level = self.capacity
+        self.__updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Returns the number of seconds until the amount is available. Amounts above the capacity only wait for a full
+        bucket, so a single oversized request is never blocked forever.
+
+        Args:
+            amount (float): The requested budget.
+
+        Returns:
+            float: The number of seconds to wait, 0 if the amount is available now.
+        """
+        self.__refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0) * 60 / self.rate_per_minute
+
+    def consume(self, amount: float):
+        """
+        Takes the amount from the bucket, a negative amount gives it back.
+
+        Args:
+            amount (float): The consumed budget.
+        """
+        self.__refill()
+        self.level = min(self.level - amount, self.capacity)
+
+    def drain(self):
+        """
+        Empties the bucket, e.g. after the server signalled that the budget is exhausted.
+        """
+        self.__refill()
+        self.level = min(self.level, 0)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.__updated) * self.rate_per_minute / 60)
+        self.__updated = now
+
+
+class Permit:
+    """
+    A granted request slot.
+
+    Attributes:
+        kind (str): The kind of the request, e.g. "chat" or "embedding".
+        tokens (float): The tokens reserved for the request.
+        started (float): The monotonic time the request was granted.
+        used_tokens (int | None): The tokens actually used, reported by the caller from the response usage.
+    """
+
+    __slots__ = ("kind", "tokens", "started", "used_tokens")
+
+    def __init__(self, kind: str, tokens: float):
+        """
+        Initializes the Permit of a request granted now.
+
+        Args:
+            kind (str): "chat" or "embedding".
+            tokens (float): The estimated tokens of the request.
+        """
+        self.kind = kind
+        self.tokens = tokens
+        self.started = time.monotonic()
+        self.used_tokens = None
+
+
+class RateLimiter:
+    """
+    A class used to pace API requests proactively instead of reacting to rate limit errors.
+
+    Every request waits for a slot of a requests-per-minute and of a tokens-per-minute bucket and for a free
+    concurrency slot. The concurrency limit adapts AIMD-style: it grows by one after every limit successful requests,
+    is halved on a 429 response and cut by a quarter on a latency spike. Latencies are tracked per request kind as a
+    slow moving baseline and a fast moving recent average, a spike is a recent average above latency_factor times the
+    baseline and more than latency_tolerance seconds above it, so a single slow request or the scheduling jitter of
+    short requests never counts as one. Decreases are applied at most once per baseline latency, so a burst of 429s
+    from the same window counts once. A single limiter is meant to be shared by the chat and the embedding calls of a
+    run.
+
+    Attributes:
+        requests (TokenBucket | None): The requests-per-minute bucket, None if unlimited.
+        tokens (TokenBucket | None): The tokens-per-minute bucket, None if unlimited.
+        max_concurrency (int | None): The upper bound of the concurrency limit, None if unlimited.
+        min_concurrency (int): The lower bound of the concurrency limit.
+        limit (float): The current concurrency limit.
+        latency_factor (float): The ratio of the recent to the baseline latency considered a latency spike.
+        latency_tolerance (float): The seconds the recent latency must exceed the baseline by to be a spike.
+        in_flight (int): The number of granted requests that have not finished.
+        rate_limited (int): The number of 429 responses.
+        waited (float): The total number of seconds requests waited for the limiter.
+
+    Methods:
+        acquire(kind: str, tokens: float): Waits for and returns a Permit.
+        aacquire(kind: str, tokens: float): Waits for and returns a Permit without blocking the event loop.
+        release(permit: Permit, error: BaseException | None = None): Returns the slot and adapts the limit.
+        request(kind: str, tokens: float): Context manager around acquire and release.
+        arequest(kind: str, tokens: float): Async context manager around aacquire and release.
+    """
+
+    POLL_INTERVAL = 0.02
+    # weights of a new latency in the baseline and in the recent average, and the samples before spikes are detected
+    BASELINE_WEIGHT = 0.01
+    RECENT_WEIGHT = 0.3
+    WARMUP_SAMPLES = 20
+
+    def __init__(self,
+                 requests_per_minute: float | None = None,
+                 tokens_per_minute: float | None = None,
+                 max_concurrency: int | None = None,
+                 min_concurrency: int = 1,
+                 latency_factor: float = 3.0,
+                 latency_tolerance: float = 0.25):
+        """
+        Initializes the RateLimiter with the provided budgets, the concurrency limit starts at max_concurrency.
+
+        Args:
+            requests_per_minute (float, optional): The requests-per-minute budget. Defaults to None (unlimited).
+            tokens_per_minute (float, optional): The tokens-per-minute budget. Defaults to None (unlimited).
+            max_concurrency (int, optional): The upper bound of the concurrency limit. Defaults to None (unlimited).
+            min_concurrency (int, optional): The lower bound of the concurrency limit. Defaults to 1.
+            latency_factor (float, optional): The ratio of the recent to the baseline latency considered a spike.
+                Defaults to 3.0.
+            latency_tolerance (float, optional): The seconds the recent latency must exceed the baseline by to be a
+                spike. Defaults to 0.25.
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency or min_concurrency)
+        self.limit = float(max_concurrency) if max_concurrency else float("inf")
+        self.latency_factor = latency_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.waited = 0.0
+        self.__latency = {}
+        self.__successes = 0
+        self.__last_decrease = 0.0
+        self.__lock = threading.Lock()
+
+    def acquire(self, kind: str, tokens: float) -> Permit:
+        """
+        Waits until the request fits all budgets and returns its Permit.
+
+        Args:
+            kind (str): The kind of the request, latencies are tracked per kind.
+            tokens (float): The estimated number of tokens of the request.
+
+        Returns:
+            Permit: The granted slot, to be passed to release().
+        """
+        started = time.monotonic()
+        while (wait := self.__try_acquire(tokens)) > 0:
+            time.sleep(wait)
+        self.__add_wait(time.monotonic() - started)
+        return Permit(kind, tokens)
+
+    async def aacquire(self, kind: str, tokens: float) -> Permit:
+        """
+        Waits until the request fits all budgets without blocking the event loop and returns its Permit.
+
+        Args:
+            kind (str): The kind of the request, latencies are tracked per kind.
+            tokens (float): The estimated number of tokens of the request.
+
+        Returns:
+            Permit: The granted slot, to be passed to release().
+        """
+        started = time.monotonic()
+        while (wait := self.__try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+        self.__add_wait(time.monotonic() - started)
+        return Permit(kind, tokens)
+
+    def release(self, permit: Permit, error: BaseException | None = None):
+        """
+        Returns the slot of a finished request, settles its token usage and adapts the concurrency limit. A request
+        interrupted by a BaseException such as a cancellation only returns its slot.
+
+        Args:
+            permit (Permit): The slot returned by acquire().
+            error (BaseException, optional): The error raised by the request, if any. Defaults to None.
+        """
+        latency = time.monotonic() - permit.started
+        with self.__lock:
+            self.in_flight -= 1
+            if self.tokens is not None and permit.used_tokens is not None:
+                self.tokens.consume(permit.used_tokens - permit.tokens)
+            if getattr(error, "status_code", None) == 429:
+                self.rate_limited += 1
+                for bucket in (self.requests, self.tokens):
+                    if bucket is not None:
+                        bucket.drain()
+                self.__decrease(0.5, "rate limited")
+            elif error is None:
+                baseline, recent, count = self.__latency.get(permit.kind, (latency, latency, 0))
+                count += 1
+                # the baseline is a plain mean of the first samples and moves slowly afterwards
+                baseline += (latency - baseline) * (1 / count if count < self.WARMUP_SAMPLES else self.BASELINE_WEIGHT)
+                recent += (latency - recent) * self.RECENT_WEIGHT
+                self.__latency[permit.kind] = (baseline, recent, count)
+                if (count >= self.WARMUP_SAMPLES and recent > self.latency_factor * baseline
+                        and recent - baseline > self.latency_tolerance):
+                    self.__decrease(0.75, f"{permit.kind} latency {recent:.1f}s, baseline {baseline:.1f}s")
+                else:
+                    self.__increase()
+
+    @contextmanager
+    def request(self, kind: str, tokens: float):
+        """
+        Acquires a Permit for the duration of the block and releases it with the raised error, if any. The slot is
+        also returned when the block is interrupted, e.g. by a KeyboardInterrupt.
+
+        Args:
+            kind (str): The kind of the request.
+            tokens (float): The estimated number of tokens of the request.
+
+        Yields:
+            Permit: The granted slot, used_tokens can be set from the response.
+        """
+        permit, error = self.acquire(kind, tokens), None
+        try:
+            yield permit
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.release(permit, error)
+
+    @asynccontextmanager
+    async def arequest(self, kind: str, tokens: float):
+        """
+        Asynchronously acquires a Permit for the duration of the block and releases it with the raised error, if any.
+        The slot is also returned when the block is interrupted, e.g. by the cancellation of its task.
+
+        Args:
+            kind (str): The kind of the request.
+            tokens (float): The estimated number of tokens of the request.
+
+        Yields:
+            Permit: The granted slot, used_tokens can be set from the response.
+        """
+        permit, error = await self.aacquire(kind, tokens), None
+        try:
+            yield permit
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.release(permit, error)
+
+    def __try_acquire(self, tokens: float) -> float:
+        with self.__lock:
+            if self.in_flight >= max(int(self.limit), self.min_concurrency):
+                return self.POLL_INTERVAL
+            wait = max(self.requests.wait_time(1) if self.requests is not None else 0,
+                       self.tokens.wait_time(tokens) if self.tokens is not None else 0)
+            if wait > 0:
+                return max(wait, self.POLL_INTERVAL)
+            if self.requests is not None:
+                self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(tokens)
+            self.in_flight += 1
+            return 0
+
+    def __add_wait(self, seconds: float):
+        with self.__lock:
+            self.waited += seconds
+
+    def __increase(self):
+        if self.max_concurrency is None or self.limit >= self.max_concurrency:
+            return
+        self.__successes += 1
+        if self.__successes >= self.limit:
+            self.__successes = 0
+            self.limit = min(self.limit + 1, self.max_concurrency)
+
+    def __decrease(self, factor: float, reason: str):
+        if self.max_concurrency is None:
+            return
+        now = time.monotonic()
+        cooldown = max((baseline for baseline, _, _ in self.__latency.values()), default=1.0)
+        if now - self.__last_decrease < cooldown:
+            return
+        self.__last_decrease = now
+        self.__successes = 0
+        self.limit = max(self.limit * factor, self.min_concurrency)
+        logging.info(f"Concurrency limit lowered to {int(self.limit)}: {reason}")
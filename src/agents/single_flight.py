@@ -0,0 +1,154 @@
+from collections.abc import Awaitable, Callable, Sequence
+from concurrent.futures import Future
+from typing import Any
+import asyncio
+import threading
+
+from src.monitoring.run_metrics import RunMetrics
+
+
+class SingleFlight:
+    """
+    A class used to coalesce identical requests that are in flight at the same time.
+
+    Every request is identified by a key, e.g. LLMCache.make_key of the model and the payload. The first caller of a
+    key sends the request, callers arriving before it finishes wait for its result or its error instead of sending
+    their own. Keys are forgotten as soon as their request finishes, finished responses are reused through the
+    LLMCache. Requests of several keys, e.g. a batch of embedding inputs, only send the keys not in flight yet.
+    Threads and coroutines coalesce separately, one instance can serve a synchronous and an asynchronous adapter.
+
+    Attributes:
+        metrics (RunMetrics): The metrics of the run, the saved requests are counted as coalesced_requests.
+        saved (dict[str, int]): The number of saved requests per kind.
+
+    Methods:
+        run(kind: str, keys: Sequence[str], fetch: Callable): Returns the results, fetching from this thread.
+        arun(kind: str, keys: Sequence[str], fetch: Callable): Returns the results, fetching from this coroutine.
+        run_one(kind: str, key: str, fetch: Callable): Returns the result of a single request, fetching from this
+            thread.
+        arun_one(kind: str, key: str, fetch: Callable): Returns the result of a single request, fetching from this
+            coroutine.
+    """
+
+    def __init__(self, metrics: RunMetrics | None = None):
+        """
+        Initializes the SingleFlight.
+
+        Args:
+            metrics (RunMetrics, optional): The metrics shared with the rest of the run. Defaults to new ones.
+        """
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.saved = {}
+        self.__threads = {}
+        self.__tasks = {}
+        self.__lock = threading.Lock()
+
+    def run(self, kind: str, keys: Sequence[str], fetch: Callable[[list[int]], list]) -> list:
+        """
+        Returns the result of every key, fetching only the keys no other thread is waiting for.
+
+        Args:
+            kind (str): The kind of the requests, e.g. "chat" or "embedding".
+            keys (Sequence[str]): The key of every request.
+            fetch (Callable[[list[int]], list]): Sends the requests at the given positions of keys and returns their
+                results in the same order.
+
+        Returns:
+            list: The result of every key.
+        """
+        with self.__lock:
+            futures, owned = self.__claim(self.__threads, keys, Future, kind)
+        if owned:
+            try:
+                results = fetch(owned)
+            except BaseException as e:
+                self.__settle(self.__threads, keys, futures, owned, error=e)
+                raise
+            self.__settle(self.__threads, keys, futures, owned, results=results)
+        return [future.result() for future in futures]
+
+    async def arun(self, kind: str, keys: Sequence[str], fetch: Callable[[list[int]], Awaitable[list]]) -> list:
+        """
+        Returns the result of every key, fetching only the keys no other coroutine is waiting for.
+
+        Args:
+            kind (str): The kind of the requests, e.g. "chat" or "embedding".
+            keys (Sequence[str]): The key of every request.
+            fetch (Callable[[list[int]], Awaitable[list]]): Coroutine function sending the requests at the given
+                positions of keys and returning their results in the same order.
+
+        Returns:
+            list: The result of every key.
+        """
+        futures, owned = self.__claim(self.__tasks, keys, asyncio.get_running_loop().create_future, kind)
+        if owned:
+            try:
+                results = await fetch(owned)
+            except BaseException as e:
+                self.__settle(self.__tasks, keys, futures, owned, error=e)
+                raise
+            self.__settle(self.__tasks, keys, futures, owned, results=results)
+        # shielded, so a cancelled waiter does not cancel the request it shares with the other waiters
+        return [await asyncio.shield(future) for future in futures]
+
+    def run_one(self, kind: str, key: str, fetch: Callable[[], Any]) -> Any:
+        """
+        Returns the result of a single request, sending it only if no other thread is waiting for the key.
+
+        Args:
+            kind (str): The kind of the request, e.g. "chat".
+            key (str): The key of the request.
+            fetch (Callable[[], Any]): Sends the request and returns its result.
+
+        Returns:
+            Any: The result of the request.
+        """
+        return self.run(kind, [key], lambda _owned: [fetch()])[0]
+
+    async def arun_one(self, kind: str, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the result of a single request, sending it only if no other coroutine is waiting for the key.
+
+        Args:
+            kind (str): The kind of the request, e.g. "chat".
+            key (str): The key of the request.
+            fetch (Callable[[], Awaitable[Any]]): Coroutine function sending the request and returning its result.
+
+        Returns:
+            Any: The result of the request.
+        """
+        async def fetch_all(_owned: list[int]) -> list:
+            return [await fetch()]
+
+        return (await self.arun(kind, [key], fetch_all))[0]
+
+    def __claim(self, in_flight: dict, keys: Sequence[str], create: Callable, kind: str) -> tuple[list, list[int]]:
+        futures, owned = [], []
+        for position, key in enumerate(keys):
+            if key not in in_flight:
+                in_flight[key] = create()
+                owned.append(position)
+            futures.append(in_flight[key])
+        saved = len(keys) - len(owned)
+        if saved:
+            self.saved[kind] = self.saved.get(kind, 0) + saved
+            self.metrics.count("coalesced_requests", saved, kind=kind)
+        return futures, owned
+
+    def __settle(self, in_flight: dict, keys: Sequence[str], futures: list, owned: list[int],
+                 results: list | None = None, error: BaseException | None = None):
+        with self.__lock:
+            for position in owned:
+                in_flight.pop(keys[position], None)
+        for index, position in enumerate(owned):
+            future = futures[position]
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(results[index])
+            elif isinstance(error, Exception):
+                future.set_exception(error)
+                # the owner raises the error itself, waiters are optional
+                future.exception()
+            else:
+                future.cancel()
@@ -0,0 +1,43 @@
+class CatalogItem:
+    """
+    A class used to represent a catalog item described and embedded once for every user who rated it.
+
+    It exposes the interface of the user views the encoders rely on, i.e. id, description, embedding, prompt() and
+    dict(), so items go through the same sequential and asyncio pipelines, cache and result files as users.
+
+    Attributes:
+        id (int | str): The id of the item.
+        text (str): The catalog attributes of the item rendered into the prompt.
+        description (str | list | None): The description of the item.
+        embedding (list[float] | None): The embedding of the description.
+
+    Methods:
+        prompt(): Returns the prompt of the item.
+        dict(): Returns the serializable representation of the item.
+    """
+
+    __slots__ = ("id", "text", "description", "embedding")
+
+    def __init__(self, item_id, text: str):
+        """
+        Initializes the CatalogItem.
+
+        Args:
+            item_id (int | str): The id of the item.
+            text (str): The catalog attributes of the item rendered into the prompt.
+        """
+        self.id = item_id
+        self.text = text
+        self.description = None
+        self.embedding = None
+
+    def prompt(self) -> str:
+        return self.text
+
+    def dict(self) -> dict:
+        return {"id": self.id,
+                "prompt": self.prompt(),
+                "description": self.description}
+
+    def __hash__(self):
+        return hash(self.id)
@@ -0,0 +1,245 @@
+from collections.abc import Callable, Sequence
+
+import numpy as np
+import pandas as pd
+
+from src.data.prompt_budget import BudgetedPrompt, PromptBudget
+
+
+class InteractionMatrix:
+    """
+    A class used to store user-item interactions in compressed sparse row (CSR) layout.
+
+    The interactions of the user stored in row u occupy positions user_ptr[u]:user_ptr[u + 1] of the item_idx,
+    rating and timestamp arrays. Item indices point to rows of an interned item table, so every item attribute is
+    stored once no matter how many users rated the item.
+
+    Attributes:
+        user_ids (np.ndarray): The id of the user stored in every row.
+        user_ptr (np.ndarray): The int64 offsets of every user, of length n_users + 1.
+        item_idx (np.ndarray): The int32 row of the item table of every interaction.
+        rating (np.ndarray): The rating of every interaction.
+        timestamp (np.ndarray): The timestamp of every interaction.
+        items (pd.DataFrame): The item table.
+        user_index (dict): The mapping from user id to row.
+
+    Methods:
+        from_arrays(user_codes, user_ids, item_idx, rating, timestamp, items): Builds the matrix from parallel arrays.
+        row(user_id): Returns the slice of the interactions of the user.
+        item_column(name: str): Returns a column of the item table as a NumPy array.
+        memory_usage(): Returns the number of bytes used by the interaction arrays.
+        __len__(): Returns the number of users.
+    """
+
+    def __init__(self,
+                 user_ids: np.ndarray,
+                 user_ptr: np.ndarray,
+                 item_idx: np.ndarray,
+                 rating: np.ndarray,
+                 timestamp: np.ndarray,
+                 items: pd.DataFrame):
+        """
+        Initializes the InteractionMatrix with already grouped CSR arrays.
+
+        Args:
+            user_ids (np.ndarray): The id of the user stored in every row.
+            user_ptr (np.ndarray): The offsets of every user, of length n_users + 1.
+            item_idx (np.ndarray): The row of the item table of every interaction.
+            rating (np.ndarray): The rating of every interaction.
+            timestamp (np.ndarray): The timestamp of every interaction.
+            items (pd.DataFrame): The item table.
+        """
+        self.user_ids = np.asarray(user_ids)
+        self.user_ptr = np.asarray(user_ptr, dtype=np.int64)
+        self.item_idx = np.asarray(item_idx, dtype=np.int32)
+        self.rating = np.asarray(rating)
+        self.timestamp = np.asarray(timestamp)
+        self.items = items
+        self.user_index = {user_id: position for position, user_id in enumerate(self.user_ids.tolist())}
+        self.__item_columns = {}
+
+    @classmethod
+    def from_arrays(cls,
+                    user_codes: np.ndarray,
+                    user_ids: np.ndarray,
+                    item_idx: np.ndarray,
+                    rating: np.ndarray,
+                    timestamp: np.ndarray,
+                    items: pd.DataFrame) -> "InteractionMatrix":
+        """
+        Builds the matrix from parallel interaction arrays, keeping the input order within every user.
+
+        Args:
+            user_codes (np.ndarray): The row of the user of every interaction, i.e. a position in user_ids.
+            user_ids (np.ndarray): The id of the user stored in every row.
+            item_idx (np.ndarray): The row of the item table of every interaction.
+            rating (np.ndarray): The rating of every interaction.
+            timestamp (np.ndarray): The timestamp of every interaction.
+            items (pd.DataFrame): The item table.
+
+        Returns:
+            InteractionMatrix: The matrix with one row per entry of user_ids, empty rows included.
+        """
+        user_codes = np.asarray(user_codes)
+        order = np.argsort(user_codes, kind='stable')
+        counts = np.bincount(user_codes, minlength=len(user_ids))
+        user_ptr = np.concatenate(([0], np.cumsum(counts)))
+        return cls(user_ids=user_ids,
+                   user_ptr=user_ptr,
+                   item_idx=np.asarray(item_idx)[order],
+                   rating=np.asarray(rating)[order],
+                   timestamp=np.asarray(timestamp)[order],
+                   items=items)
+
+    def row(self, user_id) -> slice:
+        """
+        Returns the slice of the interactions of the user.
+
+        Args:
+            user_id (int | str): The id of the user.
+
+        Returns:
+            slice: The positions of the interactions of the user in the interaction arrays.
+        """
+        position = self.user_index[user_id]
+        return slice(int(self.user_ptr[position]), int(self.user_ptr[position + 1]))
+
+    def item_column(self, name: str) -> np.ndarray:
+        """
+        Returns a column of the item table as a NumPy array, converting it once.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            np.ndarray: The column values aligned with the item table rows.
+        """
+        if name not in self.__item_columns:
+            self.__item_columns[name] = self.items[name].to_numpy()
+        return self.__item_columns[name]
+
+    def memory_usage(self) -> int:
+        """
+        Returns the number of bytes used by the interaction arrays.
+
+        Returns:
+            int: The size of the CSR arrays in bytes.
+        """
+        return sum(array.nbytes for array in (self.user_ptr, self.item_idx, self.rating, self.timestamp))
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+
+class UserView:
+    """
+    A class used as a lightweight view on a single row of an InteractionMatrix.
+
+    Attributes:
+        matrix (InteractionMatrix): The matrix the user is stored in.
+        id (int | str): The id of the user.
+        description (str | list | None): The description of the user.
+        embedding (list[float] | None): The embedding of the user.
+        budget (PromptBudget | None): The token budget of the prompt, None renders every rating.
+
+    Methods:
+        item_positions: Returns the item table rows of the interactions of the user.
+        rating_values: Returns the ratings of the user.
+        timestamp_values: Returns the timestamps of the interactions of the user.
+        prompt_parts(): Returns the function rendering entries into a prompt and the entries of the user.
+        fit_prompt(render, entries): Renders the entries of the user within the token budget.
+        chunk_prompts(chunk_size: int): Renders the whole history in chronological chunks.
+        budget_report(): Returns the token count and the number of kept items of the prompt.
+        __len__(): Returns the number of interactions of the user.
+    """
+
+    __slots__ = ("matrix", "id", "description", "embedding", "budget", "_row", "_prompt")
+
+    def __init__(self, matrix: InteractionMatrix, user_id, budget: PromptBudget | None = None):
+        """
+        Initializes the view on the row of the given user.
+
+        Args:
+            matrix (InteractionMatrix): The matrix the user is stored in.
+            user_id (int | str): The id of the user.
+            budget (PromptBudget, optional): The token budget of the prompt. Defaults to None.
+        """
+        self.matrix = matrix
+        self.id = user_id
+        self.description = None
+        self.embedding = None
+        self.budget = budget
+        self._row = matrix.row(user_id)
+        self._prompt = None
+
+    @property
+    def item_positions(self) -> np.ndarray:
+        return self.matrix.item_idx[self._row]
+
+    @property
+    def rating_values(self) -> np.ndarray:
+        return self.matrix.rating[self._row]
+
+    @property
+    def timestamp_values(self) -> np.ndarray:
+        return self.matrix.timestamp[self._row]
+
+    def prompt_parts(self) -> tuple[Callable[[list], str], list]:
+        """
+        Returns the function rendering entries into a prompt and the rated items of the user as entries. This method
+        should be implemented by the subclass.
+
+        Returns:
+            tuple[Callable[[list], str], list]: The render function and the entries aligned with the interaction arrays.
+        """
+        raise NotImplementedError
+
+    def fit_prompt(self, render: Callable[[list], str], entries: Sequence) -> BudgetedPrompt:
+        """
+        Renders the entries of the user within the token budget.
+
+        Args:
+            render (Callable[[list], str]): The function rendering a list of entries into the prompt.
+            entries (Sequence): The rated items of the user aligned with the interaction arrays.
+
+        Returns:
+            BudgetedPrompt: The prompt with its token count and the number of kept items.
+        """
+        if self.budget is None:
+            return BudgetedPrompt(render(entries), None, len(entries), len(entries))
+        return self.budget.fit(render, entries, self.rating_values, self.timestamp_values)
+
+    def chunk_prompts(self, chunk_size: int) -> list[str]:
+        """
+        Renders every rated item of the user, regardless of the token budget, into prompts of at most chunk_size items
+        in chronological order.
+
+        Args:
+            chunk_size (int): The maximum number of items per prompt.
+
+        Returns:
+            list[str]: The prompts of the consecutive chunks of the history.
+        """
+        render, entries = self.prompt_parts()
+        order = np.argsort(self.timestamp_values, kind='stable').tolist()
+        return [render([entries[position] for position in order[start:start + chunk_size]])
+                for start in range(0, len(order), chunk_size)]
+
+    def budget_report(self) -> dict:
+        """
+        Returns the token count and the number of kept items of the last rendered prompt, empty without a budget.
+
+        Returns:
+            dict: The prompt_tokens, prompt_items and total_items of the user.
+        """
+        if self.budget is None or self._prompt is None:
+            return {}
+        return {"prompt_tokens": self._prompt.tokens,
+                "prompt_items": self._prompt.items,
+                "total_items": self._prompt.total_items}
+
+    def __len__(self) -> int:
+        return self._row.stop - self._row.start
+
+    def __hash__(self):
+        return hash(self.id)
@@ -0,0 +1,154 @@
+from collections.abc import Iterator
+from contextlib import ExitStack
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+
+
+class InteractionStream:
+    """
+    A class used to read a delimited interaction file in chunks of complete users.
+
+    The user id must be the first column. A file grouped by user, e.g. the MovieLens ratings which are sorted by user,
+    is read as is. Any other file is first sorted into an on-disk spill with an external merge sort: chunks of lines
+    are sorted by user into temporary runs and the runs are merged into {file}.by_user, which is reused as long as it
+    is newer than the file. The sort is stable, so the interactions of every user keep the order of the file.
+
+    Lines are read chunk_lines at a time and a chunk is cut after the last complete user, the remaining lines are
+    carried over to the next chunk. The memory is bounded by the chunk size plus the largest single user history,
+    a presorted file additionally keeps the ids of the finished users to detect that it is not grouped after all.
+
+    Attributes:
+        path (str): The interaction file.
+        separator (bytes): The column separator.
+        header (bool): Whether the first line is a header.
+        presorted (bool): Whether the file is grouped by user and read without a spill.
+        chunk_lines (int): The number of lines read at once.
+
+    Methods:
+        spill_path: Returns the path of the user-sorted spill.
+        header_line(): Returns the header line of the file, empty without a header.
+        __iter__(): Yields chunks of lines holding complete users only.
+    """
+
+    def __init__(self, path: str, separator: bytes = b"\t", header: bool = True, presorted: bool = False,
+                 chunk_lines: int = 200_000):
+        r"""
+        Initializes the InteractionStream.
+
+        Args:
+            path (str): The interaction file.
+            separator (bytes, optional): The column separator. Defaults to b"\t".
+            header (bool, optional): Whether the first line is a header. Defaults to True.
+            presorted (bool, optional): Whether the file is grouped by user, otherwise it is read through a spill.
+                Defaults to False.
+            chunk_lines (int, optional): The number of lines read at once. Defaults to 200,000.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {path}")
+        self.path = path
+        self.separator = separator
+        self.header = header
+        self.presorted = presorted
+        self.chunk_lines = chunk_lines
+
+    @property
+    def spill_path(self) -> str:
+        return f"{self.path}.by_user"
+
+    def header_line(self) -> bytes:
+        """
+        Returns the header line of the file, empty without a header.
+
+        Returns:
+            bytes: The header line including its line break.
+        """
+        if not self.header:
+            return b""
+        with open(self.path, 'rb') as f:
+            return f.readline()
+
+    def __iter__(self) -> Iterator[list[bytes]]:
+        """
+        Yields chunks of lines holding complete users only, without the header.
+
+        Yields:
+            list[bytes]: The lines of one or more complete users.
+        """
+        path = self.path if self.presorted else self.__spill()
+        finished = set() if self.presorted else None
+        with open(path, 'rb') as f:
+            if self.header:
+                f.readline()
+            chunk = []
+            for line in f:
+                if not line.strip():
+                    continue
+                chunk.append(line)
+                if len(chunk) >= self.chunk_lines:
+                    cut = self.__last_user_start(chunk)
+                    if cut > 0:
+                        yield self.__checked(chunk[:cut], finished)
+                        chunk = chunk[cut:]
+            if chunk:
+                yield self.__checked(chunk, finished)
+
+    def __key(self, line: bytes) -> bytes:
+        return line.split(self.separator, 1)[0]
+
+    def __last_user_start(self, chunk: list[bytes]) -> int:
+        last = self.__key(chunk[-1])
+        position = len(chunk) - 1
+        while position > 0 and self.__key(chunk[position - 1]) == last:
+            position -= 1
+        return position
+
+    def __checked(self, chunk: list[bytes], finished: set | None) -> list[bytes]:
+        # a user id seen in an earlier chunk means the file is not grouped, its users would be split
+        if finished is None:
+            return chunk
+        keys = dict.fromkeys(self.__key(line) for line in chunk)
+        if not finished.isdisjoint(keys):
+            raise ValueError(f"{self.path} is not grouped by user, read it with presorted=False")
+        finished.update(keys)
+        return chunk
+
+    def __spill(self) -> str:
+        spill_path = self.spill_path
+        if os.path.exists(spill_path) and os.path.getmtime(spill_path) >= os.path.getmtime(self.path):
+            return spill_path
+        logging.info(f"Sorting {self.path} by user into {spill_path}")
+        run_folder = tempfile.mkdtemp(prefix="runs-", dir=os.path.dirname(spill_path) or ".")
+        try:
+            runs = []
+            with open(self.path, 'rb') as f:
+                header = f.readline() if self.header else b""
+                chunk = []
+                for line in f:
+                    if not line.strip():
+                        continue
+                    chunk.append(line if line.endswith(b"\n") else line + b"\n")
+                    if len(chunk) == self.chunk_lines:
+                        runs.append(self.__write_run(run_folder, len(runs), chunk))
+                        chunk = []
+                if chunk:
+                    runs.append(self.__write_run(run_folder, len(runs), chunk))
+            with ExitStack() as stack, open(spill_path + ".tmp", 'wb') as out:
+                files = [stack.enter_context(open(run, 'rb')) for run in runs]
+                out.write(header)
+                # heapq.merge is stable, equal users come from the earlier run first, i.e. in file order
+                out.writelines(heapq.merge(*files, key=self.__key))
+            os.replace(spill_path + ".tmp", spill_path)
+        finally:
+            shutil.rmtree(run_folder, ignore_errors=True)
+        logging.info(f"Sorted {len(runs)} runs into {spill_path}")
+        return spill_path
+
+    def __write_run(self, folder: str, index: int, chunk: list[bytes]) -> str:
+        path = os.path.join(folder, f"run-{index:05d}")
+        chunk.sort(key=self.__key)
+        with open(path, 'wb') as f:
+            f.writelines(chunk)
+        return path
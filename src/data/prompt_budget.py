@@ -0,0 +1,161 @@
+import math
+from collections.abc import Callable, Sequence
+from typing import Literal, NamedTuple
+
+import numpy as np
+
+Strategy = Literal["recent", "extreme", "stratified"]
+STRATEGIES = ("recent", "extreme", "stratified")
+
+
+def approximate_token_count(text: str) -> int:
+    """
+    Estimates the number of tokens of the text offline, assuming about four characters per token.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return math.ceil(len(text) / 4)
+
+
+def tiktoken_counter(model: str = "gpt-3.5-turbo") -> Callable[[str], int]:
+    """
+    Returns an exact token counter for the OpenAI model. Requires the optional tiktoken package.
+
+    Args:
+        model (str, optional): The model whose tokenizer is used. Defaults to "gpt-3.5-turbo".
+
+    Returns:
+        Callable[[str], int]: The function counting the tokens of a text.
+    """
+    try:
+        import tiktoken
+    except ImportError as e:
+        raise ImportError("The tiktoken token counter requires the tiktoken package, "
+                          "install it with `pip install tiktoken`") from e
+    encoding = tiktoken.encoding_for_model(model)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class BudgetedPrompt(NamedTuple):
+    """
+    The prompt of a user rendered within a token budget.
+
+    Attributes:
+        text (str): The rendered prompt.
+        tokens (int | None): The number of tokens of the prompt, None if no budget is applied.
+        items (int): The number of rated items kept in the prompt.
+        total_items (int): The number of rated items of the user.
+    """
+    text: str
+    tokens: int | None
+    items: int
+    total_items: int
+
+
+class PromptBudget:
+    """
+    A class used to fit the prompt of a user into a token budget.
+
+    Users whose full prompt fits the budget are rendered unchanged. For heavier users the rated items are ranked by
+    the strategy, the longest prefix of the ranking that fits is kept and the kept items are rendered in their original
+    order:
+
+    - "recent" keeps the latest ratings.
+    - "extreme" keeps the ratings farthest from the user's mean rating first, the latest first among equals.
+    - "stratified" keeps the rating distribution of the user, taking the latest items of every rating level.
+
+    Attributes:
+        max_tokens (int): The maximum number of tokens of the prompt.
+        strategy (str): The strategy ranking the rated items.
+        token_counter (Callable[[str], int]): The function counting the tokens of a text.
+
+    Methods:
+        rank(ratings, timestamps): Returns the item positions from the most to the least important one.
+        fit(render, entries, ratings, timestamps): Renders the entries within the budget.
+    """
+
+    def __init__(self,
+                 max_tokens: int,
+                 strategy: Strategy = "recent",
+                 token_counter: Callable[[str], int] = approximate_token_count):
+        """
+        Initializes the PromptBudget with the provided budget, strategy and token counter.
+
+        Args:
+            max_tokens (int): The maximum number of tokens of the prompt.
+            strategy (str, optional): The strategy ranking the rated items. Defaults to "recent".
+            token_counter (Callable[[str], int], optional): The function counting the tokens of a text.
+                Defaults to approximate_token_count.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown prompt strategy {strategy}, expected one of {', '.join(STRATEGIES)}")
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.token_counter = token_counter
+
+    def rank(self, ratings: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+        """
+        Returns the item positions from the most to the least important one according to the strategy.
+
+        Args:
+            ratings (np.ndarray): The ratings of the items.
+            timestamps (np.ndarray): The timestamps of the ratings.
+
+        Returns:
+            np.ndarray: The ranked positions of the items.
+        """
+        ratings = np.asarray(ratings, dtype=np.float64)
+        recency = -np.asarray(timestamps, dtype=np.float64)
+        match self.strategy:
+            case "recent":
+                return np.argsort(recency, kind='stable')
+            case "extreme":
+                return np.lexsort((recency, -np.abs(ratings - ratings.mean())))
+            case "stratified":
+                by_level = np.lexsort((recency, ratings))
+                levels = ratings[by_level]
+                starts = np.flatnonzero(np.r_[True, levels[1:] != levels[:-1]])
+                sizes = np.diff(np.r_[starts, len(levels)])
+                rank_in_level = np.arange(len(levels)) - np.repeat(starts, sizes)
+                share = (rank_in_level + 0.5) / np.repeat(sizes, sizes)
+                return by_level[np.lexsort((-levels, share))]
+
+    def fit(self,
+            render: Callable[[list], str],
+            entries: Sequence,
+            ratings: np.ndarray,
+            timestamps: np.ndarray) -> BudgetedPrompt:
+        """
+        Renders the entries of a user within the budget.
+
+        Args:
+            render (Callable[[list], str]): The function rendering a list of entries into the prompt.
+            entries (Sequence): The rated items of the user in their original order.
+            ratings (np.ndarray): The rating of every entry.
+            timestamps (np.ndarray): The timestamp of every entry.
+
+        Returns:
+            BudgetedPrompt: The prompt with its token count and the number of kept items.
+        """
+        entries = list(entries)
+        text = render(entries)
+        tokens = self.token_counter(text)
+        if tokens <= self.max_tokens:
+            return BudgetedPrompt(text, tokens, len(entries), len(entries))
+
+        # token counts are close to additive, so the cost of every entry is its share of a single-entry prompt
+        ranked = self.rank(ratings, timestamps)
+        empty = self.token_counter(render([]))
+        costs = np.array([self.token_counter(render([entries[i]])) - empty for i in ranked.tolist()])
+        keep = int(np.searchsorted(np.cumsum(np.maximum(costs, 1)), self.max_tokens - empty, side='right'))
+        while True:
+            kept = [entries[i] for i in np.sort(ranked[:keep]).tolist()]
+            text = render(kept)
+            tokens = self.token_counter(text)
+            if tokens <= self.max_tokens or keep == 0:
+                return BudgetedPrompt(text, tokens, keep, len(entries))
+            keep -= max(1, keep // 20)
@@ -0,0 +1,60 @@
+from collections.abc import Sequence
+
+import numpy as np
+
+from src.storage.quantization import STORAGE_DTYPES, decode, encode, row_bytes, truncate
+from src.storage.user_index import UserIndex
+
+
+def compression_report(vectors: np.ndarray, dimensions: Sequence[int | None] = (None,),
+                       dtypes: Sequence[str] = STORAGE_DTYPES, k: int = 10, queries: int = 1000,
+                       seed: int = 0) -> list[dict]:
+    """
+    Measures the memory saved and the similar-user recall lost by every combination of a reduced dimension and a
+    storage dtype against the full float32 embeddings.
+
+    The ground truth is the exact top-k similar users of a sample of query users under the full float32 embeddings,
+    every variant is truncated, encoded and decoded the way encode.py stores it and searched exactly as well, so the
+    recall measures the loss of the representation alone.
+
+    Args:
+        vectors (np.ndarray): The full float32 embeddings, one row per user.
+        dimensions (Sequence[int | None], optional): The reduced dimensions, None is the full one. Defaults to (None,).
+        dtypes (Sequence[str], optional): The storage dtypes. Defaults to every one of STORAGE_DTYPES.
+        k (int, optional): The number of similar users per query. Defaults to 10.
+        queries (int, optional): The number of query users. Defaults to 1000.
+        seed (int, optional): The random seed of the query sample. Defaults to 0.
+
+    Returns:
+        list[dict]: One entry per variant with its bytes per user, total size, memory saved and recall@k.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    users, full_dim = vectors.shape
+    rows = np.random.default_rng(seed).choice(users, min(queries, users), replace=False)
+    truth = _neighbours(vectors, rows, k)
+    baseline = users * row_bytes("float32", full_dim)
+    report = []
+    for dim in dimensions:
+        reduced = truncate(vectors, dim)
+        dim = reduced.shape[1]
+        for dtype in dtypes:
+            stored = decode(encode(reduced, dtype), dtype, dim)
+            found = _neighbours(stored, rows, k)
+            recall = np.mean([len(found_rows & true_rows) / len(true_rows)
+                              for found_rows, true_rows in zip(found, truth, strict=True)])
+            size = users * row_bytes(dtype, dim)
+            report.append({"dimensions": dim,
+                           "dtype": dtype,
+                           "bytes_per_user": row_bytes(dtype, dim),
+                           "megabytes": round(size / 2 ** 20, 2),
+                           "memory_saved": round(1 - size / baseline, 4),
+                           f"recall@{k}": round(float(recall), 4),
+                           "recall_lost": round(1 - float(recall), 4)})
+    return report
+
+
+def _neighbours(vectors: np.ndarray, rows: np.ndarray, k: int) -> list[set]:
+    # the exact top-k rows of every query row, without the query itself
+    index = UserIndex(list(range(len(vectors))), vectors)
+    found, _ = index.search(index.vectors[rows], k + 1, exact=True)
+    return [set([row for row in found_rows if row != query][:k]) for query, found_rows in zip(rows, found, strict=True)]
@@ -0,0 +1,210 @@
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import numpy as np
+
+from src.data.interaction_matrix import InteractionMatrix
+
+SCORERS = ("knn", "projection", "popularity")
+SPLITS = ("user", "global")
+
+
+class HoldoutSplit(NamedTuple):
+    """
+    The train and test interactions of a temporal holdout, both in CSR layout over the rows of the matrix.
+    """
+    train_ptr: np.ndarray
+    train_items: np.ndarray
+    test_ptr: np.ndarray
+    test_items: np.ndarray
+    n_items: int
+
+
+def temporal_split(matrix: InteractionMatrix, test_fraction: float = 0.2, split: str = "user",
+                   min_rating: float | None = None) -> HoldoutSplit:
+    """
+    Splits the interactions of every user by time.
+
+    With split "user" the latest test_fraction of the interactions of every user, at least one, are held out. With
+    split "global" every interaction after the (1 - test_fraction) quantile of all timestamps is held out. Held-out
+    interactions rated below min_rating are dropped.
+
+    Args:
+        matrix (InteractionMatrix): The interactions.
+        test_fraction (float, optional): The fraction of held-out interactions. Defaults to 0.2.
+        split (str, optional): "user" or "global". Defaults to "user".
+        min_rating (float, optional): The lowest rating of a relevant held-out item. Defaults to None.
+
+    Returns:
+        HoldoutSplit: The train and test interactions.
+    """
+    lengths = np.diff(matrix.user_ptr)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    order = np.lexsort((matrix.timestamp, rows))
+    match split:
+        case "user":
+            position = np.arange(len(order)) - matrix.user_ptr[rows]
+            held_out = np.where(lengths > 1, np.maximum((lengths * test_fraction).astype(np.int64), 1), 0)
+            test = position >= (lengths - held_out)[rows]
+        case "global":
+            test = matrix.timestamp[order] > np.quantile(matrix.timestamp, 1 - test_fraction)
+        case _:
+            raise ValueError(f"Unknown split {split}, expected one of {SPLITS}")
+    relevant = test.copy()
+    if min_rating is not None:
+        relevant &= matrix.rating[order] >= min_rating
+    items = matrix.item_idx[order]
+    n_items = len(matrix.items)
+    return HoldoutSplit(train_ptr=_offsets(rows[~test], len(lengths)), train_items=items[~test],
+                        test_ptr=_offsets(rows[relevant], len(lengths)), test_items=items[relevant], n_items=n_items)
+
+
+class RecommendationEvaluator:
+    """
+    A class used to measure how well user embeddings recommend the held-out items of a temporal split.
+
+    Items are scored for blocks of users at once: "knn" sums the train items of the most similar users weighted by
+    the cosine similarity of their embeddings, "projection" ranks items by the cosine similarity between the user
+    embedding and the mean embedding of the users who interacted with the item and "popularity" is the embedding-free
+    baseline. Train items are never recommended. Recall@k, NDCG@k and hit rate@k are averaged over the users with
+    an embedding, train interactions and relevant held-out items.
+
+    Attributes:
+        matrix (InteractionMatrix): The interactions.
+        split (HoldoutSplit): The train and test interactions.
+
+    Methods:
+        evaluate(user_ids, vectors, ks, scorer, neighbours): Computes the metrics of the embeddings.
+    """
+
+    BLOCK_ELEMENTS = 1 << 22
+
+    def __init__(self, matrix: InteractionMatrix, test_fraction: float = 0.2, split: str = "user",
+                 min_rating: float | None = None):
+        """
+        Initializes the RecommendationEvaluator and splits the interactions.
+
+        Args:
+            matrix (InteractionMatrix): The interactions.
+            test_fraction (float, optional): The fraction of held-out interactions. Defaults to 0.2.
+            split (str, optional): "user" or "global". Defaults to "user".
+            min_rating (float, optional): The lowest rating of a relevant held-out item. Defaults to None.
+        """
+        self.matrix = matrix
+        self.split = temporal_split(matrix, test_fraction=test_fraction, split=split, min_rating=min_rating)
+
+    def evaluate(self, user_ids: Sequence, vectors: np.ndarray, ks: Sequence[int] = (10, 20), scorer: str = "knn",
+                 neighbours: int = 50) -> dict:
+        """
+        Computes recall@k, NDCG@k and hit rate@k of the embeddings.
+
+        Args:
+            user_ids (Sequence): The user id of every embedding.
+            vectors (np.ndarray): The embeddings, one row per user.
+            ks (Sequence[int], optional): The cutoffs. Defaults to (10, 20).
+            scorer (str, optional): "knn", "projection" or "popularity". Defaults to "knn".
+            neighbours (int, optional): The number of similar users of the knn scorer. Defaults to 50.
+
+        Returns:
+            dict: The metrics and the number of evaluated users.
+        """
+        if scorer not in SCORERS:
+            raise ValueError(f"Unknown scorer {scorer}, expected one of {SCORERS}")
+        split = self.split
+        embeddings, known = self.__align(user_ids, vectors)
+        train_lengths, test_lengths = np.diff(split.train_ptr), np.diff(split.test_ptr)
+        queries = np.flatnonzero(known & (train_lengths > 0) & (test_lengths > 0))
+        max_k = max(ks)
+        items = None
+        if scorer == "projection":
+            items = self.__item_vectors(embeddings)
+        elif scorer == "popularity":
+            items = np.bincount(split.train_items, minlength=split.n_items).astype(np.float32)
+        candidates = np.flatnonzero(known & (train_lengths > 0))
+
+        totals = {f"{metric}@{k}": 0.0 for k in ks for metric in ("recall", "ndcg", "hit_rate")}
+        discounts = 1 / np.log2(np.arange(2, max_k + 2))
+        ideal = np.cumsum(discounts)
+        gathered = neighbours * train_lengths.mean() if scorer == "knn" else 0
+        block = max(1, int(self.BLOCK_ELEMENTS // max(split.n_items, len(candidates), gathered, 1)))
+        for start in range(0, len(queries), block):
+            rows = queries[start:start + block]
+            match scorer:
+                case "knn":
+                    scores = self.__knn_scores(rows, embeddings, candidates, neighbours)
+                case "projection":
+                    scores = embeddings[rows] @ items.T
+                case "popularity":
+                    scores = np.repeat(items[None, :], len(rows), axis=0)
+            local, seen = _gather(split.train_ptr, split.train_items, rows)
+            scores[local, seen] = -np.inf
+            top = np.argpartition(-scores, max_k - 1, axis=1)[:, :max_k]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+            relevant = np.zeros(scores.shape, dtype=bool)
+            local, held_out = _gather(split.test_ptr, split.test_items, rows)
+            relevant[local, held_out] = True
+            hits = np.take_along_axis(relevant, top, axis=1)
+            n_relevant = test_lengths[rows]
+            for k in ks:
+                found = hits[:, :k].sum(axis=1)
+                totals[f"recall@{k}"] += (found / n_relevant).sum()
+                totals[f"ndcg@{k}"] += ((hits[:, :k] @ discounts[:k]) / ideal[np.minimum(n_relevant, k) - 1]).sum()
+                totals[f"hit_rate@{k}"] += (found > 0).sum()
+        report = {name: round(float(total / max(len(queries), 1)), 6) for name, total in totals.items()}
+        return {"scorer": scorer, "users": int(len(queries)), "users_without_embedding": int((~known).sum()),
+                **report}
+
+    def __align(self, user_ids: Sequence, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        embeddings = np.zeros((len(self.matrix), vectors.shape[1] if vectors.ndim == 2 else 0), dtype=np.float32)
+        known = np.zeros(len(self.matrix), dtype=bool)
+        pairs = [(row, self.matrix.user_index[user_id]) for row, user_id in enumerate(user_ids)
+                 if user_id in self.matrix.user_index]
+        if pairs:
+            source, target = np.array(pairs, dtype=np.int64).T
+            embeddings[target] = vectors[source]
+            known[target] = True
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms), known & (norms[:, 0] > 0)
+
+    def __item_vectors(self, embeddings: np.ndarray) -> np.ndarray:
+        split = self.split
+        order = np.argsort(split.train_items, kind='stable')
+        users = np.repeat(np.arange(len(split.train_ptr) - 1), np.diff(split.train_ptr))[order]
+        items = split.train_items[order]
+        vectors = np.zeros((split.n_items, embeddings.shape[1]), dtype=np.float32)
+        chunk = 2048
+        for start in range(0, len(items), chunk):
+            # the interactions are sorted by item, a one-hot matrix multiplication sums the users of every item
+            chunk_items, position = np.unique(items[start:start + chunk], return_inverse=True)
+            one_hot = np.zeros((len(chunk_items), len(position)), dtype=np.float32)
+            one_hot[position, np.arange(len(position))] = 1
+            vectors[chunk_items] += one_hot @ embeddings[users[start:start + chunk]]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def __knn_scores(self, rows: np.ndarray, embeddings: np.ndarray, candidates: np.ndarray,
+                     neighbours: int) -> np.ndarray:
+        similarity = embeddings[rows] @ embeddings[candidates].T
+        similarity[candidates[None, :] == rows[:, None]] = -np.inf
+        count = min(neighbours, len(candidates))
+        nearest = np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+        weights = np.maximum(np.take_along_axis(similarity, nearest, axis=1), 0)
+        local, items = _gather(self.split.train_ptr, self.split.train_items, candidates[nearest].reshape(-1))
+        flat_weights = weights.reshape(-1)[local]
+        queries = local // count
+        scores = np.bincount(queries * self.split.n_items + items, weights=flat_weights,
+                             minlength=len(rows) * self.split.n_items)
+        return scores.reshape(len(rows), self.split.n_items).astype(np.float32)
+
+
+def _offsets(rows: np.ndarray, n_rows: int) -> np.ndarray:
+    return np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_rows)))).astype(np.int64)
+
+
+def _gather(ptr: np.ndarray, values: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # the CSR values of several rows at once, with the position of their row in rows
+    lengths = ptr[rows + 1] - ptr[rows]
+    local = np.repeat(np.arange(len(rows)), lengths)
+    starts = np.repeat(ptr[rows] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return local, values[starts + np.arange(lengths.sum())]
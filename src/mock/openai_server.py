@@ -0,0 +1,363 @@
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+
+class LatencyModel:
+    """
+    A class used to sample the latency of a mocked request.
+
+    Attributes:
+        distribution (str): The distribution of the base latency, "fixed", "uniform" or "lognormal".
+        median (float): The median base latency in seconds.
+        spread (float): The half-width of the uniform distribution or the sigma of the lognormal one.
+        per_token (float): The additional latency in seconds per generated or embedded token.
+
+    Methods:
+        parse(value: str): Parses a latency model given as "distribution:median[:spread[:per_token]]".
+        sample(tokens: int, rng: random.Random): Samples the latency of a request.
+    """
+
+    def __init__(self, distribution: str = "lognormal", median: float = 0.5, spread: float = 0.5,
+                 per_token: float = 0.0):
+        """
+        Initializes the LatencyModel with the provided distribution.
+
+        Args:
+            distribution (str, optional): The distribution of the base latency. Defaults to "lognormal".
+            median (float, optional): The median base latency in seconds. Defaults to 0.5.
+            spread (float, optional): The half-width or sigma of the distribution. Defaults to 0.5.
+            per_token (float, optional): The additional latency per token in seconds. Defaults to 0.0.
+        """
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution {distribution}")
+        self.distribution = distribution
+        self.median = median
+        self.spread = spread
+        self.per_token = per_token
+
+    @classmethod
+    def parse(cls, value: str) -> "LatencyModel":
+        """
+        Parses a latency model given as "distribution:median[:spread[:per_token]]", e.g. "lognormal:0.8:0.6".
+
+        Args:
+            value (str): The latency model specification.
+
+        Returns:
+            LatencyModel: The parsed model.
+        """
+        distribution, *numbers = value.split(":")
+        return cls(distribution, *(float(number) for number in numbers))
+
+    def sample(self, tokens: int, rng: random.Random) -> float:
+        """
+        Samples the latency of a request.
+
+        Args:
+            tokens (int): The number of generated or embedded tokens.
+            rng (random.Random): The random generator.
+
+        Returns:
+            float: The latency in seconds.
+        """
+        match self.distribution:
+            case "fixed":
+                base = self.median
+            case "uniform":
+                base = rng.uniform(max(self.median - self.spread, 0), self.median + self.spread)
+            case "lognormal":
+                base = self.median * math.exp(rng.gauss(0, self.spread))
+        return base + self.per_token * tokens
+
+
+def fake_embedding(text: str, dimensions: int) -> list[float]:
+    """
+    Returns a deterministic unit-norm pseudo-embedding of the text.
+
+    Args:
+        text (str): The embedded text.
+        dimensions (int): The dimension of the embedding.
+
+    Returns:
+        list[float]: The embedding, identical for identical texts.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_description(messages: list, words: int) -> str:
+    """
+    Returns a deterministic pseudo-description of the prompt.
+
+    Args:
+        messages (list): The prompt messages.
+        words (int): The number of words of the description.
+
+    Returns:
+        str: The description, identical for identical prompts.
+    """
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+    vocabulary = ["user", "enjoys", "prefers", "classic", "modern", "genres", "artists", "dislikes", "often", "rates"]
+    body = " ".join(vocabulary[int(digest[i % 64], 16) % len(vocabulary)] for i in range(max(words - 1, 0)))
+    return f"Profile {digest[:12]}: {body}".strip()
+
+
+class MockOpenAIServer:
+    """
+    A class used to serve an OpenAI-compatible stand-in for /v1/chat/completions and /v1/embeddings on localhost.
+
+    Responses are deterministic functions of the requests, latencies follow configurable distributions and 429
+    responses are injected either at random or when a requests-per-minute limit is exceeded. Chat prompts go through a
+    simulated provider prefix cache: like the OpenAI one, it matches prompt prefixes of at least
+    prefix_cache_min_tokens tokens in steps of 128 tokens and reports the hits as cached_tokens. GET /stats returns
+    the request counters.
+
+    Attributes:
+        host (str): The interface the server listens on.
+        port (int): The port of the server, chosen by the OS if 0.
+        chat_latency (LatencyModel): The latency of chat completions.
+        embedding_latency (LatencyModel): The latency of embedding requests.
+        error_rate (float): The probability of answering a request with a 429.
+        requests_per_minute (int | None): The limit above which requests are answered with a 429.
+        description_words (int): The number of words of the generated descriptions.
+        dimensions (int): The default embedding dimension.
+        prefix_cache_min_tokens (int | None): The shortest cached prompt prefix in tokens, None disables the cache.
+        stats (dict): The request counters.
+
+    Methods:
+        start(): Starts serving in a background thread.
+        stop(): Stops the server.
+        serve_forever(): Serves in the current thread.
+        handle(path: str, body: dict): Answers a POST request.
+        url: Returns the base URL to pass to the OpenAI client.
+        latencies(kind: str): Returns the sampled latencies of the served requests.
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 chat_latency: LatencyModel | None = None,
+                 embedding_latency: LatencyModel | None = None,
+                 error_rate: float = 0.0,
+                 requests_per_minute: int | None = None,
+                 description_words: int = 300,
+                 dimensions: int = 1536,
+                 prefix_cache_min_tokens: int | None = 1024,
+                 seed: int = 0):
+        """
+        Initializes the MockOpenAIServer and binds its socket.
+
+        Args:
+            host (str, optional): The interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on, 0 lets the OS choose. Defaults to 0.
+            chat_latency (LatencyModel, optional): The latency of chat completions. Defaults to lognormal around 1s.
+            embedding_latency (LatencyModel, optional): The latency of embeddings. Defaults to lognormal around 0.2s.
+            error_rate (float, optional): The probability of a 429 response. Defaults to 0.0.
+            requests_per_minute (int, optional): The limit above which requests get a 429. Defaults to None.
+            description_words (int, optional): The number of words of the descriptions. Defaults to 300.
+            dimensions (int, optional): The default embedding dimension. Defaults to 1536.
+            prefix_cache_min_tokens (int, optional): The shortest cached prompt prefix in tokens. Defaults to 1024.
+            seed (int, optional): The seed of the latency and error sampling. Defaults to 0.
+        """
+        self.host = host
+        self.chat_latency = chat_latency or LatencyModel("lognormal", 1.0, 0.4)
+        self.embedding_latency = embedding_latency or LatencyModel("lognormal", 0.2, 0.3)
+        self.error_rate = error_rate
+        self.requests_per_minute = requests_per_minute
+        self.description_words = description_words
+        self.dimensions = dimensions
+        self.prefix_cache_min_tokens = prefix_cache_min_tokens
+        self.stats = {"chat": 0, "embedding": 0, "embedding_inputs": 0, "rate_limited": 0, "cached_tokens": 0}
+        self.__prefixes = set()
+        self.__latencies = {"chat": [], "embedding": []}
+        self.__recent = deque()
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__server = ThreadingHTTPServer((host, port), self.__handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def latencies(self, kind: str) -> list[float]:
+        """
+        Returns the sampled latencies of the served requests.
+
+        Args:
+            kind (str): The kind of the requests, "chat" or "embedding".
+
+        Returns:
+            list[float]: The latencies in seconds.
+        """
+        with self.__lock:
+            return list(self.__latencies[kind])
+
+    def start(self) -> "MockOpenAIServer":
+        """
+        Starts serving in a background thread.
+
+        Returns:
+            MockOpenAIServer: The server itself.
+        """
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def serve_forever(self):
+        """
+        Serves in the current thread until interrupted.
+        """
+        self.__server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def handle(self, path: str, body: dict) -> tuple[int, dict, dict]:
+        """
+        Answers a POST request after its simulated latency.
+
+        Args:
+            path (str): The request path.
+            body (dict): The JSON request body.
+
+        Returns:
+            tuple[int, dict, dict]: The status code, the JSON response and the extra headers.
+        """
+        if not self.__admit():
+            time.sleep(0.01)
+            return 429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                   "code": "rate_limit_exceeded"}}, {"retry-after-ms": "100"}
+        if path.endswith("/chat/completions"):
+            kind = "chat"
+            content = fake_description(body["messages"], self.description_words)
+            prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+            completion_tokens = len(content) // 4
+            cached_tokens = self.__cached_prefix(body["messages"], prompt_tokens)
+            tokens = completion_tokens
+            response = {"id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens,
+                                  "prompt_tokens_details": {"cached_tokens": cached_tokens}}}
+        elif path.endswith("/embeddings"):
+            kind = "embedding"
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            dimensions = body.get("dimensions", self.dimensions)
+            tokens = sum(len(text) for text in texts) // 4
+            response = {"object": "list", "model": body.get("model", "mock"),
+                        "data": [{"object": "embedding", "index": index, "embedding": fake_embedding(text, dimensions)}
+                                 for index, text in enumerate(texts)],
+                        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+        else:
+            return 404, {"error": {"message": f"Unknown endpoint {path}"}}, {}
+        latency_model = self.chat_latency if kind == "chat" else self.embedding_latency
+        with self.__lock:
+            latency = latency_model.sample(tokens, self.__rng)
+            self.stats[kind] += 1
+            if kind == "chat":
+                self.stats["cached_tokens"] += cached_tokens
+            if kind == "embedding":
+                self.stats["embedding_inputs"] += len(body["input"]) if isinstance(body["input"], list) else 1
+            self.__latencies[kind].append(latency)
+        time.sleep(latency)
+        return 200, response, {}
+
+    def __cached_prefix(self, messages: list, prompt_tokens: int) -> int:
+        if self.prefix_cache_min_tokens is None or prompt_tokens < self.prefix_cache_min_tokens:
+            return 0
+        text = "".join(f"{message['role']}\n{message['content']}\n" for message in messages)
+        prefixes = [hashlib.sha1(text[:4 * length].encode("utf-8"), usedforsecurity=False).digest()
+                    for length in range(self.prefix_cache_min_tokens, prompt_tokens + 1, 128)]
+        with self.__lock:
+            hits = [prefix in self.__prefixes for prefix in prefixes]
+            self.__prefixes.update(prefixes)
+        return self.prefix_cache_min_tokens + 128 * (len(hits) - 1 - hits[::-1].index(True)) if any(hits) else 0
+
+    def __admit(self) -> bool:
+        with self.__lock:
+            now = time.monotonic()
+            while self.__recent and now - self.__recent[0] > 60:
+                self.__recent.popleft()
+            limited = self.__rng.random() < self.error_rate
+            if self.requests_per_minute is not None and len(self.__recent) >= self.requests_per_minute:
+                limited = True
+            if limited:
+                self.stats["rate_limited"] += 1
+            else:
+                self.__recent.append(now)
+            return not limited
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):  # noqa: A002
+                pass
+
+            def do_GET(self):  # noqa: N802
+                self.__send(200, server.stats)
+
+            def do_POST(self):  # noqa: N802
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                self.__send(*server.handle(self.path, body))
+
+            def __send(self, status: int, payload: dict, headers: dict | None = None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Serve a local OpenAI-compatible mock for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chat-latency", type=LatencyModel.parse, default=LatencyModel("lognormal", 1.0, 0.4),
+                        help="distribution:median[:spread[:per_token]] with distribution fixed, uniform or lognormal")
+    parser.add_argument("--embedding-latency", type=LatencyModel.parse, default=LatencyModel("lognormal", 0.2, 0.3),
+                        help="distribution:median[:spread[:per_token]] with distribution fixed, uniform or lognormal")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of answering with a 429")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute above which 429s are returned")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Default embedding dimension")
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=1024,
+                        help="Shortest prompt prefix served from the simulated prefix cache")
+    args = parser.parse_args()
+    mock = MockOpenAIServer(host=args.host, port=args.port, chat_latency=args.chat_latency,
+                            embedding_latency=args.embedding_latency, error_rate=args.error_rate,
+                            requests_per_minute=args.rpm, dimensions=args.dimensions,
+                            prefix_cache_min_tokens=args.prefix_cache_min_tokens)
+    logging.info(f"Serving the mock OpenAI API at {mock.url}")
+    mock.serve_forever()
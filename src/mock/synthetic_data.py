@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.movie.movie_user import AGE_DICT
+
+GENRES = ["Action", "Adventure", "Animation", "Children's", "Comedy", "Crime", "Documentary", "Drama", "Fantasy",
+          "Film-Noir", "Horror", "Musical", "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+MUSIC_CATEGORIES = ["Rock", "Pop", "Jazz", "Classical", "Country", "Blues", "Folk", "Metal", "Soul", "Electronic"]
+
+
+def interaction_counts(n_users: int, mean: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Draws heavy-tailed numbers of interactions per user, like real rating datasets with a few power users.
+
+    Args:
+        n_users (int): The number of users.
+        mean (int): The mean number of interactions per user.
+        rng (np.random.Generator): The random generator.
+
+    Returns:
+        np.ndarray: The number of interactions of every user, at least 1.
+    """
+    counts = rng.lognormal(mean=np.log(mean) - 0.5, sigma=1.0, size=n_users)
+    return np.maximum(counts.astype(np.int64), 1)
+
+
+def write_movielens(folder: str, n_users: int = 1000, n_movies: int = 2000, mean_ratings: int = 100,
+                    seed: int = 0) -> str:
+    """
+    Writes a synthetic dataset in the ml-1m layout: users.dat, movies.dat and ratings.dat.
+
+    Args:
+        folder (str): The folder for the dataset files.
+        n_users (int, optional): The number of users. Defaults to 1000.
+        n_movies (int, optional): The number of movies. Defaults to 2000.
+        mean_ratings (int, optional): The mean number of ratings per user. Defaults to 100.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        str: The folder.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    user_ids = np.arange(1, n_users + 1)
+    users = pd.DataFrame({"user_id": user_ids,
+                          "gender": rng.choice(["M", "F"], n_users),
+                          "age": rng.choice(list(AGE_DICT), n_users),
+                          "occupation": rng.integers(0, 21, n_users),
+                          "zip_code": rng.integers(10000, 99999, n_users)})
+    movie_ids = np.arange(1, n_movies + 1)
+    years = rng.integers(1920, 2001, n_movies)
+    genres = ["|".join(rng.choice(GENRES, rng.integers(1, 4), replace=False)) for _ in range(n_movies)]
+    titles = [f"Movie {movie_id} ({year})" for movie_id, year in zip(movie_ids, years, strict=True)]
+    movies = pd.DataFrame({"movie_id": movie_ids,
+                           "title": titles,
+                           "genres": genres})
+    counts = np.minimum(interaction_counts(n_users, mean_ratings, rng), n_movies)
+    ratings = pd.DataFrame({"user_id": np.repeat(user_ids, counts),
+                            "movie_id": np.concatenate([rng.choice(movie_ids, count, replace=False)
+                                                        for count in counts]),
+                            "rating": rng.integers(1, 6, counts.sum()),
+                            "timestamp": rng.integers(956703932, 1046454590, counts.sum())})
+    for name, frame in (("users", users), ("movies", movies), ("ratings", ratings)):
+        lines = frame.astype(str).agg("::".join, axis=1)
+        with open(os.path.join(folder, f"{name}.dat"), 'w', encoding='latin-1') as f:
+            f.write("\n".join(lines) + "\n")
+    return folder
+
+
+def write_amazon(folder: str, n_users: int = 1000, n_items: int = 5000, mean_ratings: int = 20,
+                 seed: int = 0) -> str:
+    """
+    Writes a synthetic dataset in the Amazon CD's and Vinyl layout: Amazon_CDs_and_Vinyl.item and .inter.
+
+    Args:
+        folder (str): The folder for the dataset files.
+        n_users (int, optional): The number of users. Defaults to 1000.
+        n_items (int, optional): The number of items. Defaults to 5000.
+        mean_ratings (int, optional): The mean number of ratings per user. Defaults to 20.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        str: The folder.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    item_ids = np.array([f"{item:010d}" for item in range(1, n_items + 1)])
+    categories = [str(list(rng.choice(MUSIC_CATEGORIES, rng.integers(0, 3), replace=False))) for _ in range(n_items)]
+    items = pd.DataFrame({"item_id:token": item_ids,
+                          "title:token_seq": [f"Album {item}" for item in range(1, n_items + 1)],
+                          "sales_type:token": "CDs & Vinyl",
+                          "brand:token_seq": [f"Band {band}" for band in rng.integers(1, n_items // 5 + 2, n_items)],
+                          "categories:token_seq": categories})
+    items.to_csv(os.path.join(folder, "Amazon_CDs_and_Vinyl.item"), sep='\t', index=False)
+    counts = np.minimum(interaction_counts(n_users, mean_ratings, rng), n_items)
+    user_ids = np.array([f"U{user:07d}" for user in range(n_users)])
+    interactions = pd.DataFrame({"user_id:token": np.repeat(user_ids, counts),
+                                 "item_id:token": np.concatenate([rng.choice(item_ids, count, replace=False)
+                                                                  for count in counts]),
+                                 "rating:float": rng.integers(1, 6, counts.sum()).astype(float),
+                                 "timestamp:float": rng.integers(900000000, 1500000000, counts.sum()).astype(float)})
+    interactions.sample(frac=1, random_state=seed).to_csv(os.path.join(folder, "Amazon_CDs_and_Vinyl.inter"),
+                                                          sep='\t', index=False)
+    return folder
@@ -0,0 +1,380 @@
+from contextlib import contextmanager
+from collections.abc import Callable, Iterable, Iterator
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PREFIX = "llm_user_encoder"
+
+
+class Histogram:
+    """
+    A class used to accumulate observations into cumulative buckets, the layout of a Prometheus histogram.
+
+    Attributes:
+        buckets (tuple[float, ...]): The upper bounds of the buckets, +Inf is implicit.
+        counts (list[int]): The number of observations per bucket, the last one is +Inf.
+        count (int): The number of observations.
+        sum (float): The sum of the observations.
+        max (float): The largest observation.
+
+    Methods:
+        observe(value: float): Adds an observation.
+        quantile(q: float): Returns the upper bound of the bucket holding the quantile.
+        summary(): Returns the count, the sum, the mean, the median, the 95th percentile and the maximum.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        """
+        Initializes an empty Histogram.
+
+        Args:
+            buckets (tuple[float, ...], optional): The upper bounds of the buckets. Defaults to BUCKETS.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """
+        Adds an observation.
+
+        Args:
+            value (float): The observed value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Returns the upper bound of the bucket holding the quantile, the maximum for the +Inf bucket.
+
+        Args:
+            q (float): The quantile between 0 and 1.
+
+        Returns:
+            float | None: The bucket bound, None without observations.
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        # the +Inf count has no bound, the maximum stands for it below
+        for bound, count in zip(self.buckets, self.counts, strict=False):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 4)
+        return round(self.max, 4)
+
+    def summary(self) -> dict:
+        """
+        Returns the count, the sum, the mean, the median, the 95th percentile and the maximum.
+
+        Returns:
+            dict: The summary, the quantiles are bucket bounds.
+        """
+        return {"count": self.count,
+                "seconds": round(self.sum, 3),
+                "mean": round(self.sum / self.count, 4) if self.count else None,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "max": round(self.max, 4)}
+
+
+class RunMetrics:
+    """
+    A class used to measure where an encode run spends its time.
+
+    Stages are timed into wall time histograms, events such as tokens, retries, 429 responses or written bytes are
+    summed into counters with optional labels and gauges read the state of other components, e.g. the cache hits,
+    when a snapshot is taken. The progress of the run gives the users per second and the projected time left. A single
+    instance is meant to be shared by the agent, its adapters, the writer and encode.py, it is thread-safe.
+
+    Attributes:
+        started (float): The monotonic time the run started.
+        done (int): The number of users finished in this run.
+        failed (int): The number of users that failed in this run.
+        total (int | None): The number of users of this run, None while unknown.
+
+    Methods:
+        timer(stage: str): Context manager timing a stage.
+        timed(stage: str, items: Iterable): Yields the items and times the production of every item as the stage.
+        observe(stage: str, seconds: float): Adds a stage duration.
+        count(name: str, value: float = 1, **labels): Adds to a counter.
+        value(name: str, **labels): Returns the current value of a counter.
+        gauge(name: str, read: Callable[[], float]): Registers a value read at every snapshot.
+        progress(done: int = 0, failed: int = 0, total: int | None = None): Updates the progress of the run.
+        summary(): Returns a JSON-serializable snapshot.
+        prometheus(): Returns the snapshot in the Prometheus text format.
+        write(json_path: str | None, prometheus_path: str | None): Atomically writes the snapshot files.
+    """
+
+    def __init__(self):
+        """
+        Initializes the RunMetrics, the elapsed time of the run starts now.
+        """
+        self.started = time.monotonic()
+        self.done = 0
+        self.failed = 0
+        self.total = None
+        self.__stages = {}
+        self.__counters = {}
+        self.__gauges = {}
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Times the block as the stage, also when it raises. Blocks awaiting in a coroutine are timed in wall time.
+
+        Args:
+            stage (str): The name of the stage.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage: str, items: Iterable) -> Iterator:
+        """
+        Yields the items and times the production of every item as the stage, e.g. the lazy loading of users.
+
+        Args:
+            stage (str): The name of the stage.
+            items (Iterable): The items.
+
+        Yields:
+            The next item.
+        """
+        iterator = iter(items)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Adds a stage duration.
+
+        Args:
+            stage (str): The name of the stage.
+            seconds (float): The duration.
+        """
+        with self.__lock:
+            if stage not in self.__stages:
+                self.__stages[stage] = Histogram()
+            self.__stages[stage].observe(seconds)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Adds to a counter.
+
+        Args:
+            name (str): The name of the counter.
+            value (float, optional): The increment. Defaults to 1.
+            **labels: The labels of the counter, e.g. kind="chat".
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def value(self, name: str, **labels) -> float:
+        """
+        Returns the current value of a counter.
+
+        Args:
+            name (str): The name of the counter.
+            **labels: The labels of the counter, e.g. kind="chat".
+
+        Returns:
+            float: The value, 0 if the counter was never incremented.
+        """
+        with self.__lock:
+            return self.__counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        """
+        Registers a value read at every snapshot, replacing a gauge of the same name.
+
+        Args:
+            name (str): The name of the gauge.
+            read (Callable[[], float]): Returns the current value.
+        """
+        with self.__lock:
+            self.__gauges[name] = read
+
+    def progress(self, done: int = 0, failed: int = 0, total: int | None = None):
+        """
+        Updates the progress of the run.
+
+        Args:
+            done (int, optional): The number of newly finished users. Defaults to 0.
+            failed (int, optional): The number of newly failed users. Defaults to 0.
+            total (int, optional): The number of users of the run, if it became known. Defaults to None.
+        """
+        with self.__lock:
+            self.done += done
+            self.failed += failed
+            if total is not None:
+                self.total = total
+
+    def summary(self) -> dict:
+        """
+        Returns a JSON-serializable snapshot of the progress, the stages, the counters and the gauges.
+
+        Returns:
+            dict: The snapshot.
+        """
+        with self.__lock:
+            elapsed = time.monotonic() - self.started
+            finished = self.done + self.failed
+            rate = finished / elapsed if elapsed > 0 else 0.0
+            remaining = None if self.total is None else max(self.total - finished, 0)
+            counters = {}
+            for (name, labels), value in sorted(self.__counters.items()):
+                key = name + "".join(f"[{label}={label_value}]" for label, label_value in labels)
+                counters[key] = value
+            stages = {stage: histogram.summary() for stage, histogram in self.__stages.items()}
+            gauges = dict(self.__gauges)
+        return {"elapsed_seconds": round(elapsed, 3),
+                "users_done": self.done,
+                "users_failed": self.failed,
+                "users_total": self.total,
+                "users_per_second": round(rate, 3),
+                "eta_seconds": round(remaining / rate, 1) if remaining is not None and rate > 0 else None,
+                "stages": dict(sorted(stages.items(), key=lambda stage: -stage[1]["seconds"])),
+                "counters": counters,
+                "gauges": {name: read() for name, read in gauges.items()}}
+
+    def prometheus(self) -> str:
+        """
+        Returns the snapshot in the Prometheus text exposition format, e.g. for the textfile collector of the node
+        exporter.
+
+        Returns:
+            str: The metric families.
+        """
+        summary = self.summary()
+        lines = []
+        for name in ("elapsed_seconds", "users_done", "users_failed", "users_total", "users_per_second",
+                     "eta_seconds"):
+            if summary[name] is not None:
+                lines += [f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {summary[name]}"]
+        with self.__lock:
+            stages = {stage: (list(histogram.counts), histogram.count, histogram.sum)
+                      for stage, histogram in self.__stages.items()}
+            counters = sorted(self.__counters.items())
+        if stages:
+            lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+        for stage, (counts, count, total) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*BUCKETS, "+Inf"), counts, strict=True):
+                cumulative += bucket_count
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                typed.add(name)
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+            lines.append(f"{PREFIX}_{name}_total{{{label_text}}} {value}" if labels else
+                         f"{PREFIX}_{name}_total {value}")
+        for name, value in summary["gauges"].items():
+            lines += [f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path: str | None = None, prometheus_path: str | None = None):
+        """
+        Atomically writes the JSON summary and the Prometheus textfile, so readers never see a partial file.
+
+        Args:
+            json_path (str, optional): The file of the JSON summary. Defaults to None (not written).
+            prometheus_path (str, optional): The Prometheus textfile. Defaults to None (not written).
+        """
+        for path, content in ((json_path, lambda: json.dumps(self.summary(), indent=2)),
+                              (prometheus_path, self.prometheus)):
+            if path is None:
+                continue
+            with open(path + ".tmp", 'w') as f:
+                f.write(content())
+            os.replace(path + ".tmp", path)
+
+
+class MetricsExporter:
+    """
+    A class used to write the snapshot of RunMetrics periodically from a background thread.
+
+    Attributes:
+        metrics (RunMetrics): The metrics of the run.
+        json_path (str | None): The file of the JSON summary.
+        prometheus_path (str | None): The Prometheus textfile.
+        interval (float): The number of seconds between two snapshots.
+
+    Methods:
+        start(): Starts the background thread.
+        close(): Stops the thread and writes the final snapshot.
+    """
+
+    def __init__(self, metrics: RunMetrics, json_path: str | None = None, prometheus_path: str | None = None,
+                 interval: float = 30.0):
+        """
+        Initializes the MetricsExporter.
+
+        Args:
+            metrics (RunMetrics): The metrics of the run.
+            json_path (str, optional): The file of the JSON summary. Defaults to None (not written).
+            prometheus_path (str, optional): The Prometheus textfile. Defaults to None (not written).
+            interval (float, optional): The number of seconds between two snapshots. Defaults to 30.
+        """
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self) -> "MetricsExporter":
+        """
+        Starts the background thread writing a snapshot every interval seconds.
+
+        Returns:
+            MetricsExporter: The exporter itself.
+        """
+        self.__thread = threading.Thread(target=self.__run, name="metrics-exporter", daemon=True)
+        self.__thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops the background thread and writes the final snapshot.
+        """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.metrics.write(self.json_path, self.prometheus_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.metrics.write(self.json_path, self.prometheus_path)
+            except OSError as e:
+                logging.warning(f"Could not write the metrics: {e}")
@@ -1,23 +1,37 @@
+from collections.abc import Iterator
+from itertools import pairwise
 import logging
-import os
+import numpy as np
 import pandas as pd
 
-from src.movie.movie_user import MovieUser
+from src.data.catalog_item import CatalogItem
+from src.data.interaction_matrix import InteractionMatrix
+from src.data.interaction_stream import InteractionStream
+from src.data.prompt_budget import PromptBudget
+from src.movie.movie_user import MovieUserView
+from src.movie.movielens_loader import has_users, load_movies, load_ratings, load_users, parse_ratings, ratings_path
 
 
 class MovieDataset:
     """
     A class used to represent a Movie Dataset.
 
+    The demographics of users.dat are optional. The ml-10m and ml-20m releases do not ship it, their users are the
+    ones found in the ratings and their prompts leave out gender and age.
+
     Attributes:
         folder (str): The folder containing the dataset files.
+        prompt_budget (PromptBudget | None): The token budget of the user prompts.
+        streaming (bool): Whether __iter__ streams the users from the ratings file chunk by chunk.
+        presorted (bool): Whether the ratings file is grouped by user.
         __user_score (pd.DataFrame | None): The user scores dataframe.
         __movie_dict (dict | None): The dictionary of movies.
         __users (pd.DataFrame | None): The dataframe of users.
         __movies (pd.DataFrame | None): The dataframe of movies.
         __ratings (pd.DataFrame | None): The dataframe of ratings.
-        __data (dict | None): The dictionary of user data.
         __white_list (list | None): The whitelist of movie IDs.
+        __interactions (InteractionMatrix | None): The ratings in CSR layout.
+        __user_info (dict | None): The gender and age of every user, empty without users.dat.
 
     Methods:
         user_score: Returns the user scores dataframe.
@@ -25,28 +39,44 @@ class MovieDataset:
         users: Returns the dataframe of users.
         movies: Returns the dataframe of movies.
         ratings: Returns the dataframe of ratings.
+        interactions: Returns the ratings in CSR layout.
         data: Returns the dictionary of user data.
+        user_ids(): Returns the IDs of every user in the iteration order.
+        item_ids(): Returns the movie ID of every row of the item table of the interactions.
+        catalog_items(): Returns every rated movie as an item to describe and embed once.
+        get_user(user_id: int): Returns a lightweight view on the user with the given ID.
+        stream(): Yields every user without loading the whole ratings file.
         __getitem__(user_id): Returns the user data for the given user ID.
         __len__(): Returns the number of users.
         __iter__(): Returns an iterator over the users.
     """
 
-    def __init__(self, folder: str, whitelist: list | None = None):
+    def __init__(self, folder: str, whitelist: list | None = None, prompt_budget: PromptBudget | None = None,
+                 streaming: bool = False, presorted: bool = True):
         """
         Initializes the MovieDataset with the provided folder and whitelist.
 
         Args:
             folder (str): The folder containing the dataset files.
             whitelist (list, optional): The whitelist of movie IDs. Defaults to None.
+            prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+            streaming (bool, optional): Whether __iter__ streams the users from the ratings file chunk by chunk
+                instead of loading every rating first. Defaults to False.
+            presorted (bool, optional): Whether the ratings file is grouped by user, as the MovieLens files are,
+                otherwise streaming sorts it into an on-disk spill first. Defaults to True.
         """
         self.folder = folder
+        self.prompt_budget = prompt_budget
+        self.streaming = streaming
+        self.presorted = presorted
         self.__user_score = None
         self.__movie_dict = None
         self.__users = None
         self.__movies = None
         self.__ratings = None
-        self.__data = None
-        self.__white_list = None
+        self.__white_list = whitelist
+        self.__interactions = None
+        self.__user_info = None
 
     @property
     def user_score(self):
@@ -57,8 +87,12 @@ class MovieDataset:
             pd.DataFrame: The user scores dataframe.
         """
         if self.__user_score is None:
-            self.__user_score = self.ratings.groupby('user_id')[['movie_id', 'rating']].apply(
-                lambda x: list(zip(x['movie_id'], x['rating']))).reset_index().rename(columns={0: 'ratings'})
+            matrix = self.interactions
+            movie_ids = self.movies['movie_id'].to_numpy()[matrix.item_idx].tolist()
+            pairs = list(zip(movie_ids, matrix.rating.tolist(), strict=True))
+            ptr = matrix.user_ptr.tolist()
+            self.__user_score = pd.DataFrame({'user_id': matrix.user_ids,
+                                              'ratings': [pairs[start:stop] for start, stop in pairwise(ptr)]})
         return self.__user_score
 
     @property
@@ -76,17 +110,17 @@ class MovieDataset:
     @property
     def users(self):
         """
-        Returns the dataframe of users.
+        Returns the dataframe of users, only the user_id column of the rated users if users.dat does not exist.
 
         Returns:
             pd.DataFrame: The dataframe of users.
         """
         if self.__users is None:
-            data_path = os.path.join(self.folder, "users.dat")
-            logging.info(f"Loading users from {data_path}")
-            self.__users = pd.read_csv(data_path, sep="::",
-                                       names=["user_id", "gender", "age", "occupation", "zip_code"],
-                                       encoding='latin-1', engine='python')
+            if has_users(self.folder):
+                self.__users = load_users(self.folder)
+            else:
+                logging.info(f"No users.dat in {self.folder}, taking the users from the ratings without demographics")
+                self.__users = pd.DataFrame({'user_id': self.interactions.user_ids})
             logging.info(f"User shape: {self.__users.shape}")
         return self.__users
 
@@ -99,10 +133,7 @@ class MovieDataset:
             pd.DataFrame: The dataframe of movies.
         """
         if self.__movies is None:
-            data_path = os.path.join(self.folder, "movies.dat")
-            logging.info(F"Loading movies from {data_path}")
-            self.__movies = pd.read_csv(data_path, sep="::", names=["movie_id", "title", "genres"],
-                                        encoding='latin-1', engine='python')
+            self.__movies = load_movies(self.folder)
             logging.info(f"Movie shape: {self.__movies.shape}")
         return self.__movies
 
@@ -115,36 +146,121 @@ class MovieDataset:
             pd.DataFrame: The dataframe of ratings.
         """
         if self.__ratings is None:
-            data_path = os.path.join(self.folder, "ratings.dat")
-            logging.info(F"Loading interactions from {data_path}")
-            self.__ratings = pd.read_csv(data_path, sep="::",
-                                         names=["user_id", "movie_id", "rating", "timestamp"],
-                                         encoding='latin-1', engine='python')
+            self.__ratings = load_ratings(self.folder)
             logging.info(f"Interaction shape: {self.__ratings.shape}")
         return self.__ratings
 
+    @property
+    def interactions(self) -> InteractionMatrix:
+        """
+        Returns the ratings in CSR layout, built in one vectorized pass.
+
+        Every user who rated a movie gets a row, even if the whitelist leaves it empty.
+
+        Returns:
+            InteractionMatrix: The ratings grouped by user with rows of the movies dataframe as items.
+        """
+        if self.__interactions is None:
+            self.__interactions = self.__build_interactions(self.ratings)
+            logging.info(f"Interaction matrix: {len(self.__interactions)} users, "
+                         f"{self.__interactions.memory_usage() / 2 ** 20:.1f} MiB")
+        return self.__interactions
+
+    def __build_interactions(self, ratings: pd.DataFrame) -> InteractionMatrix:
+        user_ids, user_codes = np.unique(ratings['user_id'].to_numpy(), return_inverse=True)
+        item_idx = pd.Index(self.movies['movie_id']).get_indexer(ratings['movie_id'])
+        keep = item_idx >= 0
+        if self.__white_list:
+            keep &= ratings['movie_id'].isin(self.__white_list).to_numpy()
+        return InteractionMatrix.from_arrays(user_codes=user_codes[keep],
+                                             user_ids=user_ids,
+                                             item_idx=item_idx[keep],
+                                             rating=ratings['rating'].to_numpy()[keep],
+                                             timestamp=ratings['timestamp'].to_numpy()[keep],
+                                             items=self.movies)
+
     @property
     def data(self):
         """
         Returns the dictionary of user data.
 
         Returns:
-            dict: The dictionary of user data.
-        """
-        if self.__data is None:
-            self.__data = {}
-            for user_id in self.user_score["user_id"]:
-                user_desc = self.user_score.loc[self.user_score["user_id"] == user_id]['ratings'].iloc[0]
-                if self.__white_list:
-                    user_desc = {self.movie_dict[movie_id]['title']: rating for movie_id, rating in user_desc if
-                                 movie_id in self.__white_list}
-                else:
-                    user_desc = {self.movie_dict[movie_id]['title']: rating for movie_id, rating in user_desc}
-                user_info = self.users.loc[self.users.user_id == user_id][['age', 'gender']].to_dict(orient='records')[
-                    0]
-                user = MovieUser(**user_info, rankings=user_desc, id=user_id)
-                self.__data[user_id] = user
-        return self.__data
+            dict: The dictionary of user views.
+        """
+        return {user_id: self.get_user(user_id) for user_id in self.interactions.user_index}
+
+    def user_ids(self) -> list[int]:
+        """
+        Returns the IDs of every user in the iteration order.
+
+        Returns:
+            list[int]: The user IDs.
+        """
+        return self.users['user_id'].tolist()
+
+    def item_ids(self) -> np.ndarray:
+        """
+        Returns the movie ID of every row of the item table of the interactions.
+
+        Returns:
+            np.ndarray: The movie IDs aligned with the interaction item indices.
+        """
+        return self.movies['movie_id'].to_numpy()
+
+    def catalog_items(self) -> list[CatalogItem]:
+        """
+        Returns every movie rated at least once with its title and genres, in movie table order.
+
+        Returns:
+            list[CatalogItem]: The movies to describe and embed once for the item encoding.
+        """
+        rows = np.unique(self.interactions.item_idx)
+        titles = self.movies['title'].to_numpy()[rows].tolist()
+        genres = self.movies['genres'].astype(str).to_numpy()[rows].tolist()
+        return [CatalogItem(movie_id, f"{title}, genres: {genre.replace('|', ', ')}")
+                for movie_id, title, genre in zip(self.item_ids()[rows].tolist(), titles, genres, strict=True)]
+
+    def get_user(self, user_id: int) -> MovieUserView:
+        """
+        Returns a lightweight view on the user with the given ID.
+
+        Args:
+            user_id (int): The user ID.
+
+        Returns:
+            MovieUserView: The user rendering its rankings from the interaction matrix.
+        """
+        return self.__view(self.interactions, user_id)
+
+    def stream(self) -> Iterator[MovieUserView]:
+        """
+        Yields every user with at least one rating without loading the whole ratings file.
+
+        The file is read in chunks of complete users through an InteractionStream, every chunk becomes a small
+        interaction matrix built like the full one, so a user has the same rankings in both modes.
+
+        Yields:
+            MovieUserView: The next user, in the order of the ratings file.
+        """
+        data_path = ratings_path(self.folder)
+        dat = data_path.endswith(".dat")
+        stream = InteractionStream(data_path, separator=b"::" if dat else b",", header=not dat,
+                                   presorted=self.presorted)
+        header = stream.header_line()
+        for lines in stream:
+            matrix = self.__build_interactions(parse_ratings(header + b"".join(lines), dat=dat))
+            for user_id in matrix.user_index:
+                yield self.__view(matrix, user_id)
+
+    def __view(self, matrix: InteractionMatrix, user_id: int) -> MovieUserView:
+        if self.__user_info is None:
+            self.__user_info = {}
+            if has_users(self.folder):
+                self.__user_info = dict(zip(self.users['user_id'].tolist(),
+                                            zip(self.users['gender'].tolist(), self.users['age'].tolist(), strict=True),
+                                            strict=True))
+        gender, age = self.__user_info.get(user_id, (None, None))
+        return MovieUserView(matrix, user_id, gender=gender, age=age, budget=self.prompt_budget)
 
     def __getitem__(self, user_id):
         """
@@ -154,10 +270,10 @@ class MovieDataset:
             user_id (int | slice | list): The user ID or a slice or list of user IDs.
 
         Returns:
-            MovieUser | list[MovieUser]: The user data for the given user ID or a list of user data.
+            MovieUserView | list[MovieUserView]: The user data for the given user ID or a list of user data.
         """
         if isinstance(user_id, int):
-            return self.data[user_id]
+            return self.get_user(user_id)
         elif isinstance(user_id, slice):
             start = user_id.start
             stop = user_id.stop
@@ -188,7 +304,10 @@ class MovieDataset:
         Returns an iterator over the users.
 
         Yields:
-            MovieUser: The next user in the dataset.
+            MovieUserView: The next user in the dataset.
         """
+        if self.streaming:
+            yield from self.stream()
+            return
         for user_id in self.users['user_id']:
             yield self[user_id]
@@ -1,51 +1,87 @@
+from collections.abc import Iterable
 from typing import Literal
 
+import numpy as np
 from pydantic import BaseModel
 
+from src.data.interaction_matrix import InteractionMatrix, UserView
+from src.data.prompt_budget import PromptBudget
+
+AGE_DICT = {1: "Under 18",
+            18: "18-24",
+            25: "25-34",
+            35: "35-44",
+            45: "45-49",
+            50: "50-55",
+            56: "56+"}
+
 
 class MovieUser(BaseModel):
     """A class used to represent a Movie User.
 
     Attributes:
         id (int): The unique identifier for the user.
-        gender (Literal["M", "F"]): The gender of the user.
-        age (int): The age of the user.
+        gender (Literal["M", "F"] | None): The gender of the user, None if unknown.
+        age (int | None): The age of the user, None if unknown.
         rankings (dict[str, int] | None): The movie rankings given by the user.
         description (str | None): The description of the user.
         embedding (list[float] | None): The embedding of the user.
         AGE_DICT (dict[int, str]): A dictionary mapping age ranges to descriptions.
 
     Methods:
-        prompt(): Generates a description prompt for the user.
+        render_prompt(gender, age, rankings): Renders the description prompt from plain values.
+        prompt(budget: PromptBudget | None = None): Generates a description prompt for the user.
         __hash__(): Returns the hash of the user id.
     """
 
     id: int
-    gender: Literal["M", "F"]
-    age: int
+    gender: Literal["M", "F"] | None = None
+    age: int | None = None
     rankings: dict[str, int] | None = None
     description: str | list[dict[str, str]] | None = None
     embedding: list[float] | None = None
-    AGE_DICT: dict[int, str] = {1: "Under 18",
-                                18: "18-24",
-                                25: "25-34",
-                                35: "35-44",
-                                45: "45-49",
-                                50: "50-55",
-                                56: "56+"}
+    AGE_DICT: dict[int, str] = AGE_DICT
 
-    def prompt(self):
-        """Generates a description prompt for the user.
+    @staticmethod
+    def render_prompt(gender: str | None, age: int | None, rankings: Iterable[tuple[str, int]]) -> str:
+        """Renders the description prompt from plain values, leaving out the demographics that are unknown.
+
+        Args:
+            gender (str | None): The gender of the user, "M" or "F", None if unknown.
+            age (int | None): The age category of the user, None if unknown.
+            rankings (Iterable[tuple[str, int]]): The rated movie titles and their ratings.
 
         Returns:
             str: The description prompt for the user.
         """
-        gender = "Male" if self.gender == "M" else "Female"
-        desc = f"I am a {gender} of age {self.AGE_DICT[self.age]} and I rank movies as follows: "
-        movie_desc = ", ".join([f"{movie}: {rating}" for movie, rating in self.rankings.items()])
+        person = "user" if gender is None else "Male" if gender == "M" else "Female"
+        if age is not None:
+            desc = f"I am a {person} of age {AGE_DICT[age]} and I rank movies as follows: "
+        elif gender is not None:
+            desc = f"I am a {person} and I rank movies as follows: "
+        else:
+            desc = "I rank movies as follows: "
+        movie_desc = ", ".join([f"{movie}: {rating}" for movie, rating in rankings])
         desc += movie_desc
         return desc
 
+    def prompt(self, budget: PromptBudget | None = None):
+        """Generates a description prompt for the user.
+
+        Args:
+            budget (PromptBudget, optional): The token budget of the prompt, the rankings carry no timestamps so the
+                "recent" strategy keeps the last rankings. Defaults to None.
+
+        Returns:
+            str: The description prompt for the user.
+        """
+        if budget is None:
+            return self.render_prompt(self.gender, self.age, self.rankings.items())
+        rankings = list(self.rankings.items())
+        ratings = np.array([rating for _, rating in rankings])
+        return budget.fit(lambda entries: self.render_prompt(self.gender, self.age, entries),
+                          rankings, ratings, np.arange(len(rankings))).text
+
     def __hash__(self):
         """Returns the hash of the user id.
 
@@ -55,6 +91,77 @@ class MovieUser(BaseModel):
         return hash(self.id)
 
     def dict(self, *args, **kwargs) -> dict:
-        data = self.model_dump(exclude={"AGE_DICT"})
+        data = self.model_dump(exclude={"AGE_DICT", "embedding"})
         data["prompt"] = self.prompt()
         return data
+
+
+
+class MovieUserView(UserView):
+    """A class used to represent a Movie User stored in an InteractionMatrix.
+
+    It exposes the same interface as MovieUser but renders the prompt straight from the interaction arrays, within
+    the token budget of the view if one is set.
+
+    Attributes:
+        gender (str | None): The gender of the user, None without users.dat.
+        age (int | None): The age of the user, None without users.dat.
+
+    Methods:
+        rankings: Returns the movie rankings given by the user.
+        prompt_parts(): Returns the prompt renderer of the user and its (title, rating) entries.
+        prompt(): Generates a description prompt for the user.
+        dict(): Returns the serializable representation of the user.
+    """
+
+    __slots__ = ("gender", "age")
+
+    def __init__(self, matrix: InteractionMatrix, user_id: int, gender: str | None = None, age: int | None = None,
+                 budget: PromptBudget | None = None):
+        """Initializes the view on the row of the given user.
+
+        Args:
+            matrix (InteractionMatrix): The matrix of movie ratings.
+            user_id (int): The id of the user.
+            gender (str, optional): The gender of the user. Defaults to None (unknown).
+            age (int, optional): The age of the user. Defaults to None (unknown).
+            budget (PromptBudget, optional): The token budget of the prompt. Defaults to None.
+        """
+        super().__init__(matrix, user_id, budget=budget)
+        self.gender = gender
+        self.age = age
+
+    def __iter_rankings(self):
+        titles = self.matrix.item_column("title")[self.item_positions]
+        return zip(titles.tolist(), self.rating_values.tolist(), strict=True)
+
+    @property
+    def rankings(self) -> dict[str, int]:
+        return dict(self.__iter_rankings())
+
+    def prompt_parts(self):
+        """Returns the prompt renderer of the user and its (title, rating) entries.
+
+        Returns:
+            tuple[Callable[[list], str], list]: The render function and the entries.
+        """
+        return (lambda entries: MovieUser.render_prompt(self.gender, self.age, entries)), list(self.__iter_rankings())
+
+    def prompt(self):
+        """Generates a description prompt for the user.
+
+        Returns:
+            str: The description prompt for the user.
+        """
+        if self._prompt is None:
+            self._prompt = self.fit_prompt(*self.prompt_parts())
+        return self._prompt.text
+
+    def dict(self) -> dict:
+        return {"id": self.id,
+                "gender": self.gender,
+                "age": self.age,
+                "rankings": self.rankings,
+                "description": self.description,
+                "prompt": self.prompt(),
+                **self.budget_report()}
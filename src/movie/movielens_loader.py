@@ -0,0 +1,155 @@
+import csv
+import io
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+USER_COLUMNS = ["user_id", "gender", "age", "occupation", "zip_code"]
+MOVIE_COLUMNS = ["movie_id", "title", "genres"]
+RATING_COLUMNS = ["user_id", "movie_id", "rating", "timestamp"]
+CSV_COLUMNS = {"userId": "user_id", "movieId": "movie_id"}
+
+
+def read_dat(path: str, names: list[str], dtype: dict | None = None) -> pd.DataFrame:
+    """
+    Reads a "::"-delimited latin-1 MovieLens file with the C parser.
+
+    pandas only supports multi-character separators in its pure-Python parser, so the file is read into memory once,
+    the delimiter is rewritten to a tab and the buffer is handed to the C engine.
+
+    Args:
+        path (str): The path to the .dat file.
+        names (list[str]): The column names.
+        dtype (dict, optional): The column dtypes. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The parsed file.
+    """
+    with open(path, 'rb') as f:
+        return parse_dat(f.read(), names, dtype=dtype)
+
+
+def parse_dat(buffer: bytes, names: list[str], dtype: dict | None = None) -> pd.DataFrame:
+    """
+    Parses the lines of a "::"-delimited latin-1 MovieLens file, see read_dat().
+
+    Args:
+        buffer (bytes): The lines.
+        names (list[str]): The column names.
+        dtype (dict, optional): The column dtypes. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The parsed lines.
+    """
+    return pd.read_csv(io.BytesIO(buffer.replace(b"::", b"\t")), sep="\t", names=names, dtype=dtype,
+                       encoding='latin-1', quoting=csv.QUOTE_NONE, engine='c')
+
+
+def has_users(folder: str) -> bool:
+    """
+    Checks whether a MovieLens dataset ships users.dat with the demographics of its users, as ml-1m does and ml-10m
+    and ml-20m do not.
+
+    Args:
+        folder (str): The folder containing the dataset files.
+
+    Returns:
+        bool: True if users.dat exists, False otherwise.
+    """
+    return os.path.exists(os.path.join(folder, "users.dat"))
+
+
+def load_users(folder: str) -> pd.DataFrame:
+    """
+    Loads the users of a MovieLens dataset, available in the ml-1m layout only, see has_users().
+
+    Args:
+        folder (str): The folder containing the dataset files.
+
+    Returns:
+        pd.DataFrame: The users with int32 ids, categorical gender and int8 age and occupation.
+    """
+    data_path = os.path.join(folder, "users.dat")
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"File not found: {data_path}")
+    logging.info(f"Loading users from {data_path}")
+    return read_dat(data_path, USER_COLUMNS, dtype={"user_id": np.int32, "gender": "category", "age": np.int8,
+                                                    "occupation": np.int8, "zip_code": str})
+
+
+def load_movies(folder: str) -> pd.DataFrame:
+    """
+    Loads the movies of a MovieLens dataset from movies.dat (ml-1m, ml-10m) or movies.csv (ml-20m).
+
+    Args:
+        folder (str): The folder containing the dataset files.
+
+    Returns:
+        pd.DataFrame: The movies with int32 ids and categorical genres.
+    """
+    dtype = {"movie_id": np.int32, "title": str, "genres": "category"}
+    data_path = os.path.join(folder, "movies.dat")
+    if os.path.exists(data_path):
+        logging.info(f"Loading movies from {data_path}")
+        return read_dat(data_path, MOVIE_COLUMNS, dtype=dtype)
+    data_path = os.path.join(folder, "movies.csv")
+    logging.info(f"Loading movies from {data_path}")
+    movies = pd.read_csv(data_path, dtype={"movieId": np.int32, "title": str, "genres": "category"})
+    return movies.rename(columns=CSV_COLUMNS)[MOVIE_COLUMNS]
+
+
+def load_ratings(folder: str) -> pd.DataFrame:
+    """
+    Loads the ratings of a MovieLens dataset from ratings.dat (ml-1m, ml-10m) or ratings.csv (ml-20m).
+
+    Args:
+        folder (str): The folder containing the dataset files.
+
+    Returns:
+        pd.DataFrame: The ratings with int32 ids and int8 ratings, or float32 ratings for half-star datasets.
+    """
+    data_path = ratings_path(folder)
+    logging.info(f"Loading interactions from {data_path}")
+    with open(data_path, 'rb') as f:
+        return parse_ratings(f.read(), dat=data_path.endswith(".dat"))
+
+
+def ratings_path(folder: str) -> str:
+    """
+    Returns the ratings file of a MovieLens dataset, ratings.dat if it exists and ratings.csv otherwise.
+
+    Args:
+        folder (str): The folder containing the dataset files.
+
+    Returns:
+        str: The path to the ratings file.
+    """
+    data_path = os.path.join(folder, "ratings.dat")
+    return data_path if os.path.exists(data_path) else os.path.join(folder, "ratings.csv")
+
+
+def parse_ratings(buffer: bytes, dat: bool = True) -> pd.DataFrame:
+    """
+    Parses the lines of a ratings file, see load_ratings().
+
+    Args:
+        buffer (bytes): The lines, starting with the header line for ratings.csv.
+        dat (bool, optional): Whether the lines come from ratings.dat rather than ratings.csv. Defaults to True.
+
+    Returns:
+        pd.DataFrame: The ratings with int32 ids and int8 ratings, or float32 ratings for half-star datasets.
+    """
+    if dat:
+        dtype = {"user_id": np.int32, "movie_id": np.int32, "rating": np.int8, "timestamp": np.int64}
+        try:
+            return parse_dat(buffer, RATING_COLUMNS, dtype=dtype)
+        except ValueError:
+            return parse_dat(buffer, RATING_COLUMNS, dtype={**dtype, "rating": np.float32})
+    dtype = {"userId": np.int32, "movieId": np.int32, "rating": np.int8, "timestamp": np.int64}
+    try:
+        ratings = pd.read_csv(io.BytesIO(buffer), dtype=dtype)
+    except ValueError:
+        ratings = pd.read_csv(io.BytesIO(buffer), dtype={**dtype, "rating": np.float32})
+    return ratings.rename(columns=CSV_COLUMNS)
@@ -1,83 +1,244 @@
-from pydantic import ValidationError
-from tqdm import tqdm
+from collections.abc import Iterator
+import io
 import logging
 import os
+import numpy as np
 import pandas as pd
 
+from src.data.catalog_item import CatalogItem
+from src.data.interaction_matrix import InteractionMatrix
+from src.data.interaction_stream import InteractionStream
+from src.data.prompt_budget import PromptBudget
 from src.music.music_item import MusicItem
-from src.music.music_user import MusicUser
+from src.music.music_user import MusicUserView
+
+
+INTERACTION_DTYPES = {"user_id:token": str, "item_id:token": str, "rating:float": np.float32,
+                      "timestamp:float": np.float64}
 
 
 class MusicDataset:
-    def __init__(self, folder: str):
+    def __init__(self, folder: str, prompt_budget: PromptBudget | None = None, streaming: bool = False,
+                 presorted: bool = False):
+        """
+        Initializes the MusicDataset.
+
+        Args:
+            folder (str): The folder containing the dataset files.
+            prompt_budget (PromptBudget, optional): The token budget of the user prompts. Defaults to None.
+            streaming (bool, optional): Whether __iter__ streams the users from the interaction file chunk by chunk
+                instead of loading every interaction first. Defaults to False.
+            presorted (bool, optional): Whether the interaction file is grouped by user, otherwise streaming sorts
+                it into an on-disk spill first. Defaults to False.
+        """
         self.folder = folder
+        self.prompt_budget = prompt_budget
+        self.streaming = streaming
+        self.presorted = presorted
         self.__items = None
+        self.__item_table = None
         self.__interactions = None
-        self.__users = None
 
+    @property
+    def item_table(self) -> pd.DataFrame:
+        """
+        Returns the item catalog indexed by normalized item id.
+        """
+        if self.__item_table is None:
+            self.__item_table = self.load_item_table(self.folder)
+        return self.__item_table
 
     @property
-    def items(self):
+    def items(self) -> dict[str, MusicItem]:
+        """
+        Returns every item of the catalog as a MusicItem, materializing all of them on the first call.
+        """
         if self.__items is None:
-            self.__items = self.get_item_dict(self.folder)
+            self.__items = {item_id: MusicItem(id=item_id, **values)
+                            for item_id, values in self.item_table.to_dict(orient='index').items()}
         return self.__items
 
     @property
-    def users(self):
-        if self.__users is None:
-            self.__users = self.get_user_dict(self.folder, self.items)
-        return self.__users
+    def interactions(self) -> InteractionMatrix:
+        """
+        Returns the deduplicated interactions in CSR layout, with the item table as items.
+        """
+        if self.__interactions is None:
+            self.__interactions = self.load_interactions(self.folder, self.item_table)
+            logging.info(f"Interaction matrix: {len(self.__interactions)} users, "
+                         f"{self.__interactions.memory_usage() / 2 ** 20:.1f} MiB")
+        return self.__interactions
+
+    @property
+    def users(self) -> dict[str, MusicUserView]:
+        """
+        Returns a view on every user.
+        """
+        return {user_id: self.get_user(user_id) for user_id in self.interactions.user_index}
 
     @classmethod
-    def get_user_dict(cls, folder: str, item_dict: dict[str, MusicItem]) -> dict[str, MusicUser]:
+    def load_interactions(cls, folder: str, item_table: pd.DataFrame) -> InteractionMatrix:
+        """
+        Loads the interactions column-wise and keeps the latest rating of every (user, item) pair.
+
+        Item ids are normalized like MusicItem.validate_ids, interactions with items missing from the catalog are
+        dropped and the rows are ordered by the first appearance of the user and then of the item in the file.
+
+        Args:
+            folder (str): The folder containing the dataset files.
+            item_table (pd.DataFrame): The item catalog indexed by normalized item id.
+
+        Returns:
+            InteractionMatrix: The kept interactions grouped by user.
+        """
         data_path = os.path.join(folder, "Amazon_CDs_and_Vinyl.inter")
         logging.info(f"Loading interactions from {data_path}")
-        interactions = pd.read_csv(data_path, sep='\t')
-
+        interactions = pd.read_csv(data_path, sep='\t', dtype=INTERACTION_DTYPES)
         logging.info(f"Interaction shape: {interactions.shape}")
+        logging.info("Processing interactions")
+        return cls.build_interactions(*cls.interaction_columns(interactions), item_table=item_table)
+
+    @staticmethod
+    def interaction_columns(interactions: pd.DataFrame) -> tuple[pd.Series, pd.Series, np.ndarray, np.ndarray]:
+        """
+        Returns the user ids, item ids, ratings and timestamps of raw interactions, zero timestamps if absent.
+
+        Args:
+            interactions (pd.DataFrame): The rows of the interaction file.
+
+        Returns:
+            tuple[pd.Series, pd.Series, np.ndarray, np.ndarray]: The columns.
+        """
         interactions = interactions.rename(columns={x: x.split(":")[0] for x in interactions.columns})
-        inter_dict = interactions.to_dict(orient='index')
+        if "timestamp" in interactions:
+            timestamps = interactions["timestamp"].to_numpy()
+        else:
+            timestamps = np.zeros(len(interactions))
+        return interactions["user_id"], interactions["item_id"], interactions["rating"].to_numpy(), timestamps
 
-        logging.info("Processing interactions")
-        users = {}
-        for _, v in tqdm(inter_dict.items()):
-            if v['user_id'] not in users:
-                users[v['user_id']] = MusicUser(id=v['user_id'])
-            try:
-                idx = MusicItem.validate_ids(v['item_id'])
-                users[v['user_id']].add(item_dict[idx], v['rating'], v['timestamp'] if 'timestamp' in v else 0)
-            except KeyError:
-                continue
-
-        return users
+    @classmethod
+    def build_interactions(cls, users: pd.Series, items: pd.Series, ratings: np.ndarray, timestamps: np.ndarray,
+                           item_table: pd.DataFrame) -> InteractionMatrix:
+        """
+        Builds the interaction matrix of raw interaction columns, see load_interactions().
+
+        Args:
+            users (pd.Series): The user id of every interaction.
+            items (pd.Series): The raw item id of every interaction.
+            ratings (np.ndarray): The rating of every interaction.
+            timestamps (np.ndarray): The timestamp of every interaction.
+            item_table (pd.DataFrame): The item catalog indexed by normalized item id.
+
+        Returns:
+            InteractionMatrix: The kept interactions grouped by user.
+        """
+        user_codes, user_ids = pd.factorize(users)
+        item_codes, raw_item_ids = pd.factorize(items)
+        del users, items
+        item_ids = item_table.index
+        item_positions = item_ids.get_indexer(raw_item_ids.str.lstrip("0"))[item_codes]
+
+        # factorize numbers users in the order of their first appearance, so sorting by code keeps the file order
+        valid = np.flatnonzero(item_positions >= 0)
+        pairs = user_codes[valid].astype(np.int64) * len(item_ids) + item_positions[valid]
+        order = np.lexsort((-timestamps[valid], pairs))
+        pairs, order = pairs[order], valid[order]
+        starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]])
+        latest = order[starts]
+        pair_first_rows = np.minimum.reduceat(order, starts) if len(order) else order
+        latest = latest[np.lexsort((pair_first_rows, user_codes[latest]))]
+
+        kept_users, user_codes = np.unique(user_codes[latest], return_inverse=True)
+        return InteractionMatrix.from_arrays(user_codes=user_codes,
+                                             user_ids=user_ids.to_numpy()[kept_users],
+                                             item_idx=item_positions[latest],
+                                             rating=ratings[latest],
+                                             timestamp=timestamps[latest],
+                                             items=item_table)
 
     @classmethod
-    def get_item_dict(cls, folder: str) -> dict[str,MusicItem]:
+    def load_item_table(cls, folder: str) -> pd.DataFrame:
+        """
+        Loads the item catalog with normalized ids and cleaned categories.
+
+        Args:
+            folder (str): The folder containing the dataset files.
+
+        Returns:
+            pd.DataFrame: The title, categories, brand and sales_type of every item indexed by item id.
+        """
         data_path = os.path.join(folder, "Amazon_CDs_and_Vinyl.item")
         logging.info(f"Loading items from {data_path}")
         if not os.path.exists(data_path):
             raise FileNotFoundError(f"File not found: {data_path}")
-        df = pd.read_csv(data_path, sep='\t')
+        df = pd.read_csv(data_path, sep='\t', dtype=str, keep_default_na=False)
         df = df.rename(columns={x: x.split(":")[0] for x in df.columns})
-        df = df.set_index('item_id').fillna("").to_dict(orient='index')
-        items = {}
-        for k, v in df.items():
-            try:
-                item = MusicItem(id=k,
-                                 title=v["title"],
-                                 categories=v["categories"],
-                                 brand=v["brand"],
-                                 sales_type=v["sales_type"])
-                items[item.id] = item
-            except ValidationError as e:
-                print(k)
-        return items
+        df["item_id"] = df["item_id"].str.lstrip("0")
+        df["categories"] = df["categories"].str.replace(r"[\[\]']", "", regex=True)
+        df = df.drop_duplicates("item_id", keep="last").set_index("item_id")
+        return df[["title", "categories", "brand", "sales_type"]].astype("category")
+
+    @classmethod
+    def get_item_dict(cls, folder: str) -> dict[str, MusicItem]:
+        df = cls.load_item_table(folder)
+        return {item_id: MusicItem(id=item_id, **values) for item_id, values in df.to_dict(orient='index').items()}
+
+    def user_ids(self) -> list[str]:
+        """
+        Returns the ids of every user in the iteration order.
+        """
+        return list(self.interactions.user_index)
+
+    def item_ids(self) -> np.ndarray:
+        """
+        Returns the normalized id of every row of the item table of the interactions.
+        """
+        return self.item_table.index.to_numpy()
+
+    def catalog_items(self) -> list[CatalogItem]:
+        """
+        Returns every item rated at least once with its title, brand, categories and sales type, in catalog order.
+        """
+        rows = np.unique(self.interactions.item_idx)
+        table = self.item_table.iloc[rows].astype(str)
+        return [CatalogItem(item_id, f"{title} by {brand}, categories: {categories or 'unknown'}, {sales_type}")
+                for item_id, title, brand, categories, sales_type in zip(self.item_ids()[rows].tolist(),
+                                                                        table['title'], table['brand'],
+                                                                        table['categories'], table['sales_type'],
+                                                                        strict=True)]
+
+    def get_user(self, user_id: str) -> MusicUserView:
+        """
+        Returns a lightweight view on the user with the given id.
+        """
+        return MusicUserView(self.interactions, user_id, budget=self.prompt_budget)
 
     def __getitem__(self, item):
-        return self.users[item]
+        return self.get_user(item)
+
+    def stream(self) -> Iterator[MusicUserView]:
+        """
+        Yields every user without loading the whole interaction file.
+
+        The file is read in chunks of complete users through an InteractionStream, every chunk becomes a small
+        interaction matrix built like the full one, so a user has the same ratings in both modes. Users come in the
+        order of the file if it is presorted and sorted by id otherwise.
+
+        Yields:
+            MusicUserView: The next user.
+        """
+        stream = InteractionStream(os.path.join(self.folder, "Amazon_CDs_and_Vinyl.inter"), presorted=self.presorted)
+        header = stream.header_line()
+        for lines in stream:
+            chunk = pd.read_csv(io.BytesIO(header + b"".join(lines)), sep='\t', dtype=INTERACTION_DTYPES)
+            matrix = self.build_interactions(*self.interaction_columns(chunk), item_table=self.item_table)
+            for user_id in matrix.user_index:
+                yield MusicUserView(matrix, user_id, budget=self.prompt_budget)
 
     def __iter__(self):
-        return iter(self.users.values())
+        if self.streaming:
+            return self.stream()
+        return (self.get_user(user_id) for user_id in self.interactions.user_index)
 
     def __len__(self):
-        return len(self.users)
\ No newline at end of file
+        return len(self.interactions)
@@ -1,6 +1,10 @@
 from collections import defaultdict
+from collections.abc import Iterable
+import numpy as np
 from pydantic import BaseModel
 
+from src.data.interaction_matrix import InteractionMatrix, UserView
+from src.data.prompt_budget import PromptBudget
 from.music_item import MusicItem
 
 class MusicUser(BaseModel):
@@ -23,27 +27,48 @@ class MusicUser(BaseModel):
     def dict(self, *args, **kwargs):
         new_dict = {"id": self.id, "ratings": {str(k): v for k, v in self.ratings.items()},
                     "prompt": self.prompt(),
-                    "description": self.description,
-                    "embedding": self.embedding}
+                    "description": self.description}
         return new_dict
 
 
-    def prompt(self):
+    def prompt(self, budget: PromptBudget | None = None):
         if self.new_prompt:
-            return self.prompt_v2()
-        return self.prompt_v1()
+            return self.prompt_v2(budget)
+        return self.prompt_v1(budget)
+
+    def prompt_v1(self, budget: PromptBudget | None = None):
+        return self.__render(self.render_prompt_v1, budget)
+
+    def prompt_v2(self, budget: PromptBudget | None = None):
+        return self.__render(self.render_prompt_v2, budget)
 
-    def prompt_v1(self, ):
-        desc = f"I have rated {len(self.ratings)} items. "
-        desc += ", ".join([f"{item.title} of {item.brand} in {item.categories if item.categories else 'unknown'} "
-                           f"category: {rating}" for item, rating in self.ratings.items()])
+    def __render(self, render, budget: PromptBudget | None):
+        entries = [(item.title, item.brand, item.categories, rating) for item, rating in self.ratings.items()]
+        if budget is None:
+            return render(entries)
+        ratings = np.array(list(self.ratings.values()))
+        timestamps = np.array([self.timestamps.get(item) or 0 for item in self.ratings])
+        return budget.fit(render, entries, ratings, timestamps).text
+
+    @staticmethod
+    def render_prompt_v1(entries: list[tuple[str, str, str, float]]) -> str:
+        """
+        Renders the flat prompt from (title, brand, categories, rating) entries.
+        """
+        desc = f"I have rated {len(entries)} items. "
+        desc += ", ".join([f"{title} of {brand} in {categories if categories else 'unknown'} "
+                           f"category: {rating}" for title, brand, categories, rating in entries])
         return desc
 
-    def prompt_v2(self):
+    @staticmethod
+    def render_prompt_v2(entries: Iterable[tuple[str, str, str, float]]) -> str:
+        """
+        Renders the prompt grouped by rating from (title, brand, categories, rating) entries.
+        """
         marks = defaultdict(list)
-        for item, rating in self.ratings.items():
-            marks[rating].append(f"{item.title} of {item.brand} "
-                                 f"in {item.categories if item.categories else 'unknown'} category")
+        for title, brand, categories, rating in entries:
+            marks[rating].append(f"{title} of {brand} "
+                                 f"in {categories if categories else 'unknown'} category")
 
         desc = (f"I found following items excellent and rate theme five of five: {', '.join(marks[5])}. " if marks[5] else "",
                 f"Items that I found good and rate them four of five: {', '.join(marks[4])}. " if marks[4] else "",
@@ -54,4 +79,90 @@ class MusicUser(BaseModel):
         return desc
 
     def __hash__(self):
-        return hash(self.id)
\ No newline at end of file
+        return hash(self.id)
+
+
+class MusicUserView(UserView):
+    """
+    A class used to represent a Music User stored in an InteractionMatrix.
+
+    It exposes the same interface as MusicUser but renders the prompt straight from the interaction arrays, within
+    the token budget of the view if one is set, so no MusicItem objects are built unless ratings or timestamps are
+    requested.
+    """
+
+    __slots__ = ("new_prompt",)
+
+    def __init__(self, matrix: InteractionMatrix, user_id: str, new_prompt: bool = False,
+                 budget: PromptBudget | None = None):
+        """
+        Initializes the view on the row of the given user.
+
+        Args:
+            matrix (InteractionMatrix): The matrix of album ratings.
+            user_id (str): The id of the user.
+            new_prompt (bool, optional): Whether to render the prompt with prompt_v2. Defaults to False.
+            budget (PromptBudget, optional): The token budget of the prompt. Defaults to None.
+        """
+        super().__init__(matrix, user_id, budget=budget)
+        self.new_prompt = new_prompt
+
+    def entries(self) -> list[tuple[str, str, str, float]]:
+        """
+        Returns the (title, brand, categories, rating) entries of the user.
+        """
+        positions = self.item_positions
+        return list(zip(self.matrix.item_column("title")[positions].tolist(),
+                        self.matrix.item_column("brand")[positions].tolist(),
+                        self.matrix.item_column("categories")[positions].tolist(),
+                        self.rating_values.tolist(), strict=True))
+
+    def items(self) -> list[MusicItem]:
+        """
+        Returns the rated items as MusicItem objects.
+        """
+        rows = self.matrix.items.iloc[self.item_positions]
+        return [MusicItem(id=item_id, **values)
+                for item_id, values in zip(rows.index, rows.to_dict('records'), strict=True)]
+
+    @property
+    def ratings(self) -> dict[MusicItem, float]:
+        return dict(zip(self.items(), self.rating_values.tolist(), strict=True))
+
+    @property
+    def timestamps(self) -> dict[MusicItem, float]:
+        return dict(zip(self.items(), self.timestamp_values.tolist(), strict=True))
+
+    def item_keys(self) -> list[str]:
+        """
+        Returns the id::title::brand::categories::sales_type key of every rated item, as used by MusicUser.dict().
+        """
+        positions = self.item_positions
+        columns = [self.matrix.items.index.to_numpy()[positions]]
+        columns += [self.matrix.item_column(name)[positions] for name in ("title", "brand", "categories", "sales_type")]
+        return ["::".join(values) for values in zip(*(column.tolist() for column in columns), strict=True)]
+
+    def dict(self):
+        return {"id": self.id,
+                "ratings": dict(zip(self.item_keys(), self.rating_values.tolist(), strict=True)),
+                "prompt": self.prompt(),
+                "description": self.description,
+                **self.budget_report()}
+
+    def prompt_parts(self):
+        """
+        Returns the renderer of the prompt version of the user and its (title, brand, categories, rating) entries.
+        """
+        render = MusicUser.render_prompt_v2 if self.new_prompt else MusicUser.render_prompt_v1
+        return render, self.entries()
+
+    def prompt(self):
+        if self._prompt is None:
+            self._prompt = self.fit_prompt(*self.prompt_parts())
+        return self._prompt.text
+
+    def prompt_v1(self):
+        return self.fit_prompt(MusicUser.render_prompt_v1, self.entries()).text
+
+    def prompt_v2(self):
+        return self.fit_prompt(MusicUser.render_prompt_v2, self.entries()).text
@@ -0,0 +1,124 @@
+from collections import deque
+from collections.abc import Callable, Iterable
+import asyncio
+import logging
+
+from src.agents.embed_agent import EmbedAgent
+from src.pipeline.embedding_batcher import EmbeddingBatcher
+
+
+class AsyncUserEncoder:
+    """
+    A class used to encode users concurrently while keeping a bounded number of requests in flight.
+
+    Users are scheduled in the order of the input iterable and reported back in the same order, so the output of a
+    concurrent run is identical to the output of a sequential one. The concurrency bounds the chat stage only, a user
+    gives up its slot once described, so the descriptions waiting for their embedding can fill a whole batch.
+
+    Attributes:
+        llm_agent (EmbedAgent): The agent used to describe and encode users.
+        test (bool): Whether to run in test mode, i.e. without LLM calls.
+        concurrency (int): The maximum number of users described at the same time.
+        window (int): The maximum number of scheduled users waiting to be reported in order.
+        embedding_batch_size (int): The maximum number of descriptions embedded in one request, 1 disables batching.
+        embedding_max_wait (float): The maximum time in seconds a description waits for its embedding batch.
+        batcher (EmbeddingBatcher | None): The embedding stage of the current run when batching is enabled.
+
+    Methods:
+        encode_user(user, slot: asyncio.Semaphore | None = None): Describes and encodes a single user.
+        run(users, callback): Encodes all users and reports each of them to the callback in input order, off the
+            event loop.
+    """
+
+    def __init__(self,
+                 llm_agent: EmbedAgent,
+                 test: bool = False,
+                 concurrency: int = 8,
+                 window: int | None = None,
+                 embedding_batch_size: int = 1,
+                 embedding_max_wait: float = 0.25):
+        """
+        Initializes the AsyncUserEncoder with the provided agent and concurrency.
+
+        Args:
+            llm_agent (EmbedAgent): The agent used to describe and encode users.
+            test (bool, optional): Whether to run in test mode. Defaults to False.
+            concurrency (int, optional): The maximum number of users described at the same time. Defaults to 8.
+            window (int, optional): The reordering window. Defaults to four times the concurrency, and with batching
+                to at least the concurrency plus the embedding batch size, so that a full batch can be waiting.
+            embedding_batch_size (int, optional): The maximum embedding batch size. Defaults to 1 (no batching).
+            embedding_max_wait (float, optional): The maximum embedding batch wait in seconds. Defaults to 0.25.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        self.llm_agent = llm_agent
+        self.test = test
+        self.concurrency = concurrency
+        if window is None:
+            window = 4 * concurrency
+            if embedding_batch_size > 1:
+                window = max(window, concurrency + embedding_batch_size)
+        self.window = max(window, concurrency)
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_max_wait = embedding_max_wait
+        self.batcher = None
+
+    async def encode_user(self, user, slot: asyncio.Semaphore | None = None) -> dict:
+        """
+        Describes and encodes a single user.
+
+        Args:
+            user: The user to encode.
+            slot (asyncio.Semaphore, optional): The semaphore bounding the chat stage, held while the user is
+                described and released before the embedding. Defaults to None (unbounded).
+
+        Returns:
+            dict: The serialized user with its description and embedding.
+        """
+        with self.llm_agent.metrics.timer("user"):
+            if slot is None:
+                user.description = await self.llm_agent.aget_user_description(user=user, test=self.test)
+            else:
+                async with slot:
+                    user.description = await self.llm_agent.aget_user_description(user=user, test=self.test)
+            if not self.test:
+                if self.batcher is not None:
+                    user.embedding = await self.batcher.embed(user.description)
+                else:
+                    user.embedding = await self.llm_agent.aencode_description(user.description)
+        return user.dict()
+
+    async def run(self, users: Iterable, callback: Callable[[object, dict | None, Exception | None], None]):
+        """
+        Encodes all users and reports each of them to the callback in input order.
+
+        The callback runs in a worker thread, so that writing and fsync'ing the results does not stall the requests
+        in flight. Calls never overlap, the next one starts after the previous one returned.
+
+        Args:
+            users (Iterable): The users to encode.
+            callback (Callable): Called as callback(user, record, error) where exactly one of record and error is
+                not None.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if self.embedding_batch_size > 1 and not self.test:
+            self.batcher = EmbeddingBatcher(self.llm_agent.aencode_descriptions,
+                                            max_batch_size=self.embedding_batch_size,
+                                            max_wait=self.embedding_max_wait)
+
+        async def bounded(user):
+            try:
+                return user, await self.encode_user(user, semaphore), None
+            except Exception as e:
+                return user, None, e
+
+        pending = deque()
+        for user in users:
+            pending.append(asyncio.create_task(bounded(user)))
+            if len(pending) >= self.window:
+                await asyncio.to_thread(callback, *await pending.popleft())
+        while pending:
+            await asyncio.to_thread(callback, *await pending.popleft())
+        if self.batcher is not None:
+            await self.batcher.aclose()
+            logging.info(f"Embedded {self.batcher.inputs} descriptions in {self.batcher.requests} batches")
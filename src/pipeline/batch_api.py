@@ -0,0 +1,148 @@
+from collections.abc import Iterable, Iterator
+import json
+import logging
+import os
+
+from src.agents.embed_agent import EmbedAgent
+
+MAX_REQUESTS_PER_FILE = 50_000
+
+
+def custom_id(user_id) -> str:
+    """
+    Returns the custom_id of the requests of a user, the Batch API only accepts strings.
+
+    Args:
+        user_id (int | str): The id of the user.
+
+    Returns:
+        str: The custom_id.
+    """
+    return str(user_id)
+
+
+def export_batch(llm_agent: EmbedAgent,
+                 users: Iterable,
+                 result_folder: str,
+                 name: str,
+                 max_requests: int = MAX_REQUESTS_PER_FILE) -> dict[str, list[str]]:
+    """
+    Writes the next missing request of every user as Batch API input files.
+
+    Chat and embedding requests go to separate files, {name}_batch_chat-000.jsonl and {name}_batch_embedding-000.jsonl,
+    each split every max_requests lines as required by the Batch API.
+
+    Args:
+        llm_agent (EmbedAgent): The agent building the requests.
+        users (Iterable): The users to encode.
+        result_folder (str): The folder for the request files.
+        name (str): The file name prefix.
+        max_requests (int, optional): The maximum number of requests per file. Defaults to 50000.
+
+    Returns:
+        dict[str, list[str]]: The written files by endpoint, "chat" and "embedding".
+    """
+    os.makedirs(result_folder, exist_ok=True)
+    for path in batch_files(result_folder, name):
+        os.remove(path)
+    files, counts, paths = {}, {}, {"chat": [], "embedding": []}
+    try:
+        for user in users:
+            request = llm_agent.batch_request(user, custom_id(user.id))
+            if request is None:
+                continue
+            kind = "chat" if request["url"].endswith("/chat/completions") else "embedding"
+            if counts.get(kind, 0) % max_requests == 0:
+                if kind in files:
+                    files[kind].close()
+                path = os.path.join(result_folder, f"{name}_batch_{kind}-{len(paths[kind]):03d}.jsonl")
+                files[kind] = open(path, 'w', encoding='utf-8')  # noqa: SIM115
+                paths[kind].append(path)
+            files[kind].write(json.dumps(request, ensure_ascii=False) + "\n")
+            counts[kind] = counts.get(kind, 0) + 1
+    finally:
+        for file in files.values():
+            file.close()
+    for kind, count in counts.items():
+        logging.info(f"Exported {count} {kind} requests to {', '.join(paths[kind])}")
+    return paths
+
+
+def batch_files(result_folder: str, name: str) -> list[str]:
+    """
+    Returns the Batch API input files previously written by export_batch.
+
+    Args:
+        result_folder (str): The folder with the request files.
+        name (str): The file name prefix.
+
+    Returns:
+        list[str]: The paths of the files.
+    """
+    if not os.path.isdir(result_folder):
+        return []
+    prefixes = (f"{name}_batch_chat-", f"{name}_batch_embedding-")
+    return sorted(os.path.join(result_folder, file) for file in os.listdir(result_folder)
+                  if file.startswith(prefixes) and file.endswith(".jsonl"))
+
+
+def read_batch_results(path: str) -> Iterator[tuple[str, dict | None, str | None]]:
+    """
+    Reads a Batch API output or error file.
+
+    Args:
+        path (str): The path to the file.
+
+    Yields:
+        tuple[str, dict | None, str | None]: The custom_id, the response body of a successful request and the error
+            message of a failed one.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            body = response.get("body") or {}
+            if result.get("error"):
+                yield result["custom_id"], None, result["error"].get("message", str(result["error"]))
+            elif response.get("status_code", 200) != 200 or "error" in body:
+                error = body.get("error") or {}
+                yield result["custom_id"], None, error.get("message", f"HTTP {response.get('status_code')}")
+            else:
+                yield result["custom_id"], body, None
+
+
+def ingest_batch(llm_agent: EmbedAgent, get_user, result_paths: list[str]) -> dict[str, str]:
+    """
+    Caches the responses of Batch API output files, joined onto the users by custom_id.
+
+    Args:
+        llm_agent (EmbedAgent): The agent caching the responses.
+        get_user (Callable[[str], object | None]): Returns the user of a custom_id or None if unknown.
+        result_paths (list[str]): The Batch API output and error files.
+
+    Returns:
+        dict[str, str]: The error message of every failed request by custom_id, including the responses that could
+            not be cached, e.g. an embedding response without a cached description.
+    """
+    errors, ingested = {}, 0
+    for path in result_paths:
+        for request_id, body, error in read_batch_results(path):
+            user = get_user(request_id)
+            if user is None:
+                logging.warning(f"Skipping the response to {request_id} from {path}: unknown user")
+            elif error is not None:
+                errors[request_id] = error
+            else:
+                try:
+                    llm_agent.ingest_batch_response(user, body)
+                except ValueError as e:
+                    # e.g. an embedding response whose chat output was not ingested, it is exported again
+                    logging.warning(f"Skipping the response to {request_id} from {path}: {e}")
+                    errors[request_id] = str(e)
+                    continue
+                errors.pop(request_id, None)
+                ingested += 1
+    logging.info(f"Ingested {ingested} responses and {len(errors)} errors from {len(result_paths)} files")
+    return errors
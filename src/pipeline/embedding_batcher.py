@@ -0,0 +1,127 @@
+from collections.abc import Awaitable, Callable
+import asyncio
+
+
+class EmbeddingBatcher:
+    """
+    A class used to group single embedding requests into micro-batches.
+
+    Descriptions are collected as the chat stage produces them and sent together once the batch reaches its size or
+    token cap, or once the oldest description has waited for max_wait seconds. Every caller gets back the vector of its
+    own description.
+
+    Attributes:
+        encode (Callable): Coroutine function embedding a list of texts and returning vectors in the same order.
+        max_batch_size (int): The maximum number of texts in one request.
+        max_batch_tokens (int): The maximum estimated number of tokens in one request.
+        max_wait (float): The maximum time in seconds a text waits for its batch to fill up.
+        requests (int): The number of embedding requests sent so far.
+        inputs (int): The number of texts embedded so far.
+
+    Methods:
+        estimate_tokens(text: str): Estimates the number of tokens in the text.
+        embed(text: str): Embeds a single text as part of the next batch.
+        flush(): Sends the currently collected batch.
+        aclose(): Flushes the remaining texts and waits for all requests to finish.
+    """
+
+    def __init__(self,
+                 encode: Callable[[list[str]], Awaitable[list[list[float]]]],
+                 max_batch_size: int = 64,
+                 max_batch_tokens: int = 100_000,
+                 max_wait: float = 0.25):
+        """
+        Initializes the EmbeddingBatcher with the provided encoder and batch limits.
+
+        Args:
+            encode (Callable): Coroutine function embedding a list of texts.
+            max_batch_size (int, optional): The maximum number of texts in one request. Defaults to 64.
+            max_batch_tokens (int, optional): The maximum estimated tokens in one request. Defaults to 100000.
+            max_wait (float, optional): The maximum waiting time of a text in seconds. Defaults to 0.25.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be a positive integer")
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait
+        self.requests = 0
+        self.inputs = 0
+        self.__buffer = []
+        self.__tokens = 0
+        self.__timer = None
+        self.__in_flight = set()
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        Estimates the number of tokens in the text, assuming four characters per token.
+
+        Args:
+            text (str): The text to estimate.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return len(text) // 4 + 1
+
+    async def embed(self, text: str) -> list[float]:
+        """
+        Embeds a single text as part of the next batch.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            list[float]: The embedding of the text.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        tokens = self.estimate_tokens(text)
+        if self.__buffer and self.__tokens + tokens > self.max_batch_tokens:
+            self.flush()
+        self.__buffer.append((text, future))
+        self.__tokens += tokens
+        if len(self.__buffer) >= self.max_batch_size or self.__tokens >= self.max_batch_tokens:
+            self.flush()
+        elif self.__timer is None:
+            self.__timer = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        Sends the currently collected batch.
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if not self.__buffer:
+            return
+        batch, self.__buffer, self.__tokens = self.__buffer, [], 0
+        task = asyncio.ensure_future(self.__send(batch))
+        self.__in_flight.add(task)
+        task.add_done_callback(self.__in_flight.discard)
+
+    async def aclose(self):
+        """
+        Flushes the remaining texts and waits for all requests to finish.
+        """
+        self.flush()
+        if self.__in_flight:
+            await asyncio.gather(*self.__in_flight)
+
+    async def __send(self, batch: list[tuple[str, asyncio.Future]]):
+        try:
+            vectors = await self.encode([text for text, _ in batch])
+            if len(vectors) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.requests += 1
+        self.inputs += len(batch)
+        for (_, future), vector in zip(batch, vectors, strict=True):
+            if not future.done():
+                future.set_result(vector)
@@ -0,0 +1,157 @@
+from collections.abc import Iterator
+import json
+import logging
+import os
+
+from src.monitoring.run_metrics import RunMetrics
+from src.pipeline.result_writer import ResultWriter
+from src.storage.embedding_store import EmbeddingStore
+
+
+class PreviousResults:
+    """
+    A class used to carry the records of unchanged users forward from the previous result set of a run.
+
+    The previous description file and embedding store are moved aside to {name}_previous_* before the new result set
+    is written, and only the byte offset and the fingerprint of every previous record are kept in memory. The list of
+    finished users and the checkpoint of the previous run are removed with it, so that the new result set starts
+    empty even with --resume. A snapshot left by an interrupted incremental run is reused together with the
+    checkpoint of that run, so that the run can be resumed.
+
+    Attributes:
+        result_path (str): The previous description file.
+        embeddings (EmbeddingStore | None): The previous embedding store, None if the previous run had none.
+        index (dict): The fingerprint and the byte offset of the record of every previous user.
+
+    Methods:
+        carry(user_id, fingerprint: str, test: bool = False): Returns the previous record and embedding of an
+            unchanged user.
+        discard(): Removes the snapshot of the previous result set.
+    """
+
+    def __init__(self, result_folder: str, name: str):
+        """
+        Moves the previous result set of the name aside and removes its checkpoint, unless a snapshot already exists,
+        and indexes its records.
+
+        Args:
+            result_folder (str): The folder for the results.
+            name (str): The file name prefix of the result set.
+        """
+        snapshot = f"{name}_previous"
+        current_paths = self.paths(result_folder, name)
+        self.__paths = self.paths(result_folder, snapshot)
+        if not os.path.exists(self.__paths[0]):
+            for current, previous in zip(current_paths, self.__paths, strict=True):
+                if os.path.exists(current):
+                    os.replace(current, previous)
+            # the checkpoint refers to the files moved above, resuming from it would look for them in vain
+            for path in self.progress_paths(result_folder, name):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.result_path = self.__paths[0]
+        self.embeddings = EmbeddingStore(result_folder, snapshot) if os.path.exists(self.__paths[1]) else None
+        self.index = {}
+        if os.path.exists(self.result_path):
+            with open(self.result_path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.index[record["id"]] = (record.get("fingerprint"), offset)
+                    offset += len(line)
+        self.__file = open(self.result_path, 'rb') if self.index else None  # noqa: SIM115
+        logging.info(f"Found {len(self.index)} users in the previous results")
+
+    @staticmethod
+    def paths(result_folder: str, name: str) -> tuple[str, str, str]:
+        """
+        Returns the paths of the description file and of the embedding store of a result set.
+
+        Args:
+            result_folder (str): The folder for the results.
+            name (str): The file name prefix of the result set.
+
+        Returns:
+            tuple[str, str, str]: The description file, the .npy matrix and the id index.
+        """
+        return (os.path.join(result_folder, f"{name}_description.jsonl"), *EmbeddingStore.paths(result_folder, name))
+
+    @staticmethod
+    def progress_paths(result_folder: str, name: str) -> tuple[str, str]:
+        """
+        Returns the paths of the list of finished users and of the checkpoint of a result set, see ResultWriter.
+
+        Args:
+            result_folder (str): The folder for the results.
+            name (str): The file name prefix of the result set.
+
+        Returns:
+            tuple[str, str]: The list of finished users and the checkpoint file.
+        """
+        return (os.path.join(result_folder, f"{name}_done.txt"), os.path.join(result_folder, f"{name}_checkpoint.json"))
+
+    def carry(self, user_id, fingerprint: str, test: bool = False) -> tuple[dict, list[float] | None] | None:
+        """
+        Returns the previous record and embedding of the user if its fingerprint is unchanged.
+
+        Args:
+            user_id (int | str): The id of the user.
+            fingerprint (str): The current fingerprint of the user.
+            test (bool, optional): Whether the run is in test mode, which needs no embedding. Defaults to False.
+
+        Returns:
+            tuple[dict, list[float] | None] | None: The record and the embedding, None if the user must be encoded.
+        """
+        previous = self.index.get(user_id)
+        if previous is None or previous[0] != fingerprint:
+            return None
+        embedding = None if self.embeddings is None else self.embeddings.get(user_id)
+        if embedding is None and not test:
+            return None
+        self.__file.seek(previous[1])
+        return json.loads(self.__file.readline()), embedding
+
+    def discard(self):
+        """
+        Removes the snapshot of the previous result set once the new one is complete.
+        """
+        if self.__file is not None:
+            self.__file.close()
+        self.embeddings = None
+        for path in self.__paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def carry_forward(previous: PreviousResults, writer: ResultWriter, users, fingerprint, test: bool = False,
+                  metrics: RunMetrics | None = None) -> Iterator:
+    """
+    Writes the previous records of the unchanged users and yields the users that must be encoded.
+
+    The users are consumed lazily, one at a time, so a streamed run keeps its bounded memory.
+
+    Args:
+        previous (PreviousResults): The previous result set.
+        writer (ResultWriter): The writer of the new result set.
+        users (Iterable): The users of the run.
+        fingerprint (Callable[[object], str]): Returns the current fingerprint of a user.
+        test (bool, optional): Whether the run is in test mode. Defaults to False.
+        metrics (RunMetrics, optional): The metrics of the run, carried users count as done. Defaults to None.
+
+    Yields:
+        The next new or changed user, in input order.
+    """
+    changed, unchanged = 0, 0
+    for user in users:
+        carried = previous.carry(user.id, fingerprint(user), test=test)
+        if carried is None:
+            changed += 1
+            yield user
+        else:
+            writer.write(*carried)
+            unchanged += 1
+            if metrics is not None:
+                metrics.progress(done=1)
+    logging.info(f"Incremental run: {unchanged} unchanged users carried forward, "
+                 f"{changed} new or changed users encoded")
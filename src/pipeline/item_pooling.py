@@ -0,0 +1,95 @@
+from collections.abc import Iterator
+
+import numpy as np
+
+from src.data.interaction_matrix import InteractionMatrix
+
+SECONDS_PER_DAY = 86400
+
+
+def pooling_weights(matrix: InteractionMatrix,
+                    rating_center: float | None = None,
+                    half_life_days: float | None = None,
+                    mask: np.ndarray | None = None) -> np.ndarray:
+    """
+    Returns the weight of every interaction in the user vector pooled from item embeddings.
+
+    The rating weight is the rating minus the rating center, so liked items pull the user towards them and disliked
+    items push the user away. The recency weight halves every half_life_days before the latest interaction of the
+    user. A user whose weights are all zero, e.g. implicit feedback with a single rating value, falls back to the
+    recency weights alone.
+
+    Args:
+        matrix (InteractionMatrix): The interactions.
+        rating_center (float, optional): The neutral rating. Defaults to the middle of the rating range.
+        half_life_days (float, optional): The half-life of the recency weight in days. Defaults to None, i.e. every
+            interaction counts the same.
+        mask (np.ndarray, optional): The interactions that may be pooled, e.g. the ones with an embedded item, the
+            others get a zero weight. Defaults to every interaction.
+
+    Returns:
+        np.ndarray: The float32 weights aligned with the interaction arrays.
+    """
+    rating = matrix.rating.astype(np.float32)
+    users = np.repeat(np.arange(len(matrix)), np.diff(matrix.user_ptr))
+    recency = np.ones(len(rating), dtype=np.float32)
+    if half_life_days is not None and len(rating):
+        timestamp = matrix.timestamp.astype(np.float64)
+        latest = np.full(len(matrix), -np.inf)
+        np.maximum.at(latest, users, timestamp)
+        age_days = (latest[users] - timestamp) / SECONDS_PER_DAY
+        recency = np.exp2(-age_days / half_life_days).astype(np.float32)
+    if mask is not None:
+        recency *= mask
+    if rating_center is None:
+        rating_center = (rating.min() + rating.max()) / 2 if len(rating) else 0
+    weights = (rating - np.float32(rating_center)) * recency
+    unweighted = np.bincount(users, weights=np.abs(weights), minlength=len(matrix)) == 0
+    fallback = unweighted[users]
+    weights[fallback] = recency[fallback]
+    return weights
+
+
+def pool_embeddings(matrix: InteractionMatrix,
+                    item_vectors: np.ndarray,
+                    item_rows: np.ndarray,
+                    weights: np.ndarray,
+                    users_per_block: int = 4096,
+                    chunk: int = 1024) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yields the user vectors pooled from item embeddings, i.e. the L2-normalized weighted sums of the embeddings of
+    the rated items, block by block so that the memory is bounded by the block and not by the number of users.
+
+    The interactions are grouped by user, so every chunk of interactions covers a contiguous range of users and a
+    one-hot matrix of the chunk weights, multiplied with the chunk item embeddings, sums them per user.
+
+    Args:
+        matrix (InteractionMatrix): The interactions.
+        item_vectors (np.ndarray): The item embeddings, one per row.
+        item_rows (np.ndarray): The row of item_vectors of every item table row, -1 for items without embedding.
+        weights (np.ndarray): The weight of every interaction, see pooling_weights().
+        users_per_block (int, optional): The number of users per yielded block. Defaults to 4096.
+        chunk (int, optional): The number of interactions per matrix multiplication. Defaults to 1024.
+
+    Yields:
+        tuple[int, np.ndarray]: The first user row of the block and the float32 vectors of its users, zero for users
+            without any weighted embedded item.
+    """
+    ptr = matrix.user_ptr
+    for first in range(0, len(matrix), users_per_block):
+        last = min(first + users_per_block, len(matrix))
+        start, stop = ptr[first], ptr[last]
+        users = np.repeat(np.arange(last - first), np.diff(ptr[first:last + 1]))
+        rows = item_rows[matrix.item_idx[start:stop]]
+        block_weights = weights[start:stop]
+        keep = (rows >= 0) & (block_weights != 0)
+        users, rows, block_weights = users[keep], rows[keep], block_weights[keep]
+        vectors = np.zeros((last - first, item_vectors.shape[1]), dtype=np.float32)
+        for position in range(0, len(users), chunk):
+            local = users[position:position + chunk]
+            low = local[0]
+            one_hot = np.zeros((local[-1] - low + 1, len(local)), dtype=np.float32)
+            one_hot[local - low, np.arange(len(local))] = block_weights[position:position + chunk]
+            vectors[low:local[-1] + 1] += one_hot @ item_vectors[rows[position:position + chunk]]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        yield first, vectors / np.where(norms == 0, 1, norms)
@@ -0,0 +1,82 @@
+from collections.abc import Iterator
+import json
+import logging
+
+from src.agents.embedding_backends import EmbeddingBackend, HashedTfidfBackend
+from src.storage.embedding_store import EmbeddingStoreWriter
+
+
+def read_descriptions(result_path: str) -> Iterator[tuple[object, str]]:
+    """
+    Reads the descriptions of a result JSONL file, skipping records without a text description such as test runs.
+
+    Args:
+        result_path (str): The {name}_description.jsonl file.
+
+    Yields:
+        tuple[object, str]: The user id and the description.
+    """
+    skipped = 0
+    with open(result_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record.get("description"), str):
+                yield record["id"], record["description"]
+            else:
+                skipped += 1
+    if skipped:
+        logging.warning(f"Skipped {skipped} records of {result_path} without a text description")
+
+
+def reembed(backend: EmbeddingBackend,
+            result_path: str,
+            result_folder: str,
+            name: str,
+            batch_size: int = 1024,
+            idf_path: str | None = None,
+            dtype: str = "float32") -> int:
+    """
+    Embeds the descriptions of a previous run with another backend into a new embedding store, without any chat
+    request. An unfitted TF-IDF backend is first fitted on the descriptions and its weights saved to idf_path.
+
+    Args:
+        backend (EmbeddingBackend): The backend embedding the descriptions.
+        result_path (str): The {name}_description.jsonl file of the previous run.
+        result_folder (str): The folder for the new store.
+        name (str): The name of the new store, written to {name}_embeddings.npy.
+        batch_size (int, optional): The number of descriptions per backend call. Defaults to 1024.
+        idf_path (str, optional): The file for the fitted TF-IDF weights. Defaults to None.
+        dtype (str, optional): The storage dtype of the new store. Defaults to "float32".
+
+    Returns:
+        int: The number of embedded users.
+    """
+    if isinstance(backend, HashedTfidfBackend) and backend.idf is None:
+        backend.fit((description for _, description in read_descriptions(result_path)), batch_size=batch_size)
+        if idf_path:
+            backend.save_idf(idf_path)
+            logging.info(f"Fitted TF-IDF weights saved to {idf_path}")
+
+    store = EmbeddingStoreWriter(result_folder, name, dtype=dtype)
+    ids, descriptions = [], []
+
+    def flush():
+        for user_id, embedding in zip(ids, backend.embed_array(descriptions), strict=True):
+            store.append(user_id, embedding)
+        ids.clear()
+        descriptions.clear()
+
+    try:
+        for user_id, description in read_descriptions(result_path):
+            ids.append(user_id)
+            descriptions.append(description)
+            if len(ids) == batch_size:
+                flush()
+        if ids:
+            flush()
+    finally:
+        store.close()
+    logging.info(f"Embedded {store.rows} descriptions with {backend.name} into {store.matrix_path}")
+    return store.rows
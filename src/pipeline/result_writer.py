@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+
+from src.monitoring.run_metrics import RunMetrics
+from src.storage.embedding_store import EmbeddingStoreWriter
+from src.storage.quantization import row_bytes
+
+
+class ResultWriter:
+    """
+    A class used to stream encoded users to disk and checkpoint the progress of a run.
+
+    Every record is appended to a JSONL file as soon as it is produced, its embedding goes to an embedding store
+    and the id of the user is appended to a list of finished users. Every checkpoint_every records all files are
+    fsync'd and their sizes are recorded in an atomically replaced checkpoint file. Resuming truncates the files back
+    to the last checkpoint, so a crash never leaves partial or duplicated records behind.
+
+    Attributes:
+        result_path (str): The JSONL file with one encoded user per line.
+        done_path (str): The file with the JSON-encoded id of every finished user, one per line.
+        checkpoint_path (str): The checkpoint file with the committed sizes of the files above and of the embeddings.
+        embeddings (EmbeddingStoreWriter | None): The store of the embeddings, created with the first embedding.
+        checkpoint_every (int): The number of records between two checkpoints.
+        done (set): The ids of the users finished in this or a previous run.
+        metrics (RunMetrics): The write and checkpoint timings and the written bytes of the run.
+
+    Methods:
+        is_done(user_id): Checks whether the user has already been encoded.
+        write(record: dict, embedding=None): Appends an encoded user and its embedding.
+        checkpoint(): Flushes, fsyncs and records the current progress.
+        close(): Writes the final checkpoint and closes the files.
+    """
+
+    def __init__(self, result_folder: str, mode: str, resume: bool = False, checkpoint_every: int = 100,
+                 embedding_dtype: str = "float32", metrics: RunMetrics | None = None):
+        """
+        Initializes the ResultWriter for the provided result folder and mode.
+
+        Args:
+            result_folder (str): The folder for the results.
+            mode (str): The dataset mode used as the file name prefix.
+            resume (bool, optional): Whether to continue from the last checkpoint. Defaults to False.
+            checkpoint_every (int, optional): The number of records between two checkpoints. Defaults to 100.
+            embedding_dtype (str, optional): The storage dtype of the embeddings, a resumed store keeps its own.
+                Defaults to "float32".
+            metrics (RunMetrics, optional): The metrics shared with the rest of the run. Defaults to new ones.
+        """
+        os.makedirs(result_folder, exist_ok=True)
+        self.result_path = os.path.join(result_folder, f"{mode}_description.jsonl")
+        self.done_path = os.path.join(result_folder, f"{mode}_done.txt")
+        self.checkpoint_path = os.path.join(result_folder, f"{mode}_checkpoint.json")
+        self.checkpoint_every = checkpoint_every
+        self.done = set()
+        self.embeddings = None
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.__result_folder = result_folder
+        self.__mode = mode
+        self.__embedding_dtype = embedding_dtype
+        self.__pending = 0
+
+        result_offset, done_offset, embedding_state = 0, 0, None
+        if resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            result_offset, done_offset = checkpoint["result_offset"], checkpoint["done_offset"]
+            embedding_state = checkpoint.get("embeddings")
+        if embedding_state or not resume:
+            self.embeddings = EmbeddingStoreWriter(result_folder, mode, state=embedding_state, dtype=embedding_dtype)
+        self.__result_file = self.__open_truncated(self.result_path, result_offset)
+        self.__done_file = self.__open_truncated(self.done_path, done_offset)
+        if done_offset:
+            with open(self.done_path, 'r') as f:
+                self.done = {json.loads(line) for line in f if line.strip()}
+            logging.info(f"Resuming after {len(self.done)} finished users")
+        self.checkpoint()
+
+    def is_done(self, user_id) -> bool:
+        """
+        Checks whether the user has already been encoded.
+
+        Args:
+            user_id (int | str): The id of the user.
+
+        Returns:
+            bool: True if the user is finished, False otherwise.
+        """
+        return user_id in self.done
+
+    def write(self, record: dict, embedding=None):
+        """
+        Appends an encoded user and its embedding.
+
+        Args:
+            record (dict): The serialized user, it must contain the "id" key.
+            embedding (list[float], optional): The embedding of the user. Defaults to None.
+        """
+        with self.metrics.timer("write"):
+            if embedding is not None:
+                if self.embeddings is None:
+                    self.embeddings = EmbeddingStoreWriter(self.__result_folder, self.__mode,
+                                                           dtype=self.__embedding_dtype)
+                self.embeddings.append(record["id"], embedding)
+                self.metrics.count("bytes_written", row_bytes(self.embeddings.dtype, self.embeddings.dim),
+                                   file="embeddings")
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            done_line = (json.dumps(record["id"]) + "\n").encode("utf-8")
+            self.__result_file.write(line)
+            self.__done_file.write(done_line)
+            self.metrics.count("bytes_written", len(line), file="descriptions")
+            self.metrics.count("bytes_written", len(done_line), file="done")
+            self.done.add(record["id"])
+            self.__pending += 1
+        if self.__pending >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Flushes, fsyncs and records the current progress.
+        """
+        with self.metrics.timer("checkpoint"):
+            self.__checkpoint()
+
+    def __checkpoint(self):
+        for file in (self.__result_file, self.__done_file):
+            file.flush()
+            os.fsync(file.fileno())
+        checkpoint = {"result_offset": self.__result_file.tell(),
+                      "done_offset": self.__done_file.tell(),
+                      "count": len(self.done)}
+        if self.embeddings is not None:
+            self.embeddings.flush()
+            checkpoint["embeddings"] = self.embeddings.state()
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self.__pending = 0
+
+    def close(self):
+        """
+        Writes the final checkpoint and closes the files.
+        """
+        self.checkpoint()
+        self.__result_file.close()
+        self.__done_file.close()
+        if self.embeddings is not None:
+            self.embeddings.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def __open_truncated(path: str, offset: int):
+        file = open(path, 'ab')  # noqa: SIM115
+        file.truncate(offset)
+        file.seek(offset)
+        return file
@@ -0,0 +1,197 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from collections.abc import Iterable
+from contextlib import ExitStack
+from typing import NamedTuple
+
+from src.pipeline.result_writer import ResultWriter
+from src.storage.embedding_store import EmbeddingStore
+
+
+def shard_of(user_id, count: int) -> int:
+    """
+    Returns the shard of the user, a stable hash of its JSON-encoded id modulo the number of shards.
+
+    Args:
+        user_id (int | str): The id of the user.
+        count (int): The number of shards.
+
+    Returns:
+        int: The index of the shard in [0, count).
+    """
+    digest = hashlib.sha1(json.dumps(user_id).encode("utf-8"), usedforsecurity=False).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class Shard(NamedTuple):
+    """
+    A deterministic slice of the users of a dataset.
+
+    Attributes:
+        index (int): The index of the shard, starting from 0.
+        count (int): The number of shards.
+
+    Methods:
+        parse(value: str): Parses a shard given as "i/N".
+        name(mode: str): Returns the file name prefix of the shard outputs.
+        contains(user_id): Checks whether the user belongs to the shard.
+    """
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """
+        Parses a shard given as "i/N" with 0 <= i < N.
+
+        Args:
+            value (str): The shard specification.
+
+        Returns:
+            Shard: The parsed shard.
+        """
+        match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+        if match is None or not int(match[1]) < int(match[2]):
+            raise ValueError(f"Invalid shard {value}, expected i/N with 0 <= i < N")
+        return cls(int(match[1]), int(match[2]))
+
+    def name(self, mode: str) -> str:
+        """
+        Returns the file name prefix of the shard outputs.
+
+        Args:
+            mode (str): The dataset mode.
+
+        Returns:
+            str: The prefix, e.g. "amazon_shard-0-of-4".
+        """
+        return f"{mode}_shard-{self.index}-of-{self.count}"
+
+    def contains(self, user_id) -> bool:
+        """
+        Checks whether the user belongs to the shard.
+
+        Args:
+            user_id (int | str): The id of the user.
+
+        Returns:
+            bool: True if the user is encoded by this shard, False otherwise.
+        """
+        return shard_of(user_id, self.count) == self.index
+
+
+def find_shards(result_folder: str, mode: str) -> list[Shard]:
+    """
+    Finds the shards with an output in the result folder.
+
+    Args:
+        result_folder (str): The folder with the shard outputs.
+        mode (str): The dataset mode.
+
+    Returns:
+        list[Shard]: The shards sorted by count and index.
+    """
+    pattern = re.compile(re.escape(mode) + r"_shard-(\d+)-of-(\d+)_description\.jsonl")
+    shards = []
+    for path in glob.glob(os.path.join(glob.escape(result_folder), f"{glob.escape(mode)}_shard-*_description.jsonl")):
+        match = pattern.fullmatch(os.path.basename(path))
+        if match is not None:
+            shards.append(Shard(int(match[1]), int(match[2])))
+    return sorted(shards, key=lambda shard: (shard.count, shard.index))
+
+
+def merge_shards(result_folder: str, mode: str, user_ids: Iterable) -> dict:
+    """
+    Merges the shard outputs into one result set and one error report in the dataset order.
+
+    Records are located by a scan of every shard and copied one at a time, so the merge holds only their offsets in
+    memory. A user found in several shards keeps the record of the first one and is reported as a duplicate, a user
+    of the dataset found in no result and no error report is reported as missing and added to the error report.
+
+    Args:
+        result_folder (str): The folder with the shard outputs, the merged output is written there as well.
+        mode (str): The dataset mode.
+        user_ids (Iterable): The ids of every user of the dataset in the output order.
+
+    Returns:
+        dict: The number of merged users and errors and the lists of missing, duplicate and unknown user ids.
+    """
+    shards = find_shards(result_folder, mode)
+    if not shards:
+        raise FileNotFoundError(f"No shard outputs of {mode} found in {result_folder}")
+    counts = {shard.count for shard in shards}
+    if len(counts) > 1:
+        raise ValueError(f"Shard outputs of {mode} in {result_folder} come from different shard counts: {counts}")
+    count = counts.pop()
+    absent = sorted(set(range(count)) - {shard.index for shard in shards})
+    if absent:
+        logging.warning(f"Outputs of shards {absent} of {count} are missing")
+
+    # the shard files stay open until the merge is written, the stack closes them even if it fails
+    with ExitStack() as stack:
+        records, errors, duplicates, stores, files = {}, {}, [], {}, {}
+        for shard in shards:
+            name = shard.name(mode)
+            path = os.path.join(result_folder, f"{name}_description.jsonl")
+            files[shard] = stack.enter_context(open(path, 'rb'))
+            offset, found = 0, 0
+            for line in files[shard]:
+                if line.strip():
+                    found += 1
+                    user_id = json.loads(line)["id"]
+                    if user_id in records:
+                        duplicates.append(user_id)
+                    else:
+                        records[user_id] = (shard, offset, len(line))
+                offset += len(line)
+            if os.path.exists(EmbeddingStore.paths(result_folder, name)[0]):
+                stores[shard] = EmbeddingStore(result_folder, name)
+            error_path = os.path.join(result_folder, f"{name}_errors.json")
+            if os.path.exists(error_path):
+                with open(error_path, 'r') as f:
+                    errors.update(json.load(f))
+            logging.info(f"Shard {shard.index}/{count}: {found} users")
+
+        merged_errors, missing, merged = {}, [], 0
+        # the merged store keeps the storage dtype of the shards, decoded rows encode back to the same codes
+        dtype = next((store.dtype for store in stores.values()), "float32")
+        with ResultWriter(result_folder=result_folder, mode=mode, embedding_dtype=dtype) as writer:
+            for user_id in user_ids:
+                if user_id in records:
+                    shard, offset, size = records.pop(user_id)
+                    files[shard].seek(offset)
+                    record = json.loads(files[shard].read(size))
+                    embedding = stores[shard].get(user_id) if shard in stores else None
+                    writer.write(record, embedding=embedding)
+                    merged += 1
+                elif str(user_id) in errors:
+                    merged_errors[str(user_id)] = errors[str(user_id)]
+                else:
+                    missing.append(user_id)
+                    merged_errors[str(user_id)] = "Missing from every shard output"
+
+    error_path = os.path.join(result_folder, f"{mode}_errors.json")
+    if merged_errors:
+        with open(error_path, 'w') as f:
+            json.dump(merged_errors, f, indent=2)
+    elif os.path.exists(error_path):
+        os.remove(error_path)
+
+    unknown = list(records)
+    logging.info(f"Merged {merged} users and {len(merged_errors) - len(missing)} errors of {len(shards)} shards "
+                 f"into {writer.result_path}")
+    if missing:
+        logging.warning(f"{len(missing)} users are missing from every shard, e.g. {missing[:5]}")
+    if duplicates:
+        logging.warning(f"{len(duplicates)} users were encoded by several shards, e.g. {duplicates[:5]}")
+    if unknown:
+        logging.warning(f"{len(unknown)} encoded users are not part of the dataset, e.g. {unknown[:5]}")
+    return {"users": merged,
+            "errors": len(merged_errors) - len(missing),
+            "missing": missing,
+            "duplicates": duplicates,
+            "unknown": unknown}
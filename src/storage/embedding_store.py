@@ -0,0 +1,236 @@
+import json
+import os
+
+import numpy as np
+
+from src.storage.quantization import decode, detect, encode, row_bytes, row_layout
+
+
+class EmbeddingStoreWriter:
+    """
+    A class used to append user embeddings to a contiguous .npy matrix.
+
+    The matrix is written row by row behind a fixed-size .npy header that is rewritten with the current number of
+    rows on every flush, so the file is a valid .npy array at every checkpoint. The id of the user stored in every row
+    goes to a separate index file with one JSON-encoded id per line. Rows are stored as float32, float16, int8 codes
+    with a scale per row or packed sign bits, see src.storage.quantization.
+
+    Attributes:
+        matrix_path (str): The path to the .npy matrix.
+        ids_path (str): The path to the user id index.
+        rows (int): The number of rows written so far.
+        dim (int | None): The embedding dimension, known after the first row.
+        dtype (str): The storage dtype of the rows.
+
+    Methods:
+        append(user_id, embedding): Appends the embedding of a user.
+        extend(user_ids, embeddings): Appends the embeddings of several users.
+        flush(): Rewrites the header and fsyncs both files.
+        state(): Returns the committed sizes used to resume the store.
+        close(): Flushes and closes the files.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, folder: str, name: str, state: dict | None = None, dtype: str = "float32"):
+        """
+        Initializes the EmbeddingStoreWriter, optionally resuming from a state returned by state().
+
+        Args:
+            folder (str): The folder for the store files.
+            name (str): The name of the store used as the file name prefix.
+            state (dict, optional): The state to resume from, a new store is started if None. Defaults to None.
+            dtype (str, optional): The storage dtype of a new store, a resumed store keeps its own. Defaults to
+                "float32".
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.matrix_path, self.ids_path = EmbeddingStore.paths(folder, name)
+        self.rows = 0
+        self.dim = None
+        self.dtype = dtype
+        self.__matrix_file = None
+        ids_offset = 0
+        if state and state.get("rows"):
+            self.rows, self.dim, ids_offset = state["rows"], state["dim"], state["ids_offset"]
+            self.dtype = state.get("dtype", "float32")
+            self.__matrix_file = open(self.matrix_path, 'r+b')  # noqa: SIM115
+            self.__matrix_file.truncate(self.HEADER_SIZE + self.rows * row_bytes(self.dtype, self.dim))
+            self.__matrix_file.seek(0, os.SEEK_END)
+        elif os.path.exists(self.matrix_path):
+            os.remove(self.matrix_path)
+        self.__ids_file = open(self.ids_path, 'ab')  # noqa: SIM115
+        self.__ids_file.truncate(ids_offset)
+        self.__ids_file.seek(ids_offset)
+
+    def append(self, user_id, embedding):
+        """
+        Appends the embedding of a user.
+
+        Args:
+            user_id (int | str): The id of the user.
+            embedding (list[float] | np.ndarray): The embedding of the user.
+        """
+        self.extend([user_id], np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+
+    def extend(self, user_ids: list, embeddings: np.ndarray):
+        """
+        Appends the embeddings of several users, encoded in one vectorized pass.
+
+        Args:
+            user_ids (list): The ids of the users.
+            embeddings (np.ndarray): The embeddings of the users, one per row.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self.__matrix_file is None:
+            row_layout(self.dtype, vectors.shape[1])  # rejects an unknown dtype before the file is created
+            self.dim = vectors.shape[1]
+            self.__matrix_file = open(self.matrix_path, 'w+b')  # noqa: SIM115
+            self.__write_header()
+            self.__matrix_file.seek(self.HEADER_SIZE)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected embedding of dimension {self.dim}, got {vectors.shape[1]}")
+        self.__matrix_file.write(encode(vectors, self.dtype).tobytes())
+        self.__ids_file.write("".join(json.dumps(user_id) + "\n" for user_id in user_ids).encode("utf-8"))
+        self.rows += len(vectors)
+
+    def flush(self):
+        """
+        Rewrites the header with the current number of rows and fsyncs both files.
+        """
+        if self.__matrix_file is not None:
+            self.__write_header()
+            self.__matrix_file.flush()
+            os.fsync(self.__matrix_file.fileno())
+        self.__ids_file.flush()
+        os.fsync(self.__ids_file.fileno())
+
+    def state(self) -> dict:
+        """
+        Returns the committed sizes used to resume the store, it should be called right after flush().
+
+        Returns:
+            dict: The number of rows, the dimension, the storage dtype and the size of the id index.
+        """
+        return {"rows": self.rows, "dim": self.dim, "dtype": self.dtype, "ids_offset": self.__ids_file.tell()}
+
+    def close(self):
+        """
+        Flushes and closes the files.
+        """
+        self.flush()
+        if self.__matrix_file is not None:
+            self.__matrix_file.close()
+        self.__ids_file.close()
+
+    def __write_header(self):
+        element, shape = row_layout(self.dtype, self.dim)
+        header = {"descr": np.lib.format.dtype_to_descr(element), "fortran_order": False, "shape": (self.rows, *shape)}
+        prefix = np.lib.format.magic(1, 0)
+        text = repr(header).encode("latin-1")
+        text += b" " * (self.HEADER_SIZE - len(prefix) - 2 - len(text) - 1) + b"\n"
+        position = self.__matrix_file.tell()
+        self.__matrix_file.seek(0)
+        self.__matrix_file.write(prefix + len(text).to_bytes(2, "little") + text)
+        self.__matrix_file.seek(max(position, self.HEADER_SIZE))
+
+
+class EmbeddingStore:
+    """
+    A class used to read user embeddings written by EmbeddingStoreWriter.
+
+    The matrix is opened memory-mapped, so rows are read from disk on access without loading or copying the whole
+    matrix. Rows of float16, int8 and binary stores are decoded to float32 on access.
+
+    Attributes:
+        codes (np.ndarray): The memory-mapped stored matrix with one row per user.
+        dtype (str): The storage dtype of the rows.
+        dim (int): The embedding dimension.
+        vectors (np.ndarray): The float32 matrix, the memory-mapped matrix itself for float32 stores and a decoded
+            copy otherwise.
+        ids (list): The user id of every row.
+        index (dict): The mapping from user id to row.
+
+    Methods:
+        paths(folder: str, name: str): Returns the paths of the matrix and the id index.
+        row(position: int): Returns the embedding stored in the given row.
+        get(user_id, default=None): Returns the embedding of the user or the default.
+        __getitem__(user_id): Returns the embedding of the user.
+        __contains__(user_id): Checks whether the user is stored.
+        __len__(): Returns the number of stored users.
+    """
+
+    def __init__(self, folder: str, name: str):
+        """
+        Opens the store with the provided name in the folder.
+
+        Args:
+            folder (str): The folder with the store files.
+            name (str): The name of the store used as the file name prefix.
+        """
+        matrix_path, ids_path = self.paths(folder, name)
+        self.codes = np.load(matrix_path, mmap_mode='r')
+        self.dtype, self.dim = detect(self.codes)
+        self.__vectors = None
+        with open(ids_path, 'r') as f:
+            # ids appended after the last flush of the matrix have no row yet
+            self.ids = [json.loads(line) for line, _ in zip(f, range(len(self.codes)), strict=False)]
+        self.index = {user_id: position for position, user_id in enumerate(self.ids)}
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self.dtype == "float32":
+            return self.codes
+        if self.__vectors is None:
+            self.__vectors = decode(self.codes, self.dtype, self.dim)
+        return self.__vectors
+
+    @staticmethod
+    def paths(folder: str, name: str) -> tuple[str, str]:
+        """
+        Returns the paths of the matrix and the id index.
+
+        Args:
+            folder (str): The folder with the store files.
+            name (str): The name of the store.
+
+        Returns:
+            tuple[str, str]: The paths of the .npy matrix and of the id index.
+        """
+        return os.path.join(folder, f"{name}_embeddings.npy"), os.path.join(folder, f"{name}_embeddings_ids.txt")
+
+    def row(self, position: int) -> np.ndarray:
+        """
+        Returns the embedding stored in the given row.
+
+        Args:
+            position (int): The row of the matrix.
+
+        Returns:
+            np.ndarray: The float32 embedding, a read-only view for float32 stores.
+        """
+        if self.dtype == "float32":
+            return self.codes[position]
+        return decode(self.codes[position:position + 1], self.dtype, self.dim)[0]
+
+    def get(self, user_id, default=None) -> np.ndarray | None:
+        """
+        Returns the embedding of the user or the default if the user is not stored.
+
+        Args:
+            user_id (int | str): The id of the user.
+            default (optional): The value returned for unknown users. Defaults to None.
+
+        Returns:
+            np.ndarray | None: The float32 embedding or the default.
+        """
+        position = self.index.get(user_id)
+        return default if position is None else self.row(position)
+
+    def __getitem__(self, user_id) -> np.ndarray:
+        return self.row(self.index[user_id])
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.ids)
@@ -0,0 +1,148 @@
+import numpy as np
+
+STORAGE_DTYPES = ("float32", "float16", "int8", "binary")
+
+
+def truncate(vectors: np.ndarray, dimensions: int | None) -> np.ndarray:
+    """
+    Keeps the first dimensions of every row and scales the rows back to unit L2 norm.
+
+    Embeddings trained with Matryoshka representation learning, e.g. text-embedding-3, keep most of their quality
+    when truncated, this is what the dimensions parameter of the OpenAI embeddings endpoint does server-side.
+
+    Args:
+        vectors (np.ndarray): The vectors, one per row.
+        dimensions (int | None): The number of kept dimensions, None keeps every dimension.
+
+    Returns:
+        np.ndarray: The truncated and normalized float32 vectors.
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    if dimensions is not None:
+        if dimensions > vectors.shape[1]:
+            raise ValueError(f"Cannot truncate embeddings of dimension {vectors.shape[1]} to {dimensions}")
+        vectors = vectors[:, :dimensions].copy()
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+    return vectors
+
+
+def row_layout(dtype: str, dim: int) -> tuple[np.dtype, tuple]:
+    """
+    Returns the NumPy dtype and the shape of one stored row.
+
+    float32 and float16 rows are plain vectors, int8 rows are a record of a float32 scale and the int8 codes and binary
+    rows are the sign bits of the vector packed into bytes.
+
+    Args:
+        dtype (str): One of STORAGE_DTYPES.
+        dim (int): The embedding dimension.
+
+    Returns:
+        tuple[np.dtype, tuple]: The element dtype and the shape of a row in elements.
+    """
+    match dtype:
+        case "float32":
+            return np.dtype("<f4"), (dim,)
+        case "float16":
+            return np.dtype("<f2"), (dim,)
+        case "int8":
+            return np.dtype([("scale", "<f4"), ("codes", "i1", (dim,))]), ()
+        case "binary":
+            if dim % 8:
+                raise ValueError(f"Binary codes need a dimension divisible by 8, got {dim}")
+            return np.dtype("u1"), (dim // 8,)
+    raise ValueError(f"Unknown storage dtype {dtype}, expected one of {STORAGE_DTYPES}")
+
+
+def row_bytes(dtype: str, dim: int) -> int:
+    """
+    Returns the size of one stored row in bytes.
+
+    Args:
+        dtype (str): One of STORAGE_DTYPES.
+        dim (int): The embedding dimension.
+
+    Returns:
+        int: The bytes per row.
+    """
+    element, shape = row_layout(dtype, dim)
+    return element.itemsize * int(np.prod(shape, dtype=np.int64))
+
+
+def encode(vectors: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Encodes float32 rows into the stored representation.
+
+    int8 codes use a symmetric scale per row, binary codes keep the sign of every dimension.
+
+    Args:
+        vectors (np.ndarray): The vectors, one per row.
+        dtype (str): One of STORAGE_DTYPES.
+
+    Returns:
+        np.ndarray: The encoded rows in the layout of row_layout().
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    element, _ = row_layout(dtype, vectors.shape[1])
+    match dtype:
+        case "float32":
+            return np.ascontiguousarray(vectors)
+        case "float16":
+            return vectors.astype(np.float16)
+        case "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            rows = np.empty(len(vectors), dtype=element)
+            rows["scale"] = scales
+            rows["codes"] = np.rint(vectors / scales[:, None])
+            return rows
+        case "binary":
+            return np.packbits(vectors > 0, axis=1)
+
+
+def decode(rows: np.ndarray, dtype: str, dim: int) -> np.ndarray:
+    """
+    Decodes stored rows back into float32 vectors.
+
+    Binary codes decode to +-1/sqrt(dim), so the dot product of two decoded rows is 1 - 2 * hamming distance / dim.
+
+    Args:
+        rows (np.ndarray): The encoded rows.
+        dtype (str): One of STORAGE_DTYPES.
+        dim (int): The embedding dimension.
+
+    Returns:
+        np.ndarray: The (rows, dim) float32 vectors.
+    """
+    match dtype:
+        case "float32" | "float16":
+            return np.asarray(rows, dtype=np.float32)
+        case "int8":
+            return rows["codes"].astype(np.float32) * rows["scale"][:, None]
+        case "binary":
+            signs = np.unpackbits(rows, axis=1, count=dim).astype(np.float32)
+            return (2 * signs - 1) / np.float32(np.sqrt(dim))
+    raise ValueError(f"Unknown storage dtype {dtype}, expected one of {STORAGE_DTYPES}")
+
+
+def detect(matrix: np.ndarray) -> tuple[str, int]:
+    """
+    Returns the storage dtype and the embedding dimension of a stored matrix.
+
+    Args:
+        matrix (np.ndarray): The matrix loaded from an embedding store.
+
+    Returns:
+        tuple[str, int]: The storage dtype and the dimension.
+    """
+    if matrix.dtype.names:
+        return "int8", matrix.dtype["codes"].shape[0]
+    match matrix.dtype.str:
+        case "<f4":
+            return "float32", matrix.shape[1]
+        case "<f2":
+            return "float16", matrix.shape[1]
+        case "|u1":
+            return "binary", 8 * matrix.shape[1]
+    raise ValueError(f"Unsupported embedding matrix dtype {matrix.dtype}")
@@ -0,0 +1,286 @@
+import json
+
+import numpy as np
+
+from src.storage.embedding_store import EmbeddingStore
+
+
+class UserIndex:
+    """
+    A class used to find the most similar users by cosine similarity of their embeddings.
+
+    The embeddings are L2-normalized float32 rows, so the cosine similarity is a dot product. Exact search scores
+    blocks of queries against all users with one matrix multiplication per block. The optional IVF mode clusters the
+    users with spherical k-means, stores every cluster as a contiguous list of rows, optionally as int8 codes with a
+    scale per row, and scores only the users of the nprobe clusters closest to every query, grouping the queries by
+    cluster so that every probed list is scored with one matrix multiplication.
+
+    Attributes:
+        ids (list): The user id of every row.
+        index (dict): The mapping from user id to row.
+        vectors (np.ndarray): The normalized float32 embeddings, one row per user.
+        centroids (np.ndarray | None): The normalized centroids of the IVF clusters, None for exact search only.
+        nprobe (int): The number of clusters scored per query in IVF mode.
+
+    Methods:
+        from_store(folder: str, name: str): Builds the index of an embedding store written by encode.py.
+        build_ivf(n_lists: int, nprobe: int, quantize: bool, iterations: int, sample: int, seed: int): Clusters the
+            users for approximate search.
+        search(queries: np.ndarray, k: int, exact: bool | None = None): Returns the rows and scores of the top-k
+            users of every query vector.
+        similar(user_ids: list, k: int, exact: bool | None = None): Returns the top-k most similar users of users.
+        save(path: str): Saves the index to a .npz file.
+        load(path: str): Loads an index saved by save().
+    """
+
+    BLOCK_ELEMENTS = 1 << 24
+
+    def __init__(self, ids: list, vectors: np.ndarray):
+        """
+        Initializes the UserIndex with the provided embeddings, which are copied and normalized.
+
+        Args:
+            ids (list): The user id of every row.
+            vectors (np.ndarray): The embeddings, one row per user.
+        """
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        self.ids = list(ids)
+        self.index = {user_id: row for row, user_id in enumerate(self.ids)}
+        self.vectors = self.normalize(np.asarray(vectors, dtype=np.float32))
+        self.centroids = None
+        self.nprobe = 1
+        self.__offsets = None
+        self.__rows = None
+        self.__codes = None
+        self.__scales = None
+
+    @classmethod
+    def from_store(cls, folder: str, name: str) -> "UserIndex":
+        """
+        Builds the index of an embedding store written by encode.py, e.g. name "ml-1m" for ml-1m_embeddings.npy.
+
+        Args:
+            folder (str): The result folder.
+            name (str): The name of the store.
+
+        Returns:
+            UserIndex: The exact index.
+        """
+        store = EmbeddingStore(folder, name)
+        return cls(store.ids, store.vectors)
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        """
+        Returns the rows scaled to unit L2 norm as float32, zero rows are left unchanged.
+
+        Args:
+            vectors (np.ndarray): The vectors, one per row.
+
+        Returns:
+            np.ndarray: The normalized vectors.
+        """
+        vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        return vectors
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def build_ivf(self, n_lists: int | None = None, nprobe: int = 8, quantize: bool = True, iterations: int = 10,
+                  sample: int | None = None, seed: int = 0) -> "UserIndex":
+        """
+        Clusters the users with spherical k-means for approximate search.
+
+        Args:
+            n_lists (int, optional): The number of clusters. Defaults to 4 * sqrt(number of users).
+            nprobe (int, optional): The number of clusters scored per query. Defaults to 8.
+            quantize (bool, optional): Whether to store the lists as int8 codes, 4 times smaller. Defaults to True.
+            iterations (int, optional): The number of k-means iterations. Defaults to 10.
+            sample (int, optional): The number of users the centroids are trained on. Defaults to 32 per cluster.
+            seed (int, optional): The random seed. Defaults to 0.
+
+        Returns:
+            UserIndex: The index itself.
+        """
+        n_lists = min(n_lists or int(4 * np.sqrt(len(self))), len(self))
+        rng = np.random.default_rng(seed)
+        training = self.vectors[rng.choice(len(self), min(sample or 32 * n_lists, len(self)), replace=False)]
+        centroids = training[rng.choice(len(training), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = self.__nearest_centroids(training, centroids)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, training)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = self.normalize(sums)
+        assignment = self.__nearest_centroids(self.vectors, centroids)[:, 0]
+        self.centroids = centroids
+        self.nprobe = nprobe
+        self.__rows = np.argsort(assignment, kind='stable')
+        self.__offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+        self.__codes, self.__scales = None, None
+        if quantize:
+            self.__codes, self.__scales = self.quantize(self.vectors[self.__rows])
+        return self
+
+    @staticmethod
+    def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Quantizes the rows to int8 with a symmetric scale per row.
+
+        Args:
+            vectors (np.ndarray): The vectors, one per row.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The int8 codes and the float32 scale of every row.
+        """
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def search(self, queries: np.ndarray, k: int = 10, exact: bool | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows and the cosine similarities of the top-k users of every query vector.
+
+        Args:
+            queries (np.ndarray): The query vectors, one per row, or a single vector.
+            k (int, optional): The number of users per query. Defaults to 10.
+            exact (bool, optional): Whether to score every user, defaults to exact unless the IVF mode is built.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (queries, k) rows and similarities in decreasing similarity, rows of
+                missing results are -1 with similarity -inf.
+        """
+        queries = self.normalize(queries)
+        k = min(k, len(self))
+        if exact is None:
+            exact = self.centroids is None
+        if exact:
+            return self.__search_exact(queries, k)
+        if self.centroids is None:
+            raise ValueError("Call build_ivf() before an approximate search")
+        return self.__search_ivf(queries, k)
+
+    def similar(self, user_ids: list, k: int = 10, exact: bool | None = None) -> list[list[tuple[object, float]]]:
+        """
+        Returns the top-k most similar users of every user, excluding the user itself.
+
+        Args:
+            user_ids (list): The ids of the query users.
+            k (int, optional): The number of similar users. Defaults to 10.
+            exact (bool, optional): Whether to score every user, defaults to exact unless the IVF mode is built.
+
+        Returns:
+            list[list[tuple[object, float]]]: The ids and cosine similarities of the similar users of every user.
+        """
+        rows = np.array([self.index[user_id] for user_id in user_ids], dtype=np.int64)
+        found, scores = self.search(self.vectors[rows], k + 1, exact=exact)
+        return [[(self.ids[row], float(score)) for row, score in zip(found_rows, found_scores, strict=True)
+                 if row >= 0 and row != query][:k]
+                for query, found_rows, found_scores in zip(rows, found, scores, strict=True)]
+
+    def save(self, path: str):
+        """
+        Saves the index to a .npz file.
+
+        Args:
+            path (str): The file path.
+        """
+        arrays = {"ids": np.array(json.dumps(self.ids)), "vectors": self.vectors}
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, nprobe=np.array(self.nprobe), rows=self.__rows,
+                          offsets=self.__offsets)
+            if self.__codes is not None:
+                arrays.update(codes=self.__codes, scales=self.__scales)
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "UserIndex":
+        """
+        Loads an index saved by save().
+
+        Args:
+            path (str): The file path.
+
+        Returns:
+            UserIndex: The index.
+        """
+        with np.load(path) as arrays:
+            index = cls.__new__(cls)
+            index.ids = json.loads(str(arrays["ids"]))
+            index.index = {user_id: row for row, user_id in enumerate(index.ids)}
+            index.vectors = arrays["vectors"]
+            index.centroids = arrays.get("centroids")
+            index.nprobe = int(arrays["nprobe"]) if "nprobe" in arrays else 1
+            index.__rows = arrays.get("rows")
+            index.__offsets = arrays.get("offsets")
+            index.__codes = arrays.get("codes")
+            index.__scales = arrays.get("scales")
+        return index
+
+    def __search_exact(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        block = max(1, self.BLOCK_ELEMENTS // max(len(self), 1))
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), block):
+            similarity = queries[start:start + block] @ self.vectors.T
+            rows[start:start + block], scores[start:start + block] = self.top_k(similarity, k)
+        return rows, scores
+
+    def __search_ivf(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        probes = self.__nearest_centroids(queries, self.centroids, min(self.nprobe, len(self.centroids)))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        query_order = np.argsort(probes, axis=None, kind='stable')
+        probed_lists = probes.reshape(-1)[query_order]
+        list_starts = np.searchsorted(probed_lists, np.arange(len(self.centroids) + 1))
+        for cluster in np.flatnonzero(np.diff(list_starts)):
+            begin, end = self.__offsets[cluster], self.__offsets[cluster + 1]
+            if begin == end:
+                continue
+            members = query_order[list_starts[cluster]:list_starts[cluster + 1]] // probes.shape[1]
+            if self.__codes is None:
+                similarity = queries[members] @ self.vectors[self.__rows[begin:end]].T
+            else:
+                codes = self.__codes[begin:end].T.astype(np.float32)
+                similarity = (queries[members] @ codes) * self.__scales[begin:end]
+            candidates = np.concatenate((rows[members], np.broadcast_to(self.__rows[begin:end], similarity.shape)),
+                                        axis=1)
+            positions, scores[members] = self.top_k(np.concatenate((scores[members], similarity), axis=1), k)
+            rows[members] = np.take_along_axis(candidates, positions, axis=1)
+        return rows, scores
+
+    @staticmethod
+    def top_k(similarity: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the columns and values of the k largest values of every row in decreasing order.
+
+        Args:
+            similarity (np.ndarray): The (queries, candidates) similarities.
+            k (int): The number of columns per row.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (queries, k) columns and values.
+        """
+        k = min(k, similarity.shape[1])
+        columns = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        values = np.take_along_axis(similarity, columns, axis=1)
+        order = np.argsort(-values, axis=1, kind='stable')
+        return np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+    @classmethod
+    def __nearest_centroids(cls, vectors: np.ndarray, centroids: np.ndarray, count: int = 1) -> np.ndarray:
+        block = max(1, cls.BLOCK_ELEMENTS // max(len(centroids), 1))
+        nearest = np.empty((len(vectors), count), dtype=np.int64)
+        for start in range(0, len(vectors), block):
+            similarity = vectors[start:start + block] @ centroids.T
+            if count == 1:
+                nearest[start:start + block, 0] = similarity.argmax(axis=1)
+            else:
+                nearest[start:start + block] = cls.top_k(similarity, count)[0]
+        return nearest